@@ -0,0 +1,763 @@
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import json
+import multiprocessing
+from collections import OrderedDict, defaultdict
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import cv2
+
+import torch
+
+from albumentations.augmentations import transforms
+from albumentations.core.composition import Compose, OneOf, KeypointParams
+
+from lib.datasets import Dataset
+from lib.batch_augment import BatchAugment
+from lib.utils.utils import *
+from lib.models.model_factory import get_model
+from lib.optimizers import RAdam, PlainRAdam
+from lib.health import HealthMonitor
+from lib.precision import PrecisionPolicy
+from lib import losses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--target', default='health', choices=['health', 'precision', 'losses', 'focal', 'checkpointing',
+                                                     'memory_format', 'optimizer', 'stages', 'augment'])
+    parser.add_argument('--arch', '-a', default='resnet18_fpn')
+    parser.add_argument('--head_conv', default=64, type=int)
+    parser.add_argument('--num_filters', default='256,128,64')
+    parser.add_argument('--input_w', default=640, type=int)
+    parser.add_argument('--input_h', default=256, type=int)
+    parser.add_argument('-b', '--batch_size', default=2, type=int)
+    parser.add_argument('--num_objs', default=10, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', default=41, type=int)
+    parser.add_argument('--precisions', default='fp32,bf16',
+                        help='precision modes for --target precision')
+    parser.add_argument('--checkpointing', default='none;backbone;decoder;heads;backbone,decoder;all',
+                        help='";" separated checkpointing modes for --target checkpointing')
+    parser.add_argument('--data', default='synthetic', choices=['synthetic', 'real'],
+                        help='images for --target stages: random JPEGs or inputs/train.csv')
+    parser.add_argument('--num_images', default=8, type=int)
+    parser.add_argument('--output', default=None, help='write results as json')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def get_heads(rot='trig', wh=True, tvec=True):
+    heads = OrderedDict([
+        ('hm', 1),
+        ('reg', 2),
+        ('depth', 1),
+    ])
+    heads[rot] = {'eular': 3, 'trig': 6, 'quat': 4}[rot]
+    if wh:
+        heads['wh'] = 2
+    if tvec:
+        heads['tvec'] = 3
+    return heads
+
+
+def make_batch(config, heads, device='cpu'):
+    """Synthetic batch shaped like Dataset's output with num_objs peaks per image."""
+    b = config['batch_size']
+    h, w = config['input_h'] // 4, config['input_w'] // 4
+
+    batch = {
+        'input': torch.randn(b, 3, config['input_h'], config['input_w']),
+        'mask': torch.ones(b, 1, h, w),
+        'reg_mask': torch.zeros(b, 1, h, w),
+        'ind': torch.zeros(b, 100, dtype=torch.long),
+        'ind_mask': torch.zeros(b, 100),
+    }
+    for head, num_output in heads.items():
+        batch[head] = torch.zeros(b, num_output, h, w)
+
+    ys = torch.randint(0, h, (b, config['num_objs']))
+    xs = torch.randint(0, w, (b, config['num_objs']))
+    for i in range(b):
+        batch['reg_mask'][i, 0, ys[i], xs[i]] = 1
+        batch['hm'][i, 0, ys[i], xs[i]] = 1
+        for head, num_output in heads.items():
+            if head != 'hm':
+                batch[head][i, :, ys[i], xs[i]] = torch.rand(num_output, config['num_objs'])
+        # later duplicates win, as in the dense maps
+        last = {}
+        for k, j in enumerate((ys[i] * w + xs[i]).tolist()):
+            last[j] = k
+        batch['ind'][i, :config['num_objs']] = ys[i] * w + xs[i]
+        batch['ind_mask'][i, list(last.values())] = 1
+    batch['depth'] *= 50
+
+    return {k: v.to(device) for k, v in batch.items()}
+
+
+def build(config, heads, device='cpu', checkpointing=None):
+    model = get_model(config['arch'], heads=heads,
+                      head_conv=config['head_conv'],
+                      num_filters=config['num_filters'],
+                      pretrained=False,
+                      checkpointing=checkpointing)
+    model = model.to(device)
+    criterion = OrderedDict()
+    for head in heads.keys():
+        if head == 'hm':
+            criterion[head] = losses.FocalLoss()
+        else:
+            criterion[head] = losses.L1Loss()
+    optimizer = RAdam(filter(lambda p: p.requires_grad, model.parameters()), lr=1e-3)
+    return model, criterion, optimizer
+
+
+def compute_loss(config, heads, criterion, output, batch):
+    loss = 0
+    losses = {}
+    for head in heads.keys():
+        if head == 'hm':
+            losses[head] = criterion[head](output[head], batch[head], batch['mask'])
+        else:
+            losses[head] = criterion[head](output[head], batch[head], batch['reg_mask'],
+                                           ind=batch['ind'], ind_mask=batch['ind_mask'])
+        if head == 'wh':
+            loss += 0.05 * losses[head]
+        elif head == 'tvec':
+            loss += 0.05 * losses[head]
+        else:
+            loss += losses[head]
+    losses['loss'] = loss
+    return loss, losses
+
+
+def sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def summarize(times, images=None):
+    """Latency statistics of times in seconds; images/sec when each time
+    processed `images` images."""
+    times = np.array(times) * 1000
+    result = {
+        'mean_ms': float(np.mean(times)),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+    }
+    if images is not None:
+        result['images_per_sec'] = images * 1000 / result['mean_ms']
+    return result
+
+
+def time_steps(step_fn, steps, warmup, device):
+    for _ in range(warmup):
+        step_fn()
+    times = []
+    for _ in range(steps):
+        sync(device)
+        start = time.perf_counter()
+        step_fn()
+        sync(device)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def saved_tensors_mb(fn, exclude=()):
+    """Runs fn and returns its result and the MB autograd saved for backward,
+    not counting the storages of the `exclude` tensors."""
+    skip = set(t.untyped_storage().data_ptr() for t in exclude)
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in skip:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        result = fn()
+    return result, sum(storages.values()) / 1024**2
+
+
+def count_activation_copies(fn, batch_size):
+    """Runs fn under the profiler and counts copies of batch-sized 4D tensors."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                record_shapes=True) as prof:
+        fn()
+    count = 0
+    for event in prof.events():
+        if event.name != 'aten::copy_' or not event.input_shapes:
+            continue
+        shape = event.input_shapes[0]
+        if len(shape) == 4 and shape[0] == batch_size:
+            count += 1
+    return count
+
+
+def run_isolated(fn, *args):
+    """Runs fn in a fresh process so CPU peak RSS is measured per run."""
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def bench_health(config):
+    """Training step time without checks, with global anomaly detection
+    (the old lib.losses default) and with HealthMonitor."""
+    heads = get_heads()
+    device = config['device']
+    batch = make_batch(config, heads, device)
+
+    results = OrderedDict()
+    for mode in ['off', 'anomaly', 'health']:
+        torch.manual_seed(config['seed'])
+        model, criterion, optimizer = build(config, heads, device)
+        model.train()
+        health = HealthMonitor(heads=['hm', 'depth'], grad_norm_interval=10) if mode == 'health' else None
+
+        def step():
+            if health is not None:
+                health.start_step()
+            output = model(batch['input'])
+            loss, losses = compute_loss(config, heads, criterion, output, batch)
+            if health is not None and not health.check_forward(losses, output):
+                return
+            optimizer.zero_grad()
+            loss.backward()
+            if health is None or health.check_grads(model):
+                optimizer.step()
+
+        torch.autograd.set_detect_anomaly(mode == 'anomaly')
+        results[mode] = time_steps(step, config['steps'], config['warmup'], device)
+        torch.autograd.set_detect_anomaly(False)
+
+    return results
+
+
+def _bench_precision(config, mode):
+    heads = get_heads()
+    device = config['device']
+    torch.manual_seed(config['seed'])
+    batch = make_batch(config, heads, device)
+    model, criterion, optimizer = build(config, heads, device)
+    model.train()
+    precision = PrecisionPolicy(mode, device)
+    scaler = precision.scaler
+
+    def step():
+        with precision.autocast():
+            output = model(batch['input'])
+            loss, _ = compute_loss(config, heads, criterion, output, batch)
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    reset_peak_memory(device)
+    result = time_steps(step, config['steps'], config['warmup'], device)
+    result['peak_mem_mb'] = peak_memory_mb(device)
+    return result
+
+
+def bench_precision(config):
+    """Training step time and peak memory for each --precisions mode."""
+    results = OrderedDict()
+    for mode in config['precisions'].split(','):
+        if config['device'] == 'cpu':
+            results[mode] = run_isolated(_bench_precision, config, mode)
+        else:
+            results[mode] = _bench_precision(config, mode)
+    return results
+
+
+def bench_losses(config):
+    """Forward and backward of the regression losses, dense vs gathered at
+    the object centers, on random head outputs of the model's output size."""
+    heads = get_heads()
+    device = config['device']
+    torch.manual_seed(config['seed'])
+    batch = make_batch(config, heads, device)
+    outputs = OrderedDict()
+    for head in heads.keys():
+        if head != 'hm':
+            outputs[head] = torch.randn_like(batch[head], requires_grad=True)
+    modes = OrderedDict([
+        ('dense', (losses.L1Loss(), losses.DepthL1Loss())),
+        ('gather', (losses.RegL1Loss(), losses.RegDepthL1Loss())),
+    ])
+
+    results = OrderedDict()
+    values = {}
+    for mode, (l1, depth_l1) in modes.items():
+        criterion = {head: depth_l1 if head == 'depth' else l1 for head in outputs.keys()}
+
+        def forward():
+            return sum(criterion[head](output, batch[head], batch['reg_mask'],
+                                       ind=batch['ind'], ind_mask=batch['ind_mask'])
+                       for head, output in outputs.items())
+
+        def step():
+            for output in outputs.values():
+                output.grad = None
+            forward().backward()
+
+        loss, mem = saved_tensors_mb(forward, exclude=list(outputs.values()) + [batch[head] for head in outputs])
+        step()
+        values[mode] = [loss.detach()] + [output.grad.clone() for output in outputs.values()]
+        results[mode] = time_steps(step, config['steps'], config['warmup'], device)
+        results[mode]['saved_mb'] = mem
+
+    results['max_abs_diff'] = max(float((a - b).abs().max())
+                                  for a, b in zip(values['dense'], values['gather']))
+    return results
+
+
+def bench_focal(config):
+    """Forward and backward of the heatmap focal loss: FocalLoss against
+    the logsigmoid version and the recomputing autograd function."""
+    heads = get_heads()
+    device = config['device']
+    torch.manual_seed(config['seed'])
+    batch = make_batch(config, heads, device)
+    # gaussian-like soft negatives around the peaks
+    target = torch.max(batch['hm'], torch.rand_like(batch['hm'])**8)
+    output = torch.randn_like(target, requires_grad=True)
+    modes = OrderedDict([
+        ('FocalLoss', losses.FocalLoss()),
+        ('LogitFocalLoss', losses.LogitFocalLoss()),
+        ('FusedFocalLoss', losses.FusedFocalLoss()),
+    ])
+
+    results = OrderedDict()
+    values = {}
+    for mode, criterion in modes.items():
+        def forward():
+            return criterion(output, target, batch['mask'])
+
+        def step():
+            output.grad = None
+            forward().backward()
+
+        loss, mem = saved_tensors_mb(forward, exclude=[output, target, batch['mask']])
+        step()
+        values[mode] = [loss.detach(), output.grad.clone()]
+        results[mode] = time_steps(step, config['steps'], config['warmup'], device)
+        results[mode]['saved_mb'] = mem
+        if mode != 'FocalLoss':
+            results[mode]['max_rel_diff'] = max(float((a - b).abs().max() / a.abs().max())
+                                                for a, b in zip(values['FocalLoss'], values[mode]))
+
+    return results
+
+
+def _bench_checkpointing(config, mode):
+    heads = get_heads()
+    device = config['device']
+    torch.manual_seed(config['seed'])
+    batch = make_batch(config, heads, device)
+    model, criterion, optimizer = build(config, heads, device, checkpointing=mode)
+    model.train()
+
+    def step():
+        output = model(batch['input'])
+        loss, _ = compute_loss(config, heads, criterion, output, batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    reset_peak_memory(device)
+    result = time_steps(step, config['steps'], config['warmup'], device)
+    result['peak_mem_mb'] = peak_memory_mb(device)
+    return result
+
+
+def bench_checkpointing(config):
+    """Training step time and peak memory for each activation checkpointing
+    mode in --checkpointing."""
+    results = OrderedDict()
+    for mode in config['checkpointing'].split(';'):
+        if config['device'] == 'cpu':
+            results[mode] = run_isolated(_bench_checkpointing, config, mode)
+        else:
+            results[mode] = _bench_checkpointing(config, mode)
+    return results
+
+
+def bench_memory_format(config):
+    """Training and inference throughput with NCHW and channels_last model
+    and inputs, and the activation copies made by one forward pass."""
+    heads = get_heads()
+    device = config['device']
+
+    results = OrderedDict()
+    for mode, memory_format in [('contiguous', torch.contiguous_format),
+                                ('channels_last', torch.channels_last)]:
+        torch.manual_seed(config['seed'])
+        batch = make_batch(config, heads, device)
+        batch['input'] = batch['input'].contiguous(memory_format=memory_format)
+        model, criterion, optimizer = build(config, heads, device)
+        model = model.to(memory_format=memory_format)
+
+        def step():
+            output = model(batch['input'])
+            loss, _ = compute_loss(config, heads, criterion, output, batch)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        def inference():
+            with torch.no_grad():
+                model(batch['input'])
+
+        model.train()
+        results[mode] = OrderedDict()
+        results[mode]['train'] = time_steps(step, config['steps'], config['warmup'], device)
+        model.eval()
+        results[mode]['inference'] = time_steps(inference, config['steps'], config['warmup'], device)
+        for stage in ['train', 'inference']:
+            results[mode][stage]['images_per_sec'] = \
+                config['batch_size'] * 1000 / results[mode][stage]['mean_ms']
+        results[mode]['forward_copies'] = count_activation_copies(inference, config['batch_size'])
+
+    return results
+
+
+
+def bench_optimizer(config):
+    """RAdam and PlainRAdam step time on the model parameters, per-parameter
+    loop vs foreach, and the largest parameter difference between the two
+    after the timed steps."""
+    heads = get_heads()
+    device = config['device']
+    model, _, _ = build(config, heads, device)
+    params = [p for p in model.parameters() if p.requires_grad]
+    torch.manual_seed(config['seed'])
+    grads = [torch.randn_like(p) * 1e-2 for p in params]
+
+    results = OrderedDict()
+    results['num_params'] = len(params)
+    for optimizer_cls in [RAdam, PlainRAdam]:
+        result = OrderedDict()
+        weights = OrderedDict()
+        for foreach in [False, True]:
+            weight = [p.detach().clone().requires_grad_() for p in params]
+            for w, g in zip(weight, grads):
+                w.grad = g
+            optimizer = optimizer_cls(weight, lr=1e-3, weight_decay=1e-4, foreach=foreach)
+            mode = 'foreach' if foreach else 'single'
+            result[mode] = time_steps(optimizer.step, config['steps'], config['warmup'], device)
+            weights[mode] = weight
+        result['speedup'] = result['single']['mean_ms'] / result['foreach']['mean_ms']
+        result['max_abs_diff'] = max((a - b).abs().max().item()
+                                     for a, b in zip(weights['single'], weights['foreach']))
+        results[optimizer_cls.__name__] = result
+
+    return results
+
+
+
+def make_train_data(config, tmp_dir):
+    """Image paths, mask paths and labels of --num_images training images:
+    the first rows of inputs/train.csv with --data real, otherwise random
+    JPEGs of the competition image size with random cars."""
+    if config['data'] == 'real':
+        df = pd.read_csv('inputs/train.csv')[:config['num_images']]
+        img_paths = ['inputs/train_images/' + img_id + '.jpg' for img_id in df['ImageId']]
+        mask_paths = ['inputs/train_masks/' + img_id + '.jpg' for img_id in df['ImageId']]
+        labels = [convert_str_to_labels(s) for s in df['PredictionString']]
+        return img_paths, mask_paths, labels
+
+    rng = np.random.RandomState(config['seed'])
+    img_paths, mask_paths, labels = [], [], []
+    for i in range(config['num_images']):
+        # smooth noise, so the JPEG is about as large as a photo
+        img = cv2.resize(rng.randint(0, 256, (68, 85, 3)).astype('uint8'), (3384, 2710))
+        img_paths.append(os.path.join(tmp_dir, '%d.jpg' % i))
+        cv2.imwrite(img_paths[-1], img)
+        mask_paths.append(os.path.join(tmp_dir, 'mask_%d.jpg' % i))
+        labels.append([{
+            'model_type': 0,
+            'pitch': rng.uniform(-np.pi, np.pi),
+            'yaw': rng.uniform(-0.2, 0.2),
+            'roll': np.pi + rng.uniform(-0.1, 0.1),
+            'x': rng.uniform(-15, 15),
+            'y': rng.uniform(4, 10),
+            'z': rng.uniform(8, 60),
+        } for _ in range(config['num_objs'])])
+    return img_paths, mask_paths, labels
+
+
+def get_train_transform():
+    """The Compose train.py builds with its default options."""
+    return Compose([
+        transforms.ShiftScaleRotate(shift_limit=0.1, scale_limit=0, rotate_limit=0,
+                                    border_mode=cv2.BORDER_CONSTANT, value=0, p=0.5),
+        OneOf([
+            transforms.HueSaturationValue(hue_shift_limit=20, sat_shift_limit=0, val_shift_limit=0, p=0.5),
+            transforms.RandomBrightness(limit=0.2, p=0.5),
+            transforms.RandomContrast(limit=0.2, p=0.5),
+        ], p=1),
+    ], keypoint_params=KeypointParams(format='xy', remove_invisible=False))
+
+
+def module_stages(model):
+    """(stage, module) pairs of ResNetFPN / DLAFPN: the children of the
+    backbone, the laterals, the decoders and each head."""
+    children = list(model.named_children())
+    stages = [('backbone', module) for _, module in children[0][1].named_children()]
+    for name, module in children[1:]:
+        if name.startswith('lateral'):
+            stages.append(('lateral', module))
+        elif name.startswith('decode'):
+            stages.append(('decode', module))
+        else:
+            stages.append(('head_' + name, module))
+    return stages
+
+
+def add_stage_hooks(model, times, device):
+    """Adds the forward time of each stage of every call to times[stage]."""
+    starts = {}
+
+    def pre_hook(module, args):
+        sync(device)
+        starts[module] = time.perf_counter()
+
+    def make_hook(stage):
+        def hook(module, args, output):
+            sync(device)
+            times[stage] += time.perf_counter() - starts.pop(module)
+        return hook
+
+    for stage, module in module_stages(model):
+        module.register_forward_pre_hook(pre_hook)
+        module.register_forward_hook(make_hook(stage))
+
+
+def timed(fn, device, *args, **kwargs):
+    sync(device)
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    sync(device)
+    return result, time.perf_counter() - start
+
+
+def bench_stages(config):
+    """Per-stage latency of a training iteration, one stage at a time:
+    JPEG decode, albumentations augmentation and Dataset target rendering
+    per image, collate and host-to-device copy per batch, then forward per
+    module, loss per head, backward and RAdam.step per batch. Inputs are
+    input_w x input_h (Dataset at twice the height with lhalf)."""
+    heads = get_heads()
+    device = config['device']
+    b = config['batch_size']
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        img_paths, mask_paths, labels = make_train_data(config, tmp_dir)
+        transform = get_train_transform()
+        dataset = Dataset(img_paths, mask_paths, labels,
+                          input_w=config['input_w'], input_h=config['input_h'] * 2,
+                          transform=transform, lhalf=True, hflip=0.5, scale=0.5, scale_limit=0.1)
+        np.random.seed(config['seed'])
+        num_samples = (config['warmup'] + config['steps']) * b
+        indices = [i % len(dataset) for i in range(num_samples)]
+
+        data_times = OrderedDict((stage, []) for stage in ['decode', 'augment', 'render'])
+        decoded = {}
+        for path in img_paths:
+            decoded[path], t = timed(cv2.imread, 'cpu', path)
+            data_times['decode'].append(t)
+        data_times['decode'] = [data_times['decode'][i] for i in indices]
+
+        for i in indices:
+            img = cv2.resize(decoded[img_paths[i]], (dataset.input_w, dataset.input_h))
+            mask = np.ones((dataset.output_h, dataset.output_w), dtype='float32')
+            kpts = np.random.uniform(0, 1, (len(labels[i]), 2)) * [dataset.input_w, dataset.input_h]
+            _, t = timed(transform, 'cpu', image=img, mask=mask, keypoints=kpts)
+            data_times['augment'].append(t)
+
+        # Dataset without decoding and augmentation: resize, flip/scale and target maps
+        imread = cv2.imread
+        dataset.transform = None
+        with mock.patch.object(cv2, 'imread', lambda path, *args: decoded[path] if path in decoded
+                               else imread(path, *args)):
+            for i in indices:
+                _, t = timed(dataset.__getitem__, 'cpu', i)
+                data_times['render'].append(t)
+        dataset.transform = transform
+
+        batch_times = OrderedDict((stage, []) for stage in ['collate', 'h2d'])
+        batches = []
+        for step in range(config['warmup'] + config['steps']):
+            samples = [dataset[i] for i in indices[step * b:(step + 1) * b]]
+            batch, t = timed(torch.utils.data.default_collate, 'cpu', samples)
+            batch_times['collate'].append(t)
+            if str(device).startswith('cuda'):
+                batch = {k: v.pin_memory() if torch.is_tensor(v) else v for k, v in batch.items()}
+            batch, t = timed(lambda: {k: v.to(device, non_blocking=True) if torch.is_tensor(v) else v
+                                      for k, v in batch.items()}, device)
+            batch_times['h2d'].append(t)
+            batches.append(batch)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    torch.manual_seed(config['seed'])
+    model, criterion, optimizer = build(config, heads, device)
+    model.train()
+    forward_times = defaultdict(float)
+    add_stage_hooks(model, forward_times, device)
+
+    model_times = defaultdict(list)
+    for step, batch in enumerate(batches):
+        forward_times.clear()
+        optimizer.zero_grad()
+        output, forward = timed(model, device, batch['input'])
+
+        loss = 0
+        loss_times = OrderedDict()
+        for head in heads.keys():
+            if head == 'hm':
+                head_loss, loss_times['loss_' + head] = timed(
+                    criterion[head], device, output[head], batch[head], batch['mask'])
+            else:
+                head_loss, loss_times['loss_' + head] = timed(
+                    criterion[head], device, output[head], batch[head], batch['reg_mask'],
+                    ind=batch['ind'], ind_mask=batch['ind_mask'])
+            loss += 0.05 * head_loss if head in ['wh', 'tvec'] else head_loss
+
+        _, backward = timed(loss.backward, device)
+        _, optimizer_step = timed(optimizer.step, device)
+
+        if step < config['warmup']:
+            continue
+        for stage, t in forward_times.items():
+            model_times['forward_' + stage].append(t)
+        # upsampling and additions between the modules
+        model_times['forward_other'].append(forward - sum(forward_times.values()))
+        for stage, t in loss_times.items():
+            model_times[stage].append(t)
+        model_times['backward'].append(backward)
+        model_times['optimizer_step'].append(optimizer_step)
+
+    results = OrderedDict()
+    results['data'] = OrderedDict((stage, summarize(times, images=1)) for stage, times in data_times.items())
+    for stage, times in batch_times.items():
+        results['data'][stage] = summarize(times[config['warmup']:], images=b)
+    results['model'] = OrderedDict((stage, summarize(times, images=b)) for stage, times in model_times.items())
+
+    # one process running the stages back to back, per batch
+    data_ms = (sum(results['data'][stage]['mean_ms'] for stage in data_times) * b
+               + sum(results['data'][stage]['mean_ms'] for stage in batch_times))
+    model_ms = sum(r['mean_ms'] for r in results['model'].values())
+    results['images_per_sec'] = OrderedDict([
+        ('data', b * 1000 / data_ms),
+        ('model', b * 1000 / model_ms),
+        ('total', b * 1000 / (data_ms + model_ms)),
+    ])
+    return results
+
+
+def bench_augment(config):
+    """Per-sample Dataset augmentation against BatchAugment on the same
+    flip/scale/shift parameters: the largest difference of every target
+    (the label transforms and encoding must match), the mean image
+    difference (interpolation and borders differ slightly) and the time
+    per batch of each path on decoded images."""
+    b = config['batch_size']
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        img_paths, mask_paths, labels = make_train_data(config, tmp_dir)
+        decoded = {path: cv2.imread(path) for path in img_paths}
+    finally:
+        shutil.rmtree(tmp_dir)
+    imread = cv2.imread
+    kwargs = dict(input_w=config['input_w'], input_h=config['input_h'], scale_limit=0.1)
+
+    rng = np.random.RandomState(config['seed'])
+    n = len(img_paths)
+    params = {
+        'flip': np.arange(n) % 2 == 1,
+        'scale': np.where(np.arange(n) % 3 > 0, rng.uniform(0.9, 1.1, n), 1.0),
+        'shift': np.repeat(rng.uniform(-0.1, 0.1, (n, 1)), 2, 1),
+        'color': np.full(n, -1),
+        'color_args': np.zeros((n, 3)),
+    }
+
+    def per_sample(i):
+        # fixed parameters through the random draws of Dataset and ShiftScaleRotate
+        transform = Compose([
+            transforms.ShiftScaleRotate(shift_limit=(params['shift'][i, 0],) * 2, scale_limit=0,
+                                        rotate_limit=0, border_mode=cv2.BORDER_CONSTANT, value=0, p=1),
+        ], keypoint_params=KeypointParams(format='xy', remove_invisible=False))
+        dataset = Dataset(img_paths, mask_paths, labels, transform=transform,
+                          hflip=float(params['flip'][i]), scale=float(params['scale'][i] != 1), **kwargs)
+        with mock.patch.object(np.random, 'uniform', return_value=params['scale'][i] - 1):
+            return dataset[i]
+
+    batch_set = Dataset(img_paths, mask_paths, labels, batch_aug=True, **kwargs)
+    augment = BatchAugment(batch_set)
+
+    results = OrderedDict()
+    diffs = defaultdict(float)
+    image_diffs = []
+    times = OrderedDict([('per_sample', []), ('batched', [])])
+    with mock.patch.object(cv2, 'imread', lambda path, *args: decoded[path] if path in decoded
+                           else imread(path, *args)):
+        for start in range(0, n, b):
+            idx = list(range(start, min(start + b, n)))
+            t = time.perf_counter()
+            expected = torch.utils.data.default_collate([per_sample(i) for i in idx])
+            times['per_sample'].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            batch = torch.utils.data.default_collate([batch_set[i] for i in idx])
+            batch = augment(batch, {k: v[idx] for k, v in params.items()})
+            times['batched'].append(time.perf_counter() - t)
+
+            for key, val in batch.items():
+                if key in ['img_path', 'input', 'mask']:
+                    continue
+                diffs[key] = max(diffs[key], float((val.double() - expected[key].double()).abs().max()))
+            image_diffs.append(float((batch['input'] - expected['input']).abs().mean()))
+
+    results['max_abs_diff'] = OrderedDict(diffs)
+    results['input_mean_abs_diff'] = float(np.mean(image_diffs))
+    for mode, mode_times in times.items():
+        results[mode] = summarize(mode_times, images=b)
+    return results
+
+
+def main():
+    config = vars(parse_args())
+    config['num_filters'] = [int(n) for n in config['num_filters'].split(',')]
+
+    torch.manual_seed(config['seed'])
+    results = {
+        'target': config['target'],
+        'arch': config['arch'],
+        'device': config['device'],
+        'input_size': [config['input_w'], config['input_h']],
+        'batch_size': config['batch_size'],
+        'results': globals()['bench_' + config['target']](config),
+    }
+
+    print(json.dumps(results, indent=2))
+    if config['output'] is not None:
+        with open(config['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
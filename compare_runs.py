@@ -0,0 +1,80 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--names', required=True,
+                        help='comma separated model names, the first one is the baseline')
+    parser.add_argument('--fold', default=1, type=int)
+    parser.add_argument('--target_loss', default=None, type=float,
+                        help='val_loss target (default: the highest best val_loss of the runs)')
+    parser.add_argument('--target_map', default=None, type=float,
+                        help='val_map target (default: the lowest best val_map of the runs)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def time_to_target(log, column, target, higher_is_better=False):
+    """Cumulative training time of the first epoch reaching target."""
+    vals = log[column].values
+    reached = vals >= target if higher_is_better else vals <= target
+    if not reached.any():
+        return np.nan
+    return log['time'].values[np.argmax(reached)]
+
+
+def main():
+    config = vars(parse_args())
+
+    logs = {}
+    for name in config['names'].split(','):
+        path = 'models/detection/%s/log_%d.csv' % (name, config['fold'])
+        if not os.path.exists(path):
+            print('%s not found' % path)
+            continue
+        log = pd.read_csv(path)
+        if 'time' not in log.columns:
+            print('%s has no time column, skipped' % path)
+            continue
+        logs[name] = log
+    if not logs:
+        return
+
+    target_loss = config['target_loss']
+    if target_loss is None:
+        target_loss = max(log['val_loss'].min() for log in logs.values())
+    target_map = config['target_map']
+    if target_map is None and all(log['val_map'].notnull().any() for log in logs.values()):
+        target_map = min(log['val_map'].max() for log in logs.values())
+
+    results = []
+    for name, log in logs.items():
+        result = {
+            'name': name,
+            'epochs': len(log),
+            'time': log['time'].values[-1],
+            'best_loss': log['val_loss'].min(),
+            'best_map': log['val_map'].max(),
+            'time_to_loss': time_to_target(log, 'val_loss', target_loss),
+        }
+        if target_map is not None:
+            result['time_to_map'] = time_to_target(log, 'val_map', target_map, higher_is_better=True)
+        results.append(result)
+    results = pd.DataFrame(results)
+    results['speedup'] = results['time_to_loss'].values[0] / results['time_to_loss']
+
+    print('target val_loss: %.4f' % target_loss)
+    if target_map is not None:
+        print('target val_map:  %.4f' % target_map)
+    print(results.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
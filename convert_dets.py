@@ -0,0 +1,33 @@
+import os
+import argparse
+
+from lib.utils.det_store import json_to_det_store, det_store_to_json
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src',
+                        help='outputs/decoded/{val,test}/<name>.json or a detection store directory')
+    parser.add_argument('dst', default=None, nargs='?')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    src = args.src.rstrip('/')
+    if os.path.isdir(src):
+        dst = args.dst if args.dst is not None else src + '.json'
+        det_store_to_json(src, dst)
+    else:
+        dst = args.dst if args.dst is not None else os.path.splitext(src)[0]
+        json_to_det_store(src, dst)
+    print('%s -> %s' %(src, dst))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 import re
 
 import numpy as np
@@ -40,6 +39,7 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.utils.det_store import save_dets, get_columns
 
 
 def parse_args():
@@ -149,7 +149,7 @@ def main():
         )
         det = det.numpy()[0]
 
-        dets[img_id] = det.tolist()
+        dets[img_id] = det
 
         if config['nms']:
             det = nms(det, dist_th=config['nms_th'])
@@ -167,8 +167,8 @@ def main():
 
         df.loc[i, 'PredictionString'] = convert_labels_to_str(det[:, :7])
 
-    with open('outputs/decoded/test/%s.json' %config['name'], 'w') as f:
-        json.dump(dets, f)
+    save_dets('outputs/decoded/test/%s' %config['name'], dets,
+              columns=get_columns(wh=model_config['wh']))
 
     df.to_csv('outputs/submissions/test/%s.csv' %config['name'], index=False)
 
@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -39,6 +38,7 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.utils.det_store import save_dets, get_columns
 
 
 def parse_args():
@@ -146,7 +146,7 @@ def main():
             )
             det = det.numpy()[0]
 
-            dets[img_id] = det.tolist()
+            dets[img_id] = det
 
             if config['nms']:
                 det = nms(det, dist_th=config['nms_th'])
@@ -164,8 +164,8 @@ def main():
 
             df.loc[df.ImageId == img_id, 'PredictionString'] = convert_labels_to_str(det[:, :7])
 
-    with open('outputs/decoded/val/%s.json' %config['name'], 'w') as f:
-        json.dump(dets, f)
+    save_dets('outputs/decoded/val/%s' %config['name'], dets,
+              columns=get_columns(wh=model_config['wh']))
 
     df.to_csv('outputs/submissions/val/%s.csv' %config['name'], index=False)
 
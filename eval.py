@@ -4,9 +4,12 @@ from math import sqrt, acos, pi, sin, cos
 from scipy.spatial.transform import Rotation as R
 from sklearn.metrics import average_precision_score
 from tqdm import tqdm
+import joblib
 from joblib import Parallel, delayed
 import argparse
 
+from lib.evaluation import match_image, THRES_RO_LIST, THRES_TR_LIST
+
 
 def expand_df(df, PredictionStringCols):
     df = (df.copy()).dropna()
@@ -73,39 +76,44 @@ def RotationDistance(p, g):
     return W
 
 
-def check_match(val_df, train_df, thre_tr_dist, thre_ro_dist, keep_gt=False):
-    train_dict = {imgID: str2coords(s, names=['carid_or_score', 'pitch', 'yaw', 'roll', 'x', 'y', 'z'])
-                  for imgID, s in zip(train_df['ImageId'], train_df['PredictionString'])}
-    val_dict = {imgID: str2coords(s, names=['pitch', 'yaw', 'roll', 'x', 'y', 'z', 'carid_or_score'])
-                  for imgID, s in zip(val_df['ImageId'], val_df['PredictionString'])}
+def str2array(s):
+    return np.array(s.split(), dtype=np.float64).reshape([-1, 7])
+
+
+def match_images(pairs, thre_tr_dist, thre_ro_dist, keep_gt=False):
+    return [match_image(pred, gt, thre_tr_dist, thre_ro_dist, keep_gt=keep_gt)
+            for pred, gt in pairs]
+
+
+def check_match(val_df, train_df, thre_tr_dist, thre_ro_dist, keep_gt=False, n_jobs=1):
+    train_dict = {imgID: str2array(s) for imgID, s in zip(train_df['ImageId'], train_df['PredictionString'])}
+    val_dict = {imgID: str2array(s) for imgID, s in zip(val_df['ImageId'], val_df['PredictionString'])}
+    pairs = [(val_dict[img_id], train_dict[img_id]) for img_id in val_dict]
+
+    if n_jobs == 1:
+        results = [match_image(pred, gt, thre_tr_dist, thre_ro_dist, keep_gt=keep_gt)
+                   for pred, gt in tqdm(pairs, total=len(pairs))]
+    else:
+        # images are matched independently, so shard them across workers and
+        # concatenate the shards back in the original image order.
+        n_workers = joblib.effective_n_jobs(n_jobs)
+        n_shards = min(len(pairs), n_workers * 4)
+        bounds = np.linspace(0, len(pairs), n_shards + 1).astype(int)
+        shards = Parallel(n_jobs=n_jobs)(
+            delayed(match_images)(pairs[s:e], thre_tr_dist, thre_ro_dist, keep_gt)
+            for s, e in zip(bounds[:-1], bounds[1:]))
+        results = [r for shard in shards for r in shard]
+
     result_flg = []  # 1 for TP, 0 for FP
     scores = []
-    MAX_VAL = 10**10
-    for img_id in tqdm(val_dict, total=len(val_dict)):
-        for pcar in sorted(val_dict[img_id], key=lambda x: -x['carid_or_score']):
-            # find nearest GT
-            min_tr_dist = MAX_VAL
-            min_idx = -1
-            for idx, gcar in enumerate(train_dict[img_id]):
-                tr_dist = TranslationDistance(pcar, gcar)
-                if tr_dist < min_tr_dist:
-                    min_tr_dist = tr_dist
-                    min_ro_dist = RotationDistance(pcar, gcar)
-                    min_idx = idx
-
-            # set the result
-            if min_tr_dist < thre_tr_dist and min_ro_dist < thre_ro_dist:
-                if not keep_gt:
-                    train_dict[img_id].pop(min_idx)
-                result_flg.append(1)
-            else:
-                result_flg.append(0)
-            scores.append(pcar['carid_or_score'])
+    for flg, score in results:
+        result_flg.extend(flg)
+        scores.extend(score)
 
     return result_flg, scores
 
 
-def mean_average_precision(infile, nrows=None):
+def mean_average_precision(infile, nrows=None, n_jobs=1):
     val_df = pd.read_csv(infile, nrows=nrows)
     val_df = val_df.dropna()
     expanded_val_df = expand_df(
@@ -123,13 +131,11 @@ def mean_average_precision(infile, nrows=None):
         train_df, ['model_type', 'pitch', 'yaw', 'roll', 'x', 'y', 'z'])
     n_gt = len(expanded_train_df)
 
-    thres_ro_list = [50, 45, 40, 35, 30, 25, 20, 15, 10, 5]
-    thres_tr_list = [0.1, 0.09, 0.08, 0.07, 0.06, 0.05, 0.04, 0.03, 0.02, 0.01]
     ap_list = []
-    for thre_ro_dist, thre_tr_dist in zip(thres_ro_list, thres_tr_list):
+    for thre_ro_dist, thre_tr_dist in zip(THRES_RO_LIST, THRES_TR_LIST):
         abs_dist = False
         result_flg, scores = check_match(
-            val_df, train_df, thre_tr_dist, thre_ro_dist)
+            val_df, train_df, thre_tr_dist, thre_ro_dist, n_jobs=n_jobs)
         n_tp = np.sum(result_flg)
         recall = n_tp / n_gt
         ap = average_precision_score(result_flg, scores) * recall
@@ -141,6 +147,8 @@ def parse_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--name', default=None)
+    parser.add_argument('--n_jobs', default=1, type=int,
+                        help='number of matching workers (-1: all cores)')
 
     args = parser.parse_args()
 
@@ -150,7 +158,8 @@ def parse_args():
 def main():
     args = parse_args()
 
-    map = mean_average_precision('outputs/submissions/val/%s.csv' %args.name, nrows=None)
+    map = mean_average_precision('outputs/submissions/val/%s.csv' %args.name, nrows=None,
+                                 n_jobs=args.n_jobs)
     print('map:', map)
 
 
@@ -0,0 +1,47 @@
+import copy
+import contextlib
+
+import torch
+import torch.nn as nn
+
+from .utils.utils import reset_peak_memory, peak_memory_mb
+
+
+def micro_batches(batch_size, micro_batch_size=0):
+    """Slices splitting a batch into micro-batches of at most
+    micro_batch_size samples (0: the whole batch)."""
+    if micro_batch_size <= 0 or micro_batch_size >= batch_size:
+        return [slice(None)]
+    return [slice(start, start + micro_batch_size) for start in range(0, batch_size, micro_batch_size)]
+
+
+def no_sync(model, enabled):
+    """DistributedDataParallel.no_sync() when enabled, so gradients are only
+    all-reduced after the last micro-batch."""
+    if enabled and isinstance(model, nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def estimate_micro_batch_size(model, probe_fn, batch_size, budget_mb, device='cuda'):
+    """Largest micro-batch size whose training step fits in budget_mb.
+
+    probe_fn(model, n) runs forward and backward on n samples. The peak
+    memory of n=1 and n=2 gives the per-sample cost, which is extrapolated
+    linearly. The model's parameters and buffers are restored afterwards.
+    On CPU the peak is the process max RSS, so the estimate is rough.
+    """
+    state = copy.deepcopy(model.state_dict())
+    peaks = []
+    for n in [1, 2]:
+        reset_peak_memory(device)
+        probe_fn(model, n)
+        model.zero_grad(set_to_none=True)
+        peaks.append(peak_memory_mb(device))
+    model.load_state_dict(state)
+
+    per_sample = peaks[1] - peaks[0]
+    if per_sample <= 0:
+        return batch_size
+    base = peaks[0] - per_sample
+    return int(min(max((budget_mb - base) // per_sample, 1), batch_size))
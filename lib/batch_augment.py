@@ -0,0 +1,226 @@
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from .utils.utils import convert_3d_to_2d
+
+
+def _warp(x, scale, shift, mode='bilinear', padding_mode='zeros'):
+    """x (N, C, H, W) scaled about the image center and shifted by shift
+    (N, 2) times the image size, as albumentations' shift_scale_rotate
+    with angle=0 (cv2.warpAffine with getRotationMatrix2D) does."""
+    n, _, h, w = x.shape
+    theta = x.new_zeros((n, 2, 3))
+    theta[:, 0, 0] = 1 / scale
+    theta[:, 1, 1] = 1 / scale
+    # cv2 scales about (w / 2, h / 2) in pixel-center coordinates
+    theta[:, 0, 2] = 1 / w - (1 + 2 * shift[:, 0] * w) / (scale * w)
+    theta[:, 1, 2] = 1 / h - (1 + 2 * shift[:, 1] * h) / (scale * h)
+    grid = F.affine_grid(theta, x.shape, align_corners=False)
+    return F.grid_sample(x, grid, mode=mode, padding_mode=padding_mode, align_corners=False)
+
+
+def _shift_hsv(img, hue, sat, val):
+    """HueSaturationValue on (N, 3, H, W) images in [0, 255]: hue is shifted
+    in OpenCV's uint8 units (degrees / 2), sat and val in [0, 255]. The
+    channels are taken as RGB, as albumentations does."""
+    r, g, b = img[:, 0], img[:, 1], img[:, 2]
+    v, argmax = img.max(1)
+    c = v - img.min(1)[0]
+    s = torch.where(v > 0, c / v.clamp(min=1e-6), torch.zeros_like(v))
+    safe_c = c.clamp(min=1e-6)
+    h = torch.where(argmax == 0, ((g - b) / safe_c) % 6,
+                    torch.where(argmax == 1, (b - r) / safe_c + 2, (r - g) / safe_c + 4))
+    h = torch.where(c > 0, h, torch.zeros_like(h))
+
+    h = (h + hue[:, None, None] / 30) % 6
+    s = (s * 255 + sat[:, None, None]).clamp(0, 255) / 255
+    v = (v + val[:, None, None]).clamp(0, 255)
+
+    out = []
+    for n in [5, 3, 1]:
+        k = (n + h) % 6
+        out.append(v - v * s * torch.min(torch.min(k, 4 - k), torch.ones_like(k)).clamp(min=0))
+    return torch.stack(out, 1)
+
+
+class BatchAugment(object):
+    """Augments collated batches of a Dataset built with batch_aug=True and
+    encodes their targets, so the DataLoader workers only decode.
+
+    The hflip and scale augmentation of Dataset, the ShiftScaleRotate shift
+    and the OneOf color jitter of train.py run on the whole uint8 batch with
+    torch ops; the keypoints and poses are transformed as in
+    Dataset.__getitem__ and the targets are rendered with Dataset.encode().
+
+    color is a list of (name, p, limits) chosen as albumentations' OneOf
+    does, with name 'hsv' (limits: hue, sat, val), 'brightness',
+    'contrast' or None (NoOp). The parameters of a sample are drawn from
+    its 'seed' (SeededDataset with return_seed), so they only depend on the
+    sample seed as with the per-sample path.
+    """
+    def __init__(self, dataset, hflip=0, scale=0, scale_limit=0, shift=0, shift_limit=0, color=None):
+        self.dataset = dataset
+        self.hflip = hflip
+        self.scale = scale
+        self.scale_limit = scale_limit
+        self.shift = shift
+        self.shift_limit = shift_limit
+        self.color = color or []
+        self.mean = torch.tensor(dataset.mean.ravel()).view(1, 3, 1, 1)
+        self.std = torch.tensor(dataset.std.ravel()).view(1, 3, 1, 1)
+
+    def sample_params(self, seeds):
+        params = {
+            'flip': np.zeros(len(seeds), dtype=bool),
+            'scale': np.ones(len(seeds)),
+            'shift': np.zeros((len(seeds), 2)),
+            'color': np.full(len(seeds), -1),
+            'color_args': np.zeros((len(seeds), 3)),
+        }
+        if self.color:
+            ps = np.array([p for _, p, _ in self.color], dtype='float64')
+            ps /= ps.sum()
+        for i, seed in enumerate(seeds):
+            # kept apart from the stream the worker seeded with the same seed
+            rng = np.random.RandomState([int(seed), 1])
+            params['flip'][i] = rng.random_sample() < self.hflip
+            if rng.random_sample() < self.scale:
+                params['scale'][i] = rng.uniform(-self.scale_limit, self.scale_limit) + 1.0
+            if rng.random_sample() < self.shift:
+                params['shift'][i] = rng.uniform(-self.shift_limit, self.shift_limit, 2)
+            if self.color:
+                c = rng.choice(len(self.color), p=ps)
+                name, _, limits = self.color[c]
+                params['color'][i] = c
+                if name == 'hsv':
+                    params['color_args'][i] = [rng.uniform(-limit, limit) for limit in limits]
+                elif name in ['brightness', 'contrast']:
+                    params['color_args'][i, 0] = rng.uniform(-limits, limits)
+        return params
+
+    def transform_labels(self, anns, params, input_w, input_h, height, width):
+        """Annotations (num_objs, 6: x, y, z, yaw, pitch, roll) of one
+        sample as the labels Dataset.encode() takes."""
+        kpts = anns[:, :3].copy()
+        kpts_3d = anns[:, :3].copy()
+        poses = anns[:, 3:6].copy()
+        if params['flip']:
+            kpts[:, 0] *= -1
+            kpts_3d[:, 0] *= -1
+            poses[:, [0, 2]] *= -1
+        kpts[:, 2] /= params['scale']
+
+        kpts = np.array(convert_3d_to_2d(kpts[:, 0], kpts[:, 1], kpts[:, 2])).T
+        kpts[:, 0] *= input_w / width
+        kpts[:, 1] *= input_h / height
+        kpts[:, 0] += params['shift'][0] * input_w
+        kpts[:, 1] += params['shift'][1] * input_h
+
+        label = []
+        for (x, y), (yaw, pitch, roll), (x_3d, y_3d, z_3d), z in zip(kpts, poses, kpts_3d, anns[:, 2]):
+            label.append({
+                'x': x, 'y': y, 'z': z,
+                'yaw': yaw, 'pitch': pitch, 'roll': roll,
+                'x_3d': x_3d, 'y_3d': y_3d, 'z_3d': z_3d,
+            })
+        return label
+
+    def augment_images(self, img, mask, params):
+        """(N, H, W, 3) uint8 images and (N, h, w) masks -> float images in
+        [0, 255] (N, 3, H, W) and masks (N, 1, h, w)."""
+        img = img.permute(0, 3, 1, 2).float()
+        mask = mask[:, None].float()
+
+        flip = torch.from_numpy(params['flip'])
+        if flip.any():
+            img[flip] = img[flip].flip(3)
+            mask[flip] = mask[flip].flip(3)
+
+        scale = torch.from_numpy(params['scale']).float()
+        idx = torch.nonzero(scale != 1)[:, 0]
+        if len(idx):
+            zeros = torch.zeros((len(idx), 2))
+            # reflected borders as Dataset's BORDER_REFLECT_101 (up to the edge pixel)
+            img[idx] = _warp(img[idx], scale[idx], zeros, padding_mode='reflection')
+            mask[idx] = _warp(mask[idx], scale[idx], zeros, padding_mode='reflection')
+
+        shift = torch.from_numpy(params['shift']).float()
+        idx = torch.nonzero(shift.abs().sum(1) > 0)[:, 0]
+        if len(idx):
+            ones = torch.ones(len(idx))
+            img[idx] = _warp(img[idx], ones, shift[idx])
+            mask[idx] = _warp(mask[idx], ones, shift[idx], mode='nearest')
+
+        args = torch.from_numpy(params['color_args']).float()
+        for c, (name, _, _) in enumerate(self.color):
+            idx = torch.nonzero(torch.from_numpy(params['color'] == c))[:, 0]
+            if not len(idx) or name is None:
+                continue
+            if name == 'hsv':
+                img[idx] = _shift_hsv(img[idx], args[idx, 0], args[idx, 1], args[idx, 2])
+            elif name == 'brightness':
+                img[idx] = img[idx] + args[idx, 0].view(-1, 1, 1, 1) * 255
+            elif name == 'contrast':
+                img[idx] = img[idx] * (1 + args[idx, 0].view(-1, 1, 1, 1))
+        img = img.clamp(0, 255)
+
+        return img, mask
+
+    def __call__(self, batch, params=None):
+        n, input_h, input_w = batch['input'].shape[:3]
+        dataset = self.dataset
+        if (dataset.input_w, dataset.input_h) != (input_w, input_h):
+            dataset.set_input_size(input_w, input_h)
+
+        if params is None:
+            seeds = batch['seed'].tolist() if 'seed' in batch else np.random.randint(0, 2**31, n)
+            params = self.sample_params(seeds)
+
+        img, mask = self.augment_images(batch['input'], batch['mask'], params)
+        img = (img / 255 - self.mean) / self.std
+
+        anns = batch['anns'].numpy()
+        sizes = batch['size'].tolist()
+        targets = []
+        for i in range(n):
+            sample = {k: v[i] for k, v in params.items()}
+            valid = anns[i, :, 6] > 0
+            label = self.transform_labels(anns[i, valid, :6], sample, input_w, input_h, *sizes[i])
+            targets.append(dataset.encode(label, sizes[i][1], sizes[i][0]))
+
+        if dataset.lhalf:
+            img = img[:, :, input_h // 2:]
+            mask = mask[:, :, dataset.output_h // 2:]
+
+        ret = {
+            'img_path': batch['img_path'],
+            'input': img.contiguous(),
+            'mask': mask.contiguous(),
+        }
+        for key in targets[0].keys():
+            ret[key] = torch.from_numpy(np.stack([t[key] for t in targets]))
+        if 'seed' in batch:
+            ret['seed'] = batch['seed']
+        return ret
+
+
+class BatchAugmentLoader(object):
+    """Applies a BatchAugment to the batches of a DataLoader. Wrapped in a
+    DevicePrefetcher the augmentation runs in its background thread."""
+    def __init__(self, loader, augment, pin_memory=False):
+        self.loader = loader
+        self.augment = augment
+        self.pin_memory = pin_memory
+        self.sampler = getattr(loader, 'sampler', None)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            batch = self.augment(batch)
+            if self.pin_memory:
+                batch = {k: v.pin_memory() if torch.is_tensor(v) else v for k, v in batch.items()}
+            yield batch
@@ -0,0 +1,181 @@
+import os
+import glob
+import time
+import queue
+import random
+import threading
+
+import numpy as np
+
+import torch
+
+
+def to_cpu(obj):
+    """Copy of obj with every tensor copied to CPU memory, so training can
+    keep updating the originals while the copy is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = obj.__class__((k, to_cpu(v)) for k, v in obj.items())
+        # state_dict versions, read by load_state_dict
+        if hasattr(obj, '_metadata'):
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """RNG states of Python, NumPy, torch and every CUDA device."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file next to path, then rename, so path is
+    never left half written."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_to_csv(df, path):
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """Writes checkpoints in a background thread.
+
+    save() copies the state to CPU and returns; the copy is written to
+    `path` with an atomic rename. With keep_last > 1 every checkpoint is
+    also kept as history_fmt % epoch (<path stem>.epoch%d<ext> by default;
+    path is a hard link to the newest one) and only the newest keep_last of
+    them are kept. The time
+    the caller spent in each save (CPU copy and waiting for the previous
+    write) is returned as the stall time.
+    """
+    def __init__(self, path, keep_last=1, history_fmt=None, async_save=True):
+        self.path = path
+        self.keep_last = keep_last
+        self.async_save = async_save
+        self.error = None
+        self.total_stall_s = 0.
+        if history_fmt is None:
+            dirname, basename = os.path.split(path)
+            name, dot, ext = basename.partition('.')
+            history_fmt = os.path.join(dirname, name + '.epoch%d' + dot + ext)
+        self.history_prefix, self.history_suffix = history_fmt.split('%d')
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        if async_save:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                job[0](*job[1:])
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _submit(self, *job):
+        if self.error is not None:
+            raise self.error
+        if self.async_save:
+            self.queue.put(job)
+        else:
+            job[0](*job[1:])
+
+    def _history_path(self, epoch):
+        return '%s%d%s' % (self.history_prefix, epoch, self.history_suffix)
+
+    def history(self):
+        """[(epoch, path)] of the kept checkpoints, oldest first."""
+        history = []
+        for path in glob.glob(glob.escape(self.history_prefix) + '*' + glob.escape(self.history_suffix)):
+            epoch = path[len(self.history_prefix):len(path) - len(self.history_suffix)]
+            if epoch.isdigit():
+                history.append((int(epoch), path))
+        return sorted(history)
+
+    def _write_checkpoint(self, state, epoch):
+        if self.keep_last <= 1 or epoch is None:
+            atomic_save(state, self.path)
+            return
+
+        history_path = self._history_path(epoch)
+        atomic_save(state, history_path)
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(history_path, tmp_path)
+        except OSError:
+            atomic_save(state, self.path)
+        else:
+            os.replace(tmp_path, self.path)
+
+        for _, path in self.history()[:-self.keep_last]:
+            os.remove(path)
+
+    def save(self, state, epoch=None):
+        """Snapshots state and writes it as the checkpoint of the epoch
+        (epoch=None: only to path, e.g. for checkpoints in the middle of an
+        epoch). Returns the stall time in seconds."""
+        start = time.perf_counter()
+        self._submit(self._write_checkpoint, to_cpu(state), epoch)
+        return self._stall(start)
+
+    def save_best(self, state_dict, path):
+        start = time.perf_counter()
+        self._submit(atomic_save, to_cpu(state_dict), path)
+        return self._stall(start)
+
+    def save_log(self, log, path):
+        """Writes a pandas DataFrame as csv."""
+        start = time.perf_counter()
+        self._submit(atomic_to_csv, log.copy(), path)
+        return self._stall(start)
+
+    def _stall(self, start):
+        stall = time.perf_counter() - start
+        self.total_stall_s += stall
+        return stall
+
+    def wait(self):
+        """Blocks until every submitted write is on disk."""
+        if self.async_save:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
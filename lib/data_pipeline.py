@@ -0,0 +1,284 @@
+import math
+import time
+import random
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+
+def worker_init_fn(worker_id):
+    """Seeds NumPy and random from the per-worker torch seed.
+
+    DataLoader workers are forked with the parent's NumPy state, so without
+    this every worker draws the same hflip/scale/albumentations decisions.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def sample_seed(seed, epoch, index):
+    return (((seed * 1000003) ^ epoch) * 1000003 ^ index) % 2**32
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler (also usable with a single process) that can start
+    an epoch in the middle.
+
+    state_dict(position) records the permutation of the epoch and how many
+    of this process's indices were consumed; after load_state_dict() the
+    next pass starts from there, so consumed samples are not loaded again.
+    With sample_seeds each index is yielded as (index, seed) for
+    SeededDataset, the seed depending only on seed, epoch and index, or as
+    (index, seed, input_size) after set_input_size(). With num_variants > 0
+    each index only gets num_variants different seeds, one of them drawn
+    every epoch, so the augmentations of a sample repeat (e.g. for a
+    feature cache).
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0, sample_seeds=True,
+                 num_variants=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank,
+                                               shuffle=shuffle, seed=seed)
+        self.sample_seeds = sample_seeds
+        self.num_variants = num_variants
+        self.permutation = None
+        self.start = 0
+        self.input_size = None
+
+    def set_input_size(self, input_size):
+        """(input_w, input_h) the samples of the next pass are loaded at."""
+        self.input_size = input_size
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.permutation = None
+            self.start = 0
+        super(ResumableSampler, self).set_epoch(epoch)
+
+    def get_seed(self, index):
+        if self.num_variants > 0:
+            variant = sample_seed(self.seed, self.epoch, index) % self.num_variants
+            # negative epochs keep the variant seeds apart from the per-epoch ones
+            return sample_seed(self.seed, -1 - variant, index)
+        return sample_seed(self.seed, self.epoch, index)
+
+    def get_permutation(self):
+        if self.permutation is None:
+            if self.shuffle:
+                g = torch.Generator()
+                g.manual_seed(self.seed + self.epoch)
+                self.permutation = torch.randperm(len(self.dataset), generator=g).tolist()
+            else:
+                self.permutation = list(range(len(self.dataset)))
+        return self.permutation
+
+    def __iter__(self):
+        indices = list(self.get_permutation())
+        # pad to a multiple of num_replicas as DistributedSampler does
+        padding = self.total_size - len(indices)
+        if padding > 0:
+            indices += (indices * math.ceil(padding / len(indices)))[:padding]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+
+        start, self.start = self.start, 0
+        for index in indices[start:]:
+            if self.sample_seeds and self.input_size is not None:
+                yield index, self.get_seed(index), self.input_size
+            elif self.sample_seeds:
+                yield index, self.get_seed(index)
+            else:
+                yield index
+
+    def state_dict(self, position):
+        return {
+            'epoch': self.epoch,
+            'permutation': torch.tensor(self.get_permutation()),
+            'position': position,
+        }
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.permutation = state['permutation'].tolist()
+        self.start = state['position']
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    """Seeds random and NumPy from the (index, seed) key before loading the
+    sample, so its augmentation does not depend on which worker loads it
+    or on what that worker loaded before. An (index, seed, input_size) key
+    also sets the input size of the dataset, so persistent workers follow
+    a resolution schedule without restarting. With return_seed the seed is
+    added to dict samples as 'seed'."""
+    def __init__(self, dataset, return_seed=False):
+        self.dataset = dataset
+        self.return_seed = return_seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        index, seed = key[:2]
+        if len(key) > 2 and (self.dataset.input_w, self.dataset.input_h) != tuple(key[2]):
+            self.dataset.set_input_size(*key[2])
+        in_worker = torch.utils.data.get_worker_info() is not None
+        if not in_worker:
+            states = random.getstate(), np.random.get_state()
+        random.seed(seed)
+        np.random.seed(seed)
+        try:
+            sample = self.dataset[index]
+            if self.return_seed and isinstance(sample, dict):
+                sample['seed'] = seed
+            return sample
+        finally:
+            if not in_worker:
+                random.setstate(states[0])
+                np.random.set_state(states[1])
+
+
+def build_loader(dataset, batch_size, shuffle=False, sampler=None, num_workers=4,
+                 pin_memory=True, persistent_workers=True, prefetch_factor=2, drop_last=False):
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        num_workers=num_workers,
+        pin_memory=pin_memory and torch.cuda.is_available(),
+        drop_last=drop_last,
+        worker_init_fn=worker_init_fn,
+        **kwargs)
+
+
+def to_device(obj, device, non_blocking=False):
+    if torch.is_tensor(obj):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, dict):
+        return obj.__class__((k, to_device(v, device, non_blocking)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(to_device(v, device, non_blocking) for v in obj)
+    return obj
+
+
+def _record_stream(obj, stream):
+    if torch.is_tensor(obj):
+        obj.record_stream(stream)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _record_stream(v, stream)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher(object):
+    """Iterates a DataLoader in a background thread and copies up to `depth`
+    batches to the device ahead of the training loop. On CUDA the copies run
+    on a side stream, so they overlap with compute.
+
+    stats() reports, for the last pass:
+      queue_depth: mean number of ready batches when the loop asked for one
+      stall_s: time the loop waited for a batch
+      worker_wait_s: time the thread waited for the DataLoader workers
+      copy_s: time spent issuing host-to-device copies
+    """
+    _END = object()
+
+    def __init__(self, loader, device='cuda', depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.sampler = getattr(loader, 'sampler', None)
+        self._reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _reset_stats(self):
+        self.num_batches = 0
+        self.queue_depth_sum = 0
+        self.stall_s = 0.
+        self.worker_wait_s = 0.
+        self.copy_s = 0.
+
+    def stats(self):
+        return OrderedDict([
+            ('queue_depth', self.queue_depth_sum / max(self.num_batches, 1)),
+            ('stall_s', self.stall_s),
+            ('worker_wait_s', self.worker_wait_s),
+            ('copy_s', self.copy_s),
+        ])
+
+    def _produce(self, q, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            it = iter(self.loader)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    break
+                self.worker_wait_s += time.perf_counter() - start
+
+                start = time.perf_counter()
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = to_device(batch, self.device)
+                self.copy_s += time.perf_counter() - start
+
+                self._put(q, stop, (batch, event))
+        except Exception as e:
+            self._put(q, stop, (e, None))
+            return
+        self._put(q, stop, (self._END, None))
+
+    @staticmethod
+    def _put(q, stop, item):
+        # the loop may have left early and stopped reading the full queue
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        self._reset_stats()
+        q = queue.Queue(maxsize=max(self.depth, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.queue_depth_sum += q.qsize()
+                start = time.perf_counter()
+                batch, event = q.get()
+                self.stall_s += time.perf_counter() - start
+                if batch is self._END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    _record_stream(batch, stream)
+                self.num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
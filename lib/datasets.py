@@ -1,6 +1,7 @@
 import os
 import math
 import json
+from collections import OrderedDict
 
 import numpy as np
 import cv2
@@ -22,7 +23,8 @@ class Dataset(torch.utils.data.Dataset):
     def __init__(self, img_paths, mask_paths, labels, input_w=640, input_h=512,
                  down_ratio=4, transform=None, test=False, lhalf=False,
                  hflip=0, scale=0, scale_limit=0,
-                 test_img_paths=None, test_mask_paths=None, test_outputs=None):
+                 test_img_paths=None, test_mask_paths=None, test_outputs=None,
+                 image_cache=None, batch_aug=False):
         self.img_paths = img_paths
         self.mask_paths = mask_paths
         self.labels = labels
@@ -38,27 +40,48 @@ class Dataset(torch.utils.data.Dataset):
         self.hflip = hflip
         self.scale = scale
         self.scale_limit = scale_limit
+        # decoded images shared between runs (lib/image_cache.py)
+        self.image_cache = image_cache
+        # only decode, BatchAugment augments and encodes the collated batch
+        self.batch_aug = batch_aug
         self.output_w = self.input_w // self.down_ratio
         self.output_h = self.input_h // self.down_ratio
         self.max_objs = 100
         self.mean = np.array([0.485, 0.456, 0.406], dtype='float32').reshape(1, 1, 3)
         self.std = np.array([0.229, 0.224, 0.225], dtype='float32').reshape(1, 1, 3)
 
+    def set_input_size(self, input_w, input_h):
+        self.input_w = input_w
+        self.input_h = input_h
+        self.output_w = self.input_w // self.down_ratio
+        self.output_h = self.input_h // self.down_ratio
+
     def __getitem__(self, index):
         if index < len(self.img_paths):
             img_path, mask_path, label = self.img_paths[index], self.mask_paths[index], self.labels[index]
+            # the annotations are rewritten in image coordinates below, so
+            # work on a copy (persistent workers reuse the dataset)
+            label = [dict(ann) for ann in label]
             num_objs = len(label)
 
-            img = cv2.imread(img_path)
-            height, width = img.shape[:2]
-            img = cv2.resize(img, (self.input_w, self.input_h))
-
-            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-            if mask is not None:
-                mask = cv2.resize(mask, (self.output_w, self.output_h))
+            cached = None
+            if self.image_cache is not None:
+                cached = self.image_cache.get(img_path, self.input_w, self.input_h, self.down_ratio)
+            if cached is not None:
+                # a missing mask is cached as zeros
+                img, mask, height, width = cached
                 mask = 1 - mask.astype('float32') / 255
             else:
-                mask = np.ones((self.output_h, self.output_w), dtype='float32')
+                img = cv2.imread(img_path)
+                height, width = img.shape[:2]
+                img = cv2.resize(img, (self.input_w, self.input_h))
+
+                mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+                if mask is not None:
+                    mask = cv2.resize(mask, (self.output_w, self.output_h))
+                    mask = 1 - mask.astype('float32') / 255
+                else:
+                    mask = np.ones((self.output_h, self.output_w), dtype='float32')
 
             if self.test:
                 img = img.astype('float32') / 255
@@ -77,6 +100,22 @@ class Dataset(torch.utils.data.Dataset):
                     'mask': mask,
                 }
 
+            if self.batch_aug:
+                if self.transform is not None:
+                    img = self.transform(image=img)['image']
+                anns = np.zeros((self.max_objs, 7), dtype=np.float64)
+                for k in range(num_objs):
+                    ann = label[k]
+                    anns[k] = ann['x'], ann['y'], ann['z'], ann['yaw'], ann['pitch'], ann['roll'], 1
+
+                return {
+                    'img_path': img_path,
+                    'input': img,
+                    'mask': mask,
+                    'anns': anns,
+                    'size': np.array([height, width]),
+                }
+
             kpts = []
             kpts_3d = []
             poses = []
@@ -128,96 +167,11 @@ class Dataset(torch.utils.data.Dataset):
 
             mask = mask[None, ...]
 
-            hm = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
-            reg_mask = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
-            reg = np.zeros((2, self.output_h, self.output_w), dtype=np.float32)
-            wh = np.zeros((2, self.output_h, self.output_w), dtype=np.float32)
-            depth = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
-            tvec = np.zeros((3, self.output_h, self.output_w), dtype=np.float32)
-            eular = np.zeros((3, self.output_h, self.output_w), dtype=np.float32)
-            trig = np.zeros((6, self.output_h, self.output_w), dtype=np.float32)
-            quat = np.zeros((4, self.output_h, self.output_w), dtype=np.float32)
-            gt = np.zeros((self.max_objs, 7), dtype=np.float32)
-
-            for k in range(num_objs):
-                ann = label[k]
-                x, y = ann['x'], ann['y']
-                x *= self.output_w / self.input_w
-                y *= self.output_h / self.input_h
-                if x < 0 or y < 0 or x > self.output_w or y > self.output_h:
-                    continue
-
-                bbox = get_bbox(
-                    ann['yaw'],
-                    ann['pitch'],
-                    ann['roll'],
-                    *convert_2d_to_3d(ann['x'] * width / self.input_w, ann['y'] * height / self.input_h, ann['z']),
-                    ann['z'],
-                    width,
-                    height,
-                    self.output_w,
-                    self.output_h)
-
-                h, w = bbox[3] - bbox[1], bbox[2] - bbox[0]
-                radius = gaussian_radius((math.ceil(h), math.ceil(w)))
-                radius = max(0, int(radius))
-
-                ct = np.array([x, y], dtype=np.float32)
-                ct_int = ct.astype(np.int32)
-
-                draw_umich_gaussian(hm[0], ct_int, radius)
-
-                reg_mask[0, ct_int[1], ct_int[0]] = 1
-                reg[:, ct_int[1], ct_int[0]] = ct - ct_int
-                wh[0, ct_int[1], ct_int[0]] = w
-                wh[1, ct_int[1], ct_int[0]] = h
-                depth[0, ct_int[1], ct_int[0]] = ann['z']
-
-                tvec[0, ct_int[1], ct_int[0]] = ann['x_3d']
-                tvec[1, ct_int[1], ct_int[0]] = ann['y_3d']
-                tvec[2, ct_int[1], ct_int[0]] = ann['z_3d']
-
-                yaw = ann['yaw']
-                pitch = ann['pitch']
-                roll = ann['roll']
-
-                eular[0, ct_int[1], ct_int[0]] = yaw
-                eular[1, ct_int[1], ct_int[0]] = pitch
-                eular[2, ct_int[1], ct_int[0]] = rotate(roll, np.pi)
-
-                trig[0, ct_int[1], ct_int[0]] = math.cos(yaw)
-                trig[1, ct_int[1], ct_int[0]] = math.sin(yaw)
-                trig[2, ct_int[1], ct_int[0]] = math.cos(pitch)
-                trig[3, ct_int[1], ct_int[0]] = math.sin(pitch)
-                trig[4, ct_int[1], ct_int[0]] = math.cos(rotate(roll, np.pi))
-                trig[5, ct_int[1], ct_int[0]] = math.sin(rotate(roll, np.pi))
-
-                qx, qy, qz, qw = (R.from_euler('xyz', [yaw, pitch, roll])).as_quat()
-                norm = (qx**2 + qy**2 + qz**2 + qw**2)**(1 / 2)
-                quat[0, ct_int[1], ct_int[0]] = qx / norm
-                quat[1, ct_int[1], ct_int[0]] = qy / norm
-                quat[2, ct_int[1], ct_int[0]] = qz / norm
-                quat[3, ct_int[1], ct_int[0]] = qw / norm
-
-                gt[k, 0] = ann['pitch']
-                gt[k, 1] = ann['yaw']
-                gt[k, 2] = ann['roll']
-                gt[k, 3:5] = convert_2d_to_3d(ann['x'] * width / self.input_w, ann['y'] * height / self.input_h, ann['z'])
-                gt[k, 5] = ann['z']
-                gt[k, 6] = 1
+            targets = self.encode(label, width, height)
 
             if self.lhalf:
                 img = img[:, self.input_h // 2:]
                 mask = mask[:, self.output_h // 2:]
-                hm = hm[:, self.output_h // 2:]
-                reg_mask = reg_mask[:, self.output_h // 2:]
-                reg = reg[:, self.output_h // 2:]
-                wh = wh[:, self.output_h // 2:]
-                depth = depth[:, self.output_h // 2:]
-                tvec = tvec[:, self.output_h // 2:]
-                eular = eular[:, self.output_h // 2:]
-                trig = trig[:, self.output_h // 2:]
-                quat = quat[:, self.output_h // 2:]
 
         else:
             index -= len(self.img_paths)
@@ -269,6 +223,9 @@ class Dataset(torch.utils.data.Dataset):
             trig = np.zeros((6, self.output_h // 2, self.output_w), dtype=np.float32)
             quat = np.zeros((4, self.output_h // 2, self.output_w), dtype=np.float32)
             gt = np.zeros((self.max_objs, 7), dtype=np.float32)
+            # soft pseudo-label masks have no object indices
+            ind = np.zeros(self.max_objs, dtype=np.int64)
+            ind_mask = np.zeros(self.max_objs, dtype=np.float32)
 
             hm = torch.sigmoid(output['hm']).numpy()[0]
             reg_mask = hm
@@ -284,22 +241,28 @@ class Dataset(torch.utils.data.Dataset):
                 img = img[:, self.input_h // 2:]
                 mask = mask[:, self.output_h // 2:]
 
+            targets = OrderedDict([
+                ('hm', hm),
+                ('reg_mask', reg_mask),
+                ('reg', reg),
+                ('wh', wh),
+                ('depth', depth),
+                ('tvec', tvec),
+                ('eular', eular),
+                ('trig', trig),
+                ('quat', quat),
+                ('gt', gt),
+                ('ind', ind),
+                ('ind_mask', ind_mask),
+            ])
+
         ret = {
             'img_path': img_path,
             'input': img,
             'mask': mask,
             # 'label': label,
-            'hm': hm,
-            'reg_mask': reg_mask,
-            'reg': reg,
-            'wh': wh,
-            'depth': depth,
-            'tvec': tvec,
-            'eular': eular,
-            'trig': trig,
-            'quat': quat,
-            'gt': gt,
         }
+        ret.update(targets)
 
         # plt.imshow(ret['hm'][0])
         # plt.show()
@@ -310,6 +273,129 @@ class Dataset(torch.utils.data.Dataset):
 
         return ret
 
+    def encode(self, label, width, height):
+        """Dense and sparse targets of label, whose x and y are already in
+        input image coordinates (and x_3d, y_3d, z_3d set)."""
+        num_objs = len(label)
+
+        hm = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
+        reg_mask = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
+        reg = np.zeros((2, self.output_h, self.output_w), dtype=np.float32)
+        wh = np.zeros((2, self.output_h, self.output_w), dtype=np.float32)
+        depth = np.zeros((1, self.output_h, self.output_w), dtype=np.float32)
+        tvec = np.zeros((3, self.output_h, self.output_w), dtype=np.float32)
+        eular = np.zeros((3, self.output_h, self.output_w), dtype=np.float32)
+        trig = np.zeros((6, self.output_h, self.output_w), dtype=np.float32)
+        quat = np.zeros((4, self.output_h, self.output_w), dtype=np.float32)
+        gt = np.zeros((self.max_objs, 7), dtype=np.float32)
+        ind = np.zeros(self.max_objs, dtype=np.int64)
+        ind_mask = np.zeros(self.max_objs, dtype=np.float32)
+
+        for k in range(num_objs):
+            ann = label[k]
+            x, y = ann['x'], ann['y']
+            x *= self.output_w / self.input_w
+            y *= self.output_h / self.input_h
+            if x < 0 or y < 0 or x > self.output_w or y > self.output_h:
+                continue
+
+            bbox = get_bbox(
+                ann['yaw'],
+                ann['pitch'],
+                ann['roll'],
+                *convert_2d_to_3d(ann['x'] * width / self.input_w, ann['y'] * height / self.input_h, ann['z']),
+                ann['z'],
+                width,
+                height,
+                self.output_w,
+                self.output_h)
+
+            h, w = bbox[3] - bbox[1], bbox[2] - bbox[0]
+            radius = gaussian_radius((math.ceil(h), math.ceil(w)))
+            radius = max(0, int(radius))
+
+            ct = np.array([x, y], dtype=np.float32)
+            ct_int = ct.astype(np.int32)
+
+            draw_umich_gaussian(hm[0], ct_int, radius)
+
+            reg_mask[0, ct_int[1], ct_int[0]] = 1
+            ind[k] = ct_int[1] * self.output_w + ct_int[0]
+            ind_mask[k] = 1
+            reg[:, ct_int[1], ct_int[0]] = ct - ct_int
+            wh[0, ct_int[1], ct_int[0]] = w
+            wh[1, ct_int[1], ct_int[0]] = h
+            depth[0, ct_int[1], ct_int[0]] = ann['z']
+
+            tvec[0, ct_int[1], ct_int[0]] = ann['x_3d']
+            tvec[1, ct_int[1], ct_int[0]] = ann['y_3d']
+            tvec[2, ct_int[1], ct_int[0]] = ann['z_3d']
+
+            yaw = ann['yaw']
+            pitch = ann['pitch']
+            roll = ann['roll']
+
+            eular[0, ct_int[1], ct_int[0]] = yaw
+            eular[1, ct_int[1], ct_int[0]] = pitch
+            eular[2, ct_int[1], ct_int[0]] = rotate(roll, np.pi)
+
+            trig[0, ct_int[1], ct_int[0]] = math.cos(yaw)
+            trig[1, ct_int[1], ct_int[0]] = math.sin(yaw)
+            trig[2, ct_int[1], ct_int[0]] = math.cos(pitch)
+            trig[3, ct_int[1], ct_int[0]] = math.sin(pitch)
+            trig[4, ct_int[1], ct_int[0]] = math.cos(rotate(roll, np.pi))
+            trig[5, ct_int[1], ct_int[0]] = math.sin(rotate(roll, np.pi))
+
+            qx, qy, qz, qw = (R.from_euler('xyz', [yaw, pitch, roll])).as_quat()
+            norm = (qx**2 + qy**2 + qz**2 + qw**2)**(1 / 2)
+            quat[0, ct_int[1], ct_int[0]] = qx / norm
+            quat[1, ct_int[1], ct_int[0]] = qy / norm
+            quat[2, ct_int[1], ct_int[0]] = qz / norm
+            quat[3, ct_int[1], ct_int[0]] = qw / norm
+
+            gt[k, 0] = ann['pitch']
+            gt[k, 1] = ann['yaw']
+            gt[k, 2] = ann['roll']
+            gt[k, 3:5] = convert_2d_to_3d(ann['x'] * width / self.input_w, ann['y'] * height / self.input_h, ann['z'])
+            gt[k, 5] = ann['z']
+            gt[k, 6] = 1
+
+        # objects sharing a peak pixel are overwritten in the dense maps,
+        # so only the last one is kept for the gather losses
+        last = {}
+        for k in np.nonzero(ind_mask)[0]:
+            if ind[k] in last:
+                ind_mask[last[ind[k]]] = 0
+            last[ind[k]] = k
+
+        if self.lhalf:
+            hm = hm[:, self.output_h // 2:]
+            reg_mask = reg_mask[:, self.output_h // 2:]
+            reg = reg[:, self.output_h // 2:]
+            wh = wh[:, self.output_h // 2:]
+            depth = depth[:, self.output_h // 2:]
+            tvec = tvec[:, self.output_h // 2:]
+            eular = eular[:, self.output_h // 2:]
+            trig = trig[:, self.output_h // 2:]
+            quat = quat[:, self.output_h // 2:]
+            ind_mask[ind < self.output_h // 2 * self.output_w] = 0
+            ind = np.maximum(ind - self.output_h // 2 * self.output_w, 0)
+
+        return OrderedDict([
+            ('hm', hm),
+            ('reg_mask', reg_mask),
+            ('reg', reg),
+            ('wh', wh),
+            ('depth', depth),
+            ('tvec', tvec),
+            ('eular', eular),
+            ('trig', trig),
+            ('quat', quat),
+            ('gt', gt),
+            ('ind', ind),
+            ('ind_mask', ind_mask),
+        ])
+
     def __len__(self):
         if self.test_img_paths is None:
             return len(self.img_paths)
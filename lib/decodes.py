@@ -81,7 +81,7 @@ def decode(config, hm, reg, depth, eular=None, trig=None, quat=None, wh=None, tv
     if mask is not None:
         hm *= mask
 
-    if config['depth_loss'] == 'DepthL1Loss':
+    if config['depth_loss'] in ['DepthL1Loss', 'RegDepthL1Loss']:
         depth = 1. / (torch.sigmoid(depth) + 1e-6) - 1.
 
     scores, inds, clses, ys, xs = _topk(hm, K=K)
@@ -0,0 +1,92 @@
+import os
+import builtins
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def init_distributed(backend=None):
+    """Joins the process group when the script was started by torchrun.
+
+    Returns (rank, world_size, local_rank), (0, 1, 0) for a plain single
+    process run. The backend defaults to nccl with CUDA and gloo otherwise.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0, 1, 0
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def setup_print(is_main):
+    """Silences print() on all but the main process (print(..., force=True)
+    still prints everywhere)."""
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def get_device(device='cuda', local_rank=0):
+    if device == 'cuda':
+        torch.cuda.set_device(local_rank)
+        return torch.device('cuda', local_rank)
+    return torch.device(device)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_gather_objects(obj):
+    """List of obj from every process, [obj] when not distributed."""
+    if not is_distributed():
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def shard_dataset(dataset, rank=0, world_size=1):
+    """Every world_size-th sample from rank on, without the padding of
+    DistributedSampler, so each sample is evaluated exactly once and the
+    val metrics do not depend on world_size."""
+    if world_size <= 1:
+        return dataset
+    return torch.utils.data.Subset(dataset, range(rank, len(dataset), world_size))
+
+
+def convert_sync_bn(model, names):
+    """Replaces the BatchNorm layers of the named submodules with SyncBatchNorm
+    (CUDA only, SyncBatchNorm does not run on CPU tensors)."""
+    for name in names:
+        setattr(model, name, nn.SyncBatchNorm.convert_sync_batchnorm(getattr(model, name)))
+    return model
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
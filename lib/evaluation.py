@@ -0,0 +1,162 @@
+import numpy as np
+from math import pi
+from sklearn.metrics import average_precision_score
+
+import torch.distributed as dist
+
+from .utils.nms import nms
+
+
+THRES_RO_LIST = [50, 45, 40, 35, 30, 25, 20, 15, 10, 5]
+THRES_TR_LIST = [0.1, 0.09, 0.08, 0.07, 0.06, 0.05, 0.04, 0.03, 0.02, 0.01]
+
+
+def euler_to_quat(pitch, yaw, roll):
+    """Vectorized R.from_euler('xyz', [pitch, yaw, roll]).as_quat() in (x, y, z, w) order."""
+    cx, sx = np.cos(pitch / 2), np.sin(pitch / 2)
+    cy, sy = np.cos(yaw / 2), np.sin(yaw / 2)
+    cz, sz = np.cos(roll / 2), np.sin(roll / 2)
+    return np.stack([
+        sx * cy * cz - cx * sy * sz,
+        cx * sy * cz + sx * cy * sz,
+        cx * cy * sz - sx * sy * cz,
+        cx * cy * cz + sx * sy * sz,
+    ], axis=-1)
+
+
+def TranslationDistanceMatrix(p, g, abs_dist=False):
+    """TranslationDistance for all pairs of p (N, 3) and g (M, 3) as an (N, M) matrix."""
+    p = np.asarray(p, dtype=np.float64).reshape(-1, 3)
+    g = np.asarray(g, dtype=np.float64).reshape(-1, 3)
+    diff1 = np.sqrt(((p[:, None, :] - g[None, :, :])**2).sum(axis=2))
+    if abs_dist:
+        return diff1
+    diff0 = np.sqrt((g**2).sum(axis=1))
+    return diff1 / diff0[None, :]
+
+
+def RotationDistanceMatrix(p, g):
+    """RotationDistance for all pairs of p (N, 3) and g (M, 3) as an (N, M) matrix.
+
+    Rows of p and g are (pitch, yaw, roll).
+    """
+    p = np.asarray(p, dtype=np.float64).reshape(-1, 3)
+    g = np.asarray(g, dtype=np.float64).reshape(-1, 3)
+    q_pred = euler_to_quat(p[:, 0], p[:, 1], p[:, 2])
+    q_true = euler_to_quat(g[:, 0], g[:, 1], g[:, 2])
+    # scalar part of R.inv(q2) * q1 for unit quaternions
+    W = np.clip(q_pred @ q_true.T, -1., 1.)
+
+    # same θ / θ+2π handling as RotationDistance in eval.py
+    W = (np.arccos(W) * 360) / pi
+    W = np.where(W > 180, 180 - W, W)
+    return W
+
+
+def pair_distances(pred, gt):
+    """Sorts pred by descending score and returns it with the (N_pred x N_gt)
+    translation and rotation distance matrices against gt.
+
+    pred rows are (pitch, yaw, roll, x, y, z, score) and gt rows are
+    (model_type, pitch, yaw, roll, x, y, z).
+    """
+    pred = pred[np.argsort(-pred[:, 6], kind='stable')]
+    tr_dists = TranslationDistanceMatrix(pred[:, 3:6], gt[:, 4:7])
+    ro_dists = RotationDistanceMatrix(pred[:, 0:3], gt[:, 1:4])
+    tr_dists[np.isnan(tr_dists)] = np.inf
+
+    return pred, tr_dists, ro_dists
+
+
+def greedy_match(tr_dists, ro_dists, thre_tr_dist, thre_ro_dist, keep_gt=False):
+    available = np.ones(tr_dists.shape[1], dtype=bool)
+    result_flg = []
+    for i in range(len(tr_dists)):
+        # find nearest GT
+        tr_dist = np.where(available, tr_dists[i], np.inf)
+        min_idx = np.argmin(tr_dist) if len(tr_dist) else -1
+
+        # set the result
+        if min_idx >= 0 and tr_dist[min_idx] < thre_tr_dist and ro_dists[i, min_idx] < thre_ro_dist:
+            if not keep_gt:
+                available[min_idx] = False
+            result_flg.append(1)
+        else:
+            result_flg.append(0)
+
+    return result_flg
+
+
+def match_image(pred, gt, thre_tr_dist, thre_ro_dist, keep_gt=False):
+    """Greedily matches one image's predictions against its GT cars.
+
+    Returns TP flags and scores in descending score order.
+    """
+    pred, tr_dists, ro_dists = pair_distances(pred, gt)
+    result_flg = greedy_match(tr_dists, ro_dists, thre_tr_dist, thre_ro_dist, keep_gt=keep_gt)
+
+    return result_flg, pred[:, 6].tolist()
+
+
+def compute_map(result_flgs, scores, n_gt):
+    """mAP from per-threshold TP flags and scores (one list per THRES_*_LIST entry)."""
+    ap_list = []
+    for result_flg, score in zip(result_flgs, scores):
+        n_tp = np.sum(result_flg)
+        if n_tp == 0 or n_gt == 0:
+            ap_list.append(0.)
+            continue
+        recall = n_tp / n_gt
+        ap = average_precision_score(result_flg, score) * recall
+        ap_list.append(ap)
+    return np.mean(ap_list)
+
+
+class MAPMeter(object):
+    """Accumulates TP flags and scores for the ten competition thresholds
+    from decoded batches, so mAP can be computed without CSV round-trips.
+
+    Only GT cars whose centers fall inside the network output (the rows of
+    Dataset's `gt` with a non-zero flag) are counted.
+    """
+    def __init__(self, score_th=0.1, nms_th=None):
+        self.score_th = score_th
+        self.nms_th = nms_th
+        self.reset()
+
+    def reset(self):
+        self.result_flgs = [[] for _ in THRES_RO_LIST]
+        self.scores = [[] for _ in THRES_RO_LIST]
+        self.n_gt = 0
+
+    def update(self, dets, gts):
+        """dets: (B, K, >=7) output of decode, gts: (B, max_objs, 7) Dataset gt."""
+        for det, gt in zip(dets, gts):
+            gt = gt[gt[:, 6] > 0]
+            self.n_gt += len(gt)
+            if self.nms_th is not None:
+                det = nms(det, dist_th=self.nms_th)
+            det = det[det[:, 6] > self.score_th, :7]
+            # (pitch, yaw, roll, x, y, z, flag) -> (flag, pitch, yaw, roll, x, y, z)
+            gt = np.hstack([gt[:, 6:7], gt[:, :6]])
+
+            det, tr_dists, ro_dists = pair_distances(det, gt)
+            for i, (thre_ro_dist, thre_tr_dist) in enumerate(zip(THRES_RO_LIST, THRES_TR_LIST)):
+                self.result_flgs[i].extend(greedy_match(tr_dists, ro_dists, thre_tr_dist, thre_ro_dist))
+                self.scores[i].extend(det[:, 6].tolist())
+
+    def synchronize(self):
+        """Merges the flags, scores and GT counts of all distributed processes."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, (self.result_flgs, self.scores, self.n_gt))
+        self.reset()
+        for result_flgs, scores, n_gt in states:
+            for i in range(len(THRES_RO_LIST)):
+                self.result_flgs[i].extend(result_flgs[i])
+                self.scores[i].extend(scores[i])
+            self.n_gt += n_gt
+
+    def compute(self):
+        return compute_map(self.result_flgs, self.scores, self.n_gt)
@@ -0,0 +1,152 @@
+import os
+import json
+import fcntl
+
+import numpy as np
+
+import torch
+
+
+class _Store(object):
+    """Features of one input size: one memory-mapped (capacity, C, H, W)
+    float16 array per level and a key -> row index."""
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.levels = None
+        self.index = {}
+        self.full = False
+        index_path = os.path.join(path, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                meta = json.load(f)
+            self.capacity = meta['capacity']
+            self.index = meta['index']
+            self._open([tuple(shape) for shape in meta['shapes']], 'r+')
+
+    def _open(self, shapes, mode):
+        os.makedirs(self.path, exist_ok=True)
+        self.levels = [np.lib.format.open_memmap(os.path.join(self.path, 'level%d.npy' % i), mode=mode,
+                                                 dtype=np.float16, shape=(self.capacity,) + shape)
+                       for i, shape in enumerate(shapes)]
+
+    def put(self, keys, feats):
+        if self.levels is None:
+            self._open([tuple(f.shape[1:]) for f in feats], 'w+')
+        feats = [f.detach().to('cpu', torch.float16).numpy() for f in feats]
+        for k, key in enumerate(keys):
+            if len(self.index) >= self.capacity:
+                if not self.full:
+                    print('=> feature cache %s is full (%d entries), new features are not cached'
+                          % (self.path, self.capacity))
+                    self.full = True
+                return
+            row = len(self.index)
+            for level, f in zip(self.levels, feats):
+                level[row] = f[k]
+            self.index[key] = row
+
+    def flush(self):
+        if self.levels is None:
+            return
+        for level in self.levels:
+            level.flush()
+        meta = {
+            'capacity': self.capacity,
+            'shapes': [level.shape[1:] for level in self.levels],
+            'index': self.index,
+        }
+        tmp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+
+
+class FeatureCache(object):
+    """Backbone features of a frozen backbone, kept in memory-mapped float16
+    files under path.
+
+    Entries are keyed by image path and augmentation seed (the image and
+    the seed determine the augmented input); every input size has its own
+    store (<path>/<W>x<H>) of up to capacity entries. features() returns
+    the cached levels of a batch and runs the backbone on the missing
+    samples only. Cached and computed features are both rounded to
+    float16, so a sample gets the same features whether it hits or not.
+    flush() writes the index, after which later runs with the same backbone
+    and augmentation settings reuse the cache.
+
+    The stores keep their index in memory, so only one process may write a
+    cache at a time: the cache takes an exclusive lock on path, and a
+    process that finds it taken (another fold worker or sweep trial with the
+    same settings) uses a private cache under path instead.
+    """
+    def __init__(self, path, capacity):
+        os.makedirs(path, exist_ok=True)
+        self.lock = open(os.path.join(path, '.lock'), 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            path = os.path.join(path, 'pid%d' % os.getpid())
+            print('=> feature cache locked by another process, using %s' % path)
+            os.makedirs(path, exist_ok=True)
+            self.lock = open(os.path.join(path, '.lock'), 'w')
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.path = path
+        self.capacity = capacity
+        self.stores = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, input_size):
+        if input_size not in self.stores:
+            self.stores[input_size] = _Store(os.path.join(self.path, '%dx%d' % input_size), self.capacity)
+        return self.stores[input_size]
+
+    def features(self, forward_backbone, input, img_paths, seeds):
+        store = self._store((input.size(3), input.size(2)))
+        keys = ['%s|%d' % (img_path, seed) for img_path, seed in zip(img_paths, seeds)]
+        rows = [store.index.get(key) for key in keys]
+        miss = [k for k, row in enumerate(rows) if row is None]
+        hit = [k for k, row in enumerate(rows) if row is not None]
+        self.hits += len(hit)
+        self.misses += len(miss)
+
+        if miss:
+            with torch.no_grad():
+                miss_feats = [f.half() for f in forward_backbone(input[miss])]
+            store.put([keys[k] for k in miss], miss_feats)
+        if hit:
+            # rows in ascending order read the files sequentially
+            order = np.argsort([rows[k] for k in hit])
+            hit = [hit[k] for k in order]
+            hit_rows = [rows[k] for k in hit]
+            hit_feats = [torch.from_numpy(level[hit_rows]).to(input.device)
+                         for level in store.levels]
+
+        feats = []
+        for level in range(len(store.levels)):
+            shape = store.levels[level].shape[1:]
+            f = torch.empty((input.size(0),) + shape, dtype=torch.float16, device=input.device)
+            if miss:
+                f[miss] = miss_feats[level]
+            if hit:
+                f[hit] = hit_feats[level]
+            feats.append(f.to(input.dtype))
+        return feats
+
+    def stats(self):
+        """Hit rate since the last call."""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.
+        self.hits = 0
+        self.misses = 0
+        return hit_rate
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()
+
+    def close(self):
+        self.flush()
+        self.lock.close()
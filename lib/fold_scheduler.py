@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import subprocess
+
+
+def run_jobs(jobs, n_workers, devices=None, num_threads=0, poll_interval=5):
+    """Runs jobs, a list of (name, command, output path), as subprocesses,
+    at most n_workers at a time.
+
+    Worker i of the pool sees only devices[i % len(devices)] through
+    CUDA_VISIBLE_DEVICES, so several workers can share a device, and uses at
+    most num_threads CPU threads (0: no limit). The output of each job is
+    appended to its output path. Returns {name: return code}.
+    """
+    pending = list(jobs)
+    running = {}
+    returncodes = {}
+    while pending or running:
+        for slot in range(n_workers):
+            if slot in running or not pending:
+                continue
+            name, command, out_path = pending.pop(0)
+            env = dict(os.environ)
+            if devices:
+                env['CUDA_VISIBLE_DEVICES'] = str(devices[slot % len(devices)])
+            if num_threads > 0:
+                env['OMP_NUM_THREADS'] = str(num_threads)
+                env['MKL_NUM_THREADS'] = str(num_threads)
+            out = open(out_path, 'a')
+            proc = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT, env=env)
+            running[slot] = (name, proc, out, out_path)
+            print('=> %s started (pid %d%s)' % (name, proc.pid,
+                  ', device %s' % env['CUDA_VISIBLE_DEVICES'] if devices else ''))
+
+        time.sleep(poll_interval)
+
+        for slot, (name, proc, out, out_path) in list(running.items()):
+            if proc.poll() is None:
+                continue
+            out.close()
+            returncodes[name] = proc.returncode
+            del running[slot]
+            if proc.returncode == 0:
+                print('=> %s finished' % name)
+            else:
+                print('=> %s failed with code %d, see %s' % (name, proc.returncode, out_path))
+
+    return returncodes
+
+
+def run_folds(script, name, folds, n_workers, devices=None, num_threads=0,
+              out_dir='.', poll_interval=5):
+    """Trains folds as separate `python <script> --name <name> --fold <k>`
+    processes with run_jobs(). The output of each fold goes to
+    <out_dir>/stdout_<k>.txt. Returns {fold: return code}.
+    """
+    jobs = [('fold %d' % fold,
+             [sys.executable, script, '--name', name, '--fold', str(fold)],
+             os.path.join(out_dir, 'stdout_%d.txt' % fold)) for fold in folds]
+    returncodes = run_jobs(jobs, n_workers, devices=devices, num_threads=num_threads,
+                           poll_interval=poll_interval)
+    return {fold: returncodes['fold %d' % fold] for fold in folds}
@@ -0,0 +1,95 @@
+import math
+
+import torch
+import torch.distributed as dist
+
+
+class HealthMonitor(object):
+    """Opt-in numerical health checks for the training loop.
+
+    Every step the total and per-head losses and the selected head outputs
+    are checked for NaN/Inf with a single host sync. The global gradient norm
+    is checked every `grad_norm_interval` steps (0: never). When a problem is
+    found, torch.autograd anomaly detection is turned on for the next
+    `anomaly_window` steps and off again afterwards.
+    """
+    def __init__(self, heads=(), check_losses=True, grad_norm_interval=0,
+                 anomaly_window=10):
+        self.heads = list(heads)
+        self.check_losses = check_losses
+        self.grad_norm_interval = grad_norm_interval
+        self.anomaly_window = anomaly_window
+        self.step = 0
+        self.anomaly_steps = 0
+        self.num_events = 0
+        self.grad_norm = None
+
+    def start_step(self):
+        enable = self.anomaly_steps > 0
+        if enable != torch.is_anomaly_enabled():
+            torch.autograd.set_detect_anomaly(enable)
+        if enable:
+            self.anomaly_steps -= 1
+        self.step += 1
+
+    def check_forward(self, losses, output):
+        """Returns False if any checked loss or head output is not finite."""
+        names = []
+        flags = []
+        if self.check_losses:
+            for name, loss in losses.items():
+                if torch.is_tensor(loss):
+                    names.append(name + '_loss')
+                    flags.append(torch.isfinite(loss.detach()).all())
+        for head in self.heads:
+            names.append(head)
+            flags.append(torch.isfinite(output[head].detach()).all())
+        if not flags:
+            return True
+
+        flags = torch.stack(flags)
+        if dist.is_available() and dist.is_initialized():
+            # all processes have to skip the same steps
+            flags = flags.int()
+            dist.all_reduce(flags, op=dist.ReduceOp.MIN)
+            flags = flags.bool()
+        if flags.all().item():
+            return True
+
+        bad = [name for name, flag in zip(names, flags.tolist()) if not flag]
+        self.report('non-finite %s' % ', '.join(bad))
+        return False
+
+    def check_grads(self, model, scaler=None):
+        """Returns False if the sampled global gradient norm is not finite.
+
+        With an enabled GradScaler (fp16) the gradients must already be
+        unscaled; a non-finite norm is then an ordinary overflow, which
+        scaler.step() skips and scaler.update() answers by lowering the
+        scale, so it is not a health event.
+        """
+        if self.grad_norm_interval <= 0 or self.step % self.grad_norm_interval != 0:
+            return True
+
+        grads = [p.grad.detach() for p in model.parameters() if p.grad is not None]
+        if not grads:
+            return True
+        self.grad_norm = torch.norm(torch.stack([torch.norm(g) for g in grads])).item()
+        if math.isfinite(self.grad_norm):
+            return True
+        if scaler is not None and scaler.is_enabled():
+            return True
+
+        self.report('non-finite gradient norm')
+        return False
+
+    def report(self, msg):
+        self.num_events += 1
+        print('=> step %d: %s, anomaly detection on for %d steps'
+              % (self.step, msg, self.anomaly_window))
+        self.anomaly_steps = self.anomaly_window
+
+    def close(self):
+        self.anomaly_steps = 0
+        if torch.is_anomaly_enabled():
+            torch.autograd.set_detect_anomaly(False)
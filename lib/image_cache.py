@@ -0,0 +1,107 @@
+import os
+import json
+
+import numpy as np
+import cv2
+from joblib import Parallel, delayed
+
+
+def load_image(img_path, mask_path, input_w, input_h, output_w, output_h):
+    """Image resized to the input size and raw mask resized to the output
+    size (zeros without a mask file), decoded as Dataset does."""
+    img = cv2.imread(img_path)
+    height, width = img.shape[:2]
+    img = cv2.resize(img, (input_w, input_h))
+
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    if mask is not None:
+        mask = cv2.resize(mask, (output_w, output_h))
+    else:
+        mask = np.zeros((output_h, output_w), dtype='uint8')
+
+    return img, mask, height, width
+
+
+def _write_rows(path, rows, img_paths, mask_paths, input_w, input_h, output_w, output_h):
+    images = np.load(os.path.join(path, 'images.npy'), mmap_mode='r+')
+    masks = np.load(os.path.join(path, 'masks.npy'), mmap_mode='r+')
+    sizes = []
+    for row in rows:
+        images[row], masks[row], height, width = load_image(img_paths[row], mask_paths[row],
+                                                            input_w, input_h, output_w, output_h)
+        sizes.append((height, width))
+    images.flush()
+    masks.flush()
+    return sizes
+
+
+def build_image_cache(path, img_paths, mask_paths, input_w, input_h, down_ratio=4, n_jobs=-1):
+    """Decodes img_paths and mask_paths once into an ImageCache at path.
+    An existing cache of the same images and size is kept."""
+    img_paths = [str(p) for p in img_paths]
+    mask_paths = [str(p) for p in mask_paths]
+    output_w, output_h = input_w // down_ratio, input_h // down_ratio
+    index_path = os.path.join(path, 'index.json')
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            meta = json.load(f)
+        if meta['img_paths'] == img_paths and meta['input_size'] == [input_w, input_h, down_ratio]:
+            return
+        os.remove(index_path)
+
+    os.makedirs(path, exist_ok=True)
+    np.lib.format.open_memmap(os.path.join(path, 'images.npy'), mode='w+', dtype='uint8',
+                              shape=(len(img_paths), input_h, input_w, 3))
+    np.lib.format.open_memmap(os.path.join(path, 'masks.npy'), mode='w+', dtype='uint8',
+                              shape=(len(img_paths), output_h, output_w))
+    chunks = np.array_split(np.arange(len(img_paths)), max(len(img_paths) // 64, 1))
+    sizes = Parallel(n_jobs=n_jobs, verbose=1)(
+        delayed(_write_rows)(path, chunk, img_paths, mask_paths, input_w, input_h, output_w, output_h)
+        for chunk in chunks)
+
+    # written last, a cache without an index is incomplete
+    meta = {
+        'input_size': [input_w, input_h, down_ratio],
+        'img_paths': img_paths,
+        'sizes': [size for chunk_sizes in sizes for size in chunk_sizes],
+    }
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(index_path + '.tmp', index_path)
+
+
+class ImageCache(object):
+    """Decoded images of build_image_cache(), read from memory-mapped uint8
+    arrays instead of decoding the JPEGs.
+
+    Several runs reading the same cache share it through the page cache.
+    The arrays are opened lazily in each process, so the cache can be
+    passed to DataLoader workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        self.input_size = tuple(meta['input_size'])
+        self.rows = {img_path: row for row, img_path in enumerate(meta['img_paths'])}
+        self.sizes = meta['sizes']
+        self.images = None
+        self.masks = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['masks'] = None
+        return state
+
+    def get(self, img_path, input_w, input_h, down_ratio):
+        """(img, mask, height, width) as load_image() returns them, or None
+        when img_path is not cached at this size."""
+        row = self.rows.get(img_path)
+        if row is None or (input_w, input_h, down_ratio) != self.input_size:
+            return None
+        if self.images is None:
+            self.images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='r')
+            self.masks = np.load(os.path.join(self.path, 'masks.npy'), mmap_mode='r')
+        height, width = self.sizes[row]
+        return np.array(self.images[row]), np.array(self.masks[row]), height, width
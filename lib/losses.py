@@ -2,17 +2,23 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-torch.autograd.set_detect_anomaly(True)
+# Every loss divides by a per-batch normalizer (mask.sum(), ind_mask.sum()
+# or the number of positives), also returned by its normalizer(). Passing
+# the normalizer of a whole batch to forward() makes the losses of its
+# micro-batches add up to the loss of the batch.
 
 
 class BCEWithLogitsLoss(nn.Module):
     def __init__(self):
         super().__init__()
 
-    def forward(self, input, target, mask):
+    def normalizer(self, target, mask, ind_mask=None):
+        return mask.sum()
+
+    def forward(self, input, target, mask, ind=None, ind_mask=None, normalizer=None):
         loss = F.binary_cross_entropy(
             input * mask, target * mask, reduction='sum')
-        loss /= mask.sum()
+        loss /= self.normalizer(target, mask) if normalizer is None else normalizer
         return loss
 
 
@@ -20,9 +26,13 @@ class L1Loss(nn.Module):
     def __init__(self):
         super().__init__()
 
-    def forward(self, output, target, mask):
+    def normalizer(self, target, mask, ind_mask=None):
+        return mask.sum()
+
+    def forward(self, output, target, mask, ind=None, ind_mask=None, normalizer=None):
+        output, target = output.float(), target.float()
         loss = F.l1_loss(output * mask, target * mask, reduction='sum')
-        loss /= mask.sum()
+        loss /= self.normalizer(target, mask) if normalizer is None else normalizer
         return loss
 
 
@@ -30,14 +40,68 @@ class DepthL1Loss(nn.Module):
     def __init__(self):
         super().__init__()
 
-    def forward(self, output, target, mask):
+    def normalizer(self, target, mask, ind_mask=None):
+        return mask.sum()
+
+    def forward(self, output, target, mask, ind=None, ind_mask=None, normalizer=None):
+        # computed in float32 under autocast, 1 / sigmoid overflows in fp16
+        output, target = output.float(), target.float()
         output = 1. / (torch.sigmoid(output) + 1e-6) - 1.
         loss = F.l1_loss(output * mask, target * mask, reduction='sum')
-        loss /= mask.sum()
+        loss /= self.normalizer(target, mask) if normalizer is None else normalizer
+        return loss
+
+
+def _gather_feat(feat, ind):
+    """Gathers (B, C, H, W) at flat spatial indices (B, K) into (B, K, C)
+    without copying the map, in either memory format."""
+    b, c = feat.size(0), feat.size(1)
+    if feat.is_contiguous():
+        feat = feat.view(b, c, -1)
+        ind = ind.unsqueeze(1).expand(b, c, ind.size(1))
+        return feat.gather(2, ind).permute(0, 2, 1)
+    feat = feat.permute(0, 2, 3, 1).reshape(b, -1, c)
+    ind = ind.unsqueeze(2).expand(b, ind.size(1), c)
+    return feat.gather(1, ind)
+
+
+class RegL1Loss(nn.Module):
+    """L1Loss evaluated only at the object centers given by the Dataset's
+    ind / ind_mask, instead of over the whole masked map."""
+    def __init__(self):
+        super().__init__()
+
+    def normalizer(self, target, mask, ind_mask=None):
+        return ind_mask.float().sum()
+
+    def forward(self, output, target, mask, ind=None, ind_mask=None, normalizer=None):
+        output = _gather_feat(output, ind).float()
+        target = _gather_feat(target, ind).float()
+        loss = F.l1_loss(output * ind_mask.float().unsqueeze(2), target * ind_mask.float().unsqueeze(2),
+                         reduction='sum')
+        loss /= self.normalizer(target, mask, ind_mask) if normalizer is None else normalizer
+        return loss
+
+
+class RegDepthL1Loss(nn.Module):
+    """DepthL1Loss evaluated only at the object centers."""
+    def __init__(self):
+        super().__init__()
+
+    def normalizer(self, target, mask, ind_mask=None):
+        return ind_mask.float().sum()
+
+    def forward(self, output, target, mask, ind=None, ind_mask=None, normalizer=None):
+        output = _gather_feat(output, ind).float()
+        target = _gather_feat(target, ind).float()
+        output = 1. / (torch.sigmoid(output) + 1e-6) - 1.
+        loss = F.l1_loss(output * ind_mask.float().unsqueeze(2), target * ind_mask.float().unsqueeze(2),
+                         reduction='sum')
+        loss /= self.normalizer(target, mask, ind_mask) if normalizer is None else normalizer
         return loss
 
 
-def _neg_loss(pred, gt, mask):
+def _neg_loss(pred, gt, mask, num_pos=None):
     pos_inds = gt.eq(1).float() * mask
     neg_inds = gt.lt(1).float() * mask
 
@@ -49,10 +113,14 @@ def _neg_loss(pred, gt, mask):
     neg_loss = torch.log(1 - pred) * torch.pow(pred, 2) * \
         neg_weights * neg_inds
 
-    num_pos = pos_inds.float().sum()
     pos_loss = pos_loss.sum()
     neg_loss = neg_loss.sum()
 
+    if num_pos is not None:
+        loss = loss - (pos_loss + neg_loss) / num_pos
+        return loss
+
+    num_pos = pos_inds.float().sum()
     if num_pos == 0:
         loss = loss - neg_loss
     else:
@@ -65,7 +133,74 @@ class FocalLoss(nn.Module):
         super().__init__()
         self.neg_loss = _neg_loss
 
-    def forward(self, output, target, mask):
-        output = torch.sigmoid(output)
-        loss = self.neg_loss(output, target, mask)
+    def normalizer(self, target, mask, ind_mask=None):
+        return _num_pos(target.float(), mask.float())
+
+    def forward(self, output, target, mask, normalizer=None):
+        # computed in float32 under autocast, 1 - pred rounds to 0 in fp16
+        output = torch.sigmoid(output.float())
+        loss = self.neg_loss(output, target.float(), mask.float(), num_pos=normalizer)
         return loss
+
+
+def _focal_terms(output, gt):
+    """Per-pixel positive and negative focal terms from logits, in one pass."""
+    log_pred = F.logsigmoid(output)
+    log_neg_pred = log_pred - output  # log(1 - sigmoid(x))
+    pred = torch.exp(log_pred)
+    pos_loss = log_pred * (1 - pred)**2
+    neg_loss = log_neg_pred * pred**2 * (1 - gt)**4
+    return torch.where(gt.eq(1), pos_loss, neg_loss)
+
+
+def _num_pos(gt, mask):
+    num_pos = (gt.eq(1).float() * mask).sum()
+    return torch.where(num_pos == 0, torch.ones_like(num_pos), num_pos)
+
+
+class _FocalLossFunction(torch.autograd.Function):
+    """Focal loss on logits that saves only its inputs and recomputes the
+    per-pixel gradient in backward."""
+    @staticmethod
+    def forward(ctx, output, gt, mask, num_pos):
+        ctx.save_for_backward(output, gt, mask, num_pos)
+        return -(_focal_terms(output, gt) * mask).sum() / num_pos
+
+    @staticmethod
+    def backward(ctx, grad):
+        output, gt, mask, num_pos = ctx.saved_tensors
+        pred = torch.sigmoid(output)
+        log_pred = F.logsigmoid(output)
+        log_neg_pred = log_pred - output
+        pos_grad = (1 - pred)**2 * (1 - pred - 2 * pred * log_pred)
+        neg_grad = pred**2 * (1 - gt)**4 * (2 * (1 - pred) * log_neg_pred - pred)
+        grad_output = torch.where(gt.eq(1), pos_grad, neg_grad) * mask
+        grad_output *= -grad / num_pos
+        return grad_output, None, None, None
+
+
+class LogitFocalLoss(nn.Module):
+    """FocalLoss computed from logits with logsigmoid.
+
+    With recompute=True it runs as a custom autograd function that keeps no
+    intermediate heatmap-sized tensors for backward.
+    """
+    def __init__(self, recompute=False):
+        super().__init__()
+        self.recompute = recompute
+
+    def normalizer(self, target, mask, ind_mask=None):
+        return _num_pos(target.float(), mask.float())
+
+    def forward(self, output, target, mask, normalizer=None):
+        output, target, mask = output.float(), target.float(), mask.float()
+        if normalizer is None:
+            normalizer = _num_pos(target, mask)
+        if self.recompute:
+            return _FocalLossFunction.apply(output, target, mask, normalizer)
+        return -(_focal_terms(output, target) * mask).sum() / normalizer
+
+
+class FusedFocalLoss(LogitFocalLoss):
+    def __init__(self):
+        super().__init__(recompute=True)
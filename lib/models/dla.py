@@ -11,7 +11,7 @@ import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 
 from .DCNv2.dcn_v2 import DCN
-from .modules import Conv2d
+from .modules import Conv2d, parse_checkpointing, checkpoint, decode_stage
 
 BN_MOMENTUM = 0.1
 logger = logging.getLogger(__name__)
@@ -407,10 +407,12 @@ class Interpolate(nn.Module):
 class DLAFPN(nn.Module):
     def __init__(self, base_name, heads, head_conv=128,
                  num_filters=[256, 256, 256],
-                 gn=False, ws=False, freeze_bn=False):
+                 gn=False, ws=False, freeze_bn=False, freeze_backbone=False, checkpointing=None):
         super().__init__()
 
         self.heads = heads
+        self.freeze_backbone = freeze_backbone
+        self.checkpointing = parse_checkpointing(checkpointing)
 
         self.base = globals()[base_name]()
         num_bottleneck_filters = 512
@@ -421,6 +423,10 @@ class DLAFPN(nn.Module):
                     m.weight.requires_grad = False
                     m.bias.requires_grad = False
 
+        if freeze_backbone:
+            for p in self.base.parameters():
+                p.requires_grad = False
+
         self.lateral4 = nn.Sequential(
             Conv2d(num_bottleneck_filters, num_filters[0],
                    kernel_size=1, bias=False, ws=ws),
@@ -473,34 +479,53 @@ class DLAFPN(nn.Module):
                 fill_fc_weights(fc)
             self.__setattr__(head, fc)
 
+    def train(self, mode=True):
+        super().train(mode)
+        # a frozen backbone also keeps its BatchNorm statistics
+        if self.freeze_backbone:
+            self.base.eval()
+        return self
+
+    def forward_backbone(self, x):
+        backbone = 'backbone' in self.checkpointing
+
+        # same as self.base(x), one segment per level
+        x = checkpoint(backbone, self.base.base_layer, x)
+        feats = []
+        for i in range(6):
+            x = checkpoint(backbone, getattr(self.base, 'level{}'.format(i)), x)
+            feats.append(x)
+        # the decoder only uses the last four levels
+        return feats[-4:]
+
     def forward(self, x):
-        x = self.base(x)
+        """x is an image batch or the last four levels returned by
+        forward_backbone (e.g. from a feature cache)."""
+        decoder = 'decoder' in self.checkpointing
 
-        lat4 = self.lateral4(x[-1])
-        lat3 = self.lateral3(x[-2])
-        lat2 = self.lateral2(x[-3])
-        lat1 = self.lateral1(x[-4])
+        feats = self.forward_backbone(x) if torch.is_tensor(x) else x
 
-        map4 = lat4
-        map3 = lat3 + F.interpolate(map4, scale_factor=2, mode="nearest")
-        map3 = self.decode3(map3)
-        map2 = lat2 + F.interpolate(map3, scale_factor=2, mode="nearest")
-        map2 = self.decode2(map2)
-        map1 = lat1 + F.interpolate(map2, scale_factor=2, mode="nearest")
-        map1 = self.decode1(map1)
+        map4 = checkpoint(decoder, self.lateral4, feats[-1])
+        map3 = checkpoint(decoder, decode_stage, self.lateral3, self.decode3, feats[-2], map4)
+        map2 = checkpoint(decoder, decode_stage, self.lateral2, self.decode2, feats[-3], map3)
+        map1 = checkpoint(decoder, decode_stage, self.lateral1, self.decode1, feats[-4], map2)
 
         ret = {}
         for head in self.heads:
-            ret[head] = self.__getattr__(head)(map1)
+            ret[head] = checkpoint('heads' in self.checkpointing, self.__getattr__(head), map1)
         return ret
 
 
 def get_dla34(heads, pretrained, head_conv=128,
               num_filters=[256, 256, 256],
-              gn=False, ws=False, freeze_bn=False):
+              gn=False, ws=False, freeze_bn=False, freeze_backbone=False, checkpointing=None):
     model = DLAFPN('dla34', heads, head_conv=head_conv,
                    num_filters=num_filters,
-                   gn=gn, ws=ws, freeze_bn=freeze_bn)
+                   gn=gn, ws=ws, freeze_bn=freeze_bn, freeze_backbone=freeze_backbone,
+                   checkpointing=checkpointing)
+    if pretrained is None:
+        return model
+
     state_dict_old = torch.load('pretrained_weights/%s.pth' %pretrained)['state_dict']
     state_dict = OrderedDict()
     for key, val in state_dict_old.items():
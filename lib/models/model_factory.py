@@ -8,15 +8,21 @@ from . import dla
 
 
 def get_model(name, heads, head_conv=128, num_filters=[256, 256, 256],
-              dcn=False, gn=False, ws=False, freeze_bn=False, **kwargs):
+              dcn=False, gn=False, ws=False, freeze_bn=False, freeze_backbone=False,
+              pretrained=True, checkpointing=None, **kwargs):
     if 'res' in name and 'fpn' in name:
         backbone = '_'.join(name.split('_')[:-1])
         model = resnet_fpn.ResNetFPN(backbone, heads, head_conv, num_filters,
-                                     dcn=dcn, gn=gn, ws=ws, freeze_bn=freeze_bn)
+                                     pretrained=pretrained,
+                                     dcn=dcn, gn=gn, ws=ws, freeze_bn=freeze_bn,
+                                     freeze_backbone=freeze_backbone,
+                                     checkpointing=checkpointing)
     elif 'dla' in name:
-        pretrained = '_'.join(name.split('_')[1:])
+        pretrained = '_'.join(name.split('_')[1:]) if pretrained else None
         model = dla.get_dla34(heads, pretrained, head_conv, num_filters,
-                              gn=gn, ws=ws, freeze_bn=freeze_bn)
+                              gn=gn, ws=ws, freeze_bn=freeze_bn,
+                              freeze_backbone=freeze_backbone,
+                              checkpointing=checkpointing)
     else:
         raise NotImplementedError
 
@@ -1,6 +1,13 @@
+import contextlib
+from functools import partial
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+
+
+CHECKPOINT_PARTS = ['backbone', 'decoder', 'heads']
 
 
 class Conv2d(nn.Conv2d):
@@ -13,10 +20,63 @@ class Conv2d(nn.Conv2d):
     def forward(self, input):
         weight = self.weight
         if self.ws:
-            weight_mean = weight.mean(dim=1, keepdim=True).mean(dim=2,
-                                      keepdim=True).mean(dim=3, keepdim=True)
-            weight = weight - weight_mean
-            std = weight.view(weight.size(0), -1).std(dim=1).view(-1, 1, 1, 1) + 1e-5
-            weight = weight / std.expand_as(weight)
+            # reduce over dims instead of view() so channels_last weights stay as they are
+            weight = weight - weight.mean(dim=(1, 2, 3), keepdim=True)
+            std = weight.std(dim=(1, 2, 3), keepdim=True) + 1e-5
+            weight = weight / std
         return F.conv2d(input, weight, self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
+
+
+def parse_checkpointing(checkpointing):
+    """'backbone,decoder,heads', 'all' or ''/'none' -> set of parts to checkpoint."""
+    if not checkpointing or checkpointing == 'none':
+        return set()
+    if checkpointing == 'all':
+        return set(CHECKPOINT_PARTS)
+    parts = set(checkpointing.split(','))
+    unknown = parts - set(CHECKPOINT_PARTS)
+    if unknown:
+        raise ValueError('Unknown checkpointing parts: %s' %', '.join(sorted(unknown)))
+    return parts
+
+
+@contextlib.contextmanager
+def frozen_bn_stats(modules):
+    """Keeps the running stats of the training BatchNorm layers in modules
+    unchanged (momentum 0, num_batches_tracked restored)."""
+    bns = [m for module in modules for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpoint_contexts(modules):
+    # the forward pass updates the BatchNorm running stats, the recompute does not
+    return contextlib.nullcontext(), frozen_bn_stats(modules)
+
+
+def checkpoint(enabled, function, *args):
+    """Runs function(*args), recomputing its activations in backward instead
+    of keeping them when enabled. The recompute leaves the BatchNorm running
+    stats of function (a module, or the module of a bound method such as
+    ResNetFPN.stem) and of module arguments alone, so they are updated
+    once per step as without checkpointing."""
+    if enabled and torch.is_grad_enabled():
+        modules = [m for m in (function, getattr(function, '__self__', None)) + args
+                   if isinstance(m, nn.Module)]
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False,
+                                                 context_fn=partial(_checkpoint_contexts, modules))
+    return function(*args)
+
+
+def decode_stage(lateral, decode, feat, x):
+    """One top-down FPN stage: decode(lateral(feat) + upsample(x))."""
+    return decode(lateral(feat) + F.interpolate(x, scale_factor=2, mode="nearest"))
@@ -5,7 +5,7 @@ from torchvision import models
 import pretrainedmodels
 import timm
 
-from .modules import Conv2d
+from .modules import Conv2d, parse_checkpointing, checkpoint, decode_stage
 from .DCNv2.dcn_v2 import DCN
 
 
@@ -28,10 +28,13 @@ def convert_to_inplace_relu(model):
 class ResNetFPN(nn.Module):
     def __init__(self, backbone, heads, head_conv=128,
                  num_filters=[256, 256, 256], pretrained=True,
-                 dcn=False, gn=False, ws=False, freeze_bn=False):
+                 dcn=False, gn=False, ws=False, freeze_bn=False,
+                 freeze_backbone=False, checkpointing=None):
         super().__init__()
 
         self.heads = heads
+        self.freeze_backbone = freeze_backbone
+        self.checkpointing = parse_checkpointing(checkpointing)
 
         if backbone == 'resnet18':
             pretrained = 'imagenet' if pretrained else None
@@ -103,6 +106,10 @@ class ResNetFPN(nn.Module):
                     m.weight.requires_grad = False
                     m.bias.requires_grad = False
 
+        if freeze_backbone:
+            for p in self.backbone.parameters():
+                p.requires_grad = False
+
         self.lateral4 = nn.Sequential(
             Conv2d(num_bottleneck_filters, num_filters[0],
                    kernel_size=1, bias=False, ws=ws),
@@ -157,35 +164,46 @@ class ResNetFPN(nn.Module):
                 fill_fc_weights(fc)
             self.__setattr__(head, fc)
 
-    def forward(self, x):
+    def stem(self, x):
         module_names = [n for n, _ in self.backbone.named_modules()]
         if 'layer0' in module_names:
-            x1 = self.backbone.layer0(x)
-        else:
-            x1 = self.backbone.conv1(x)
-            x1 = self.backbone.bn1(x1)
-            x1 = self.backbone.relu(x1)
-            x1 = self.backbone.maxpool(x1)
-
-        x1 = self.backbone.layer1(x1)
-        x2 = self.backbone.layer2(x1)
-        x3 = self.backbone.layer3(x2)
-        x4 = self.backbone.layer4(x3)
-
-        lat4 = self.lateral4(x4)
-        lat3 = self.lateral3(x3)
-        lat2 = self.lateral2(x2)
-        lat1 = self.lateral1(x1)
-
-        map4 = lat4
-        map3 = lat3 + F.interpolate(map4, scale_factor=2, mode="nearest")
-        map3 = self.decode3(map3)
-        map2 = lat2 + F.interpolate(map3, scale_factor=2, mode="nearest")
-        map2 = self.decode2(map2)
-        map1 = lat1 + F.interpolate(map2, scale_factor=2, mode="nearest")
-        map1 = self.decode1(map1)
+            return self.backbone.layer0(x)
+        x = self.backbone.conv1(x)
+        x = self.backbone.bn1(x)
+        x = self.backbone.relu(x)
+        x = self.backbone.maxpool(x)
+        return x
+
+    def train(self, mode=True):
+        super().train(mode)
+        # a frozen backbone also keeps its BatchNorm statistics
+        if self.freeze_backbone:
+            self.backbone.eval()
+        return self
+
+    def forward_backbone(self, x):
+        backbone = 'backbone' in self.checkpointing
+
+        x1 = checkpoint(backbone, self.stem, x)
+        x1 = checkpoint(backbone, self.backbone.layer1, x1)
+        x2 = checkpoint(backbone, self.backbone.layer2, x1)
+        x3 = checkpoint(backbone, self.backbone.layer3, x2)
+        x4 = checkpoint(backbone, self.backbone.layer4, x3)
+        return [x1, x2, x3, x4]
+
+    def forward(self, x):
+        """x is an image batch or the [x1, x2, x3, x4] features of
+        forward_backbone (e.g. from a feature cache)."""
+        decoder = 'decoder' in self.checkpointing
+
+        x1, x2, x3, x4 = self.forward_backbone(x) if torch.is_tensor(x) else x
+
+        map4 = checkpoint(decoder, self.lateral4, x4)
+        map3 = checkpoint(decoder, decode_stage, self.lateral3, self.decode3, x3, map4)
+        map2 = checkpoint(decoder, decode_stage, self.lateral2, self.decode2, x2, map3)
+        map1 = checkpoint(decoder, decode_stage, self.lateral1, self.decode1, x1, map2)
 
         ret = {}
         for head in self.heads:
-            ret[head] = self.__getattr__(head)(map1)
+            ret[head] = checkpoint('heads' in self.checkpointing, self.__getattr__(head), map1)
         return ret
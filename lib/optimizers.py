@@ -1,144 +1,167 @@
 import math
+from collections import defaultdict
+
 import torch
 from torch.optim.optimizer import Optimizer, required
 
 
-class RAdam(Optimizer):
+class _RAdamBase(Optimizer):
+    """Shared update of RAdam and PlainRAdam.
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
-        self.buffer = [[None, None, None] for ind in range(10)]
-        super(RAdam, self).__init__(params, defaults)
+    With foreach the moment updates and the rectified step of all
+    parameters of a group that are at the same step run as multi-tensor
+    (torch._foreach_*) ops. fp32 parameters are updated in place; other
+    dtypes keep fp32 state and are updated through an fp32 copy.
+    foreach=False runs the original per-parameter loop, foreach=None (the
+    default) uses the foreach ops for CUDA parameters only, as on CPU they
+    are slower than the loop.
+    """
 
-    def __setstate__(self, state):
-        super(RAdam, self).__setstate__(state)
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, foreach=None):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, foreach=foreach)
+        super(_RAdamBase, self).__init__(params, defaults)
 
+    def __setstate__(self, state):
+        super(_RAdamBase, self).__setstate__(state)
+        for group in self.param_groups:
+            group.setdefault('foreach', None)
+
+    def _step_coefs(self, group, step):
+        """(N_sma, step_size) of the given step."""
+        beta1, beta2 = group['betas']
+        beta2_t = beta2 ** step
+        N_sma_max = 2 / (1 - beta2) - 1
+        N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+
+        # more conservative since it's an approximated value
+        if N_sma >= 5:
+            step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+        else:
+            step_size = group['lr'] / (1 - beta1 ** step)
+        return N_sma, step_size
+
+    def _init_state(self, p, p_data_fp32):
+        state = self.state[p]
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p_data_fp32, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p_data_fp32, memory_format=torch.preserve_format)
+        elif state['exp_avg'].dtype != torch.float32:
+            state['exp_avg'] = state['exp_avg'].float()
+            state['exp_avg_sq'] = state['exp_avg_sq'].float()
+        return state
+
+    @torch.no_grad()
     def step(self, closure=None):
 
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         for group in self.param_groups:
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
-                    raise RuntimeError('RAdam does not support sparse gradients')
-
-                p_data_fp32 = p.data.float()
-
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
-
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-
-                state['step'] += 1
-                buffered = self.buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
-                else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-
-                    # more conservative since it's an approximated value
-                    if N_sma >= 5:
-                        step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    else:
-                        step_size = group['lr'] / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
-
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
-
-                # more conservative since it's an approximated value
-                if N_sma >= 5:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
-                else:
-                    p_data_fp32.add_(-step_size, exp_avg)
-
-                p.data.copy_(p_data_fp32)
+            foreach = group['foreach']
+            if foreach is None:
+                foreach = all(p.is_cuda for p in group['params'])
+            if foreach:
+                self._step_foreach(group)
+            else:
+                self._step_single(group)
 
         return loss
 
+    def _step_single(self, group):
+        beta1, beta2 = group['betas']
 
-class PlainRAdam(Optimizer):
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('RAdam does not support sparse gradients')
+            grad = p.grad.float()
+            p_data_fp32 = p.float()
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+            state = self._init_state(p, p_data_fp32)
+            exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
 
-        super(PlainRAdam, self).__init__(params, defaults)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
 
-    def __setstate__(self, state):
-        super(PlainRAdam, self).__setstate__(state)
+            state['step'] += 1
+            N_sma, step_size = self._step_coefs(group, state['step'])
 
-    def step(self, closure=None):
+            if group['weight_decay'] != 0:
+                p_data_fp32.add_(p_data_fp32, alpha=-group['weight_decay'] * group['lr'])
 
-        loss = None
-        if closure is not None:
-            loss = closure()
+            if N_sma >= 5:
+                denom = exp_avg_sq.sqrt().add_(group['eps'])
+                p_data_fp32.addcdiv_(exp_avg, denom, value=-step_size)
+            else:
+                p_data_fp32.add_(exp_avg, alpha=-step_size)
 
-        for group in self.param_groups:
+            if p_data_fp32 is not p:
+                p.copy_(p_data_fp32)
 
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
-                    raise RuntimeError('RAdam does not support sparse gradients')
+    def _step_foreach(self, group):
+        beta1, beta2 = group['betas']
 
-                p_data_fp32 = p.data.float()
+        # parameters skipped on some steps (no grad) can be at a different step
+        buckets = defaultdict(lambda: ([], [], [], [], []))
+        for p in group['params']:
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('RAdam does not support sparse gradients')
+            p_data_fp32 = p if p.dtype == torch.float32 else p.float()
 
-                state = self.state[p]
+            state = self._init_state(p, p_data_fp32)
+            state['step'] += 1
 
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
+            params, params_fp32, grads, exp_avgs, exp_avg_sqs = buckets[state['step']]
+            params.append(p)
+            params_fp32.append(p_data_fp32)
+            grads.append(p.grad.float())
+            exp_avgs.append(state['exp_avg'])
+            exp_avg_sqs.append(state['exp_avg_sq'])
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
+        for step, (params, params_fp32, grads, exp_avgs, exp_avg_sqs) in buckets.items():
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
 
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
+            N_sma, step_size = self._step_coefs(group, step)
 
-                state['step'] += 1
-                beta2_t = beta2 ** state['step']
-                N_sma_max = 2 / (1 - beta2) - 1
-                N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
+            if group['weight_decay'] != 0:
+                torch._foreach_add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * group['lr'])
 
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
+            if N_sma >= 5:
+                denom = torch._foreach_sqrt(exp_avg_sqs)
+                torch._foreach_add_(denom, group['eps'])
+                torch._foreach_addcdiv_(params_fp32, exp_avgs, denom, value=-step_size)
+            else:
+                torch._foreach_add_(params_fp32, exp_avgs, alpha=-step_size)
 
-                # more conservative since it's an approximated value
-                if N_sma >= 5:
-                    step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
-                else:
-                    step_size = group['lr'] / (1 - beta1 ** state['step'])
-                    p_data_fp32.add_(-step_size, exp_avg)
+            for p, p_data_fp32 in zip(params, params_fp32):
+                if p_data_fp32 is not p:
+                    p.copy_(p_data_fp32)
 
-                p.data.copy_(p_data_fp32)
 
-        return loss
+class RAdam(_RAdamBase):
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, foreach=None):
+        self.buffer = [[None, None, None] for ind in range(10)]
+        super(RAdam, self).__init__(params, lr=lr, betas=betas, eps=eps,
+                                    weight_decay=weight_decay, foreach=foreach)
+
+    def _step_coefs(self, group, step):
+        buffered = self.buffer[int(step % 10)]
+        if step == buffered[0]:
+            return buffered[1], buffered[2]
+        N_sma, step_size = super(RAdam, self)._step_coefs(group, step)
+        buffered[:] = [step, N_sma, step_size]
+        return N_sma, step_size
+
+
+class PlainRAdam(_RAdamBase):
+    pass
@@ -0,0 +1,35 @@
+import torch
+
+
+class PrecisionPolicy(object):
+    """autocast and gradient scaling for --precision fp32|fp16|bf16.
+
+    fp16 uses a GradScaler, bf16 runs without one. With fp32 both autocast
+    and the scaler are disabled, so the training step is unchanged.
+    """
+    dtypes = {
+        'fp32': torch.float32,
+        'fp16': torch.float16,
+        'bf16': torch.bfloat16,
+    }
+
+    def __init__(self, precision='fp32', device='cuda'):
+        if precision not in self.dtypes:
+            raise NotImplementedError
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self.dtype = self.dtypes[precision]
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=precision == 'fp16')
+
+    @property
+    def enabled(self):
+        return self.precision != 'fp32'
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
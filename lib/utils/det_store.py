@@ -0,0 +1,123 @@
+import os
+import json
+
+import numpy as np
+
+
+BASE_COLUMNS = ['pitch', 'yaw', 'roll', 'x', 'y', 'z', 'score']
+WH_COLUMNS = ['w', 'h']
+TVEC_COLUMNS = ['x_3d', 'y_3d', 'z_3d']
+
+
+def get_columns(wh=False, tvec=False):
+    """Column names of decode's output, in the order decode concatenates them."""
+    columns = list(BASE_COLUMNS)
+    if wh:
+        columns += WH_COLUMNS
+    if tvec:
+        columns += TVEC_COLUMNS
+    return columns
+
+
+def infer_columns(num_columns):
+    for wh in [False, True]:
+        for tvec in [False, True]:
+            columns = get_columns(wh, tvec)
+            if len(columns) == num_columns:
+                return columns
+    raise ValueError('Unknown detection layout with %d columns' %num_columns)
+
+
+def save_dets(path, dets, columns=None):
+    """Writes {img_id: (N, C) array} as a detection store directory.
+
+    The store holds a flat float32 table of all detections (dets.npy),
+    per-image row offsets (offsets.npy) and a meta.json with the image-id
+    index and the column schema.
+    """
+    img_ids = list(dets.keys())
+    arrays = [np.asarray(dets[img_id], dtype=np.float32) for img_id in img_ids]
+    if columns is None:
+        columns = infer_columns(arrays[0].shape[1]) if len(arrays) else list(BASE_COLUMNS)
+    arrays = [a.reshape(-1, len(columns)) for a in arrays]
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    if len(arrays):
+        table = np.concatenate(arrays, axis=0)
+    else:
+        table = np.zeros((0, len(columns)), dtype=np.float32)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'dets.npy'), table)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'img_ids': img_ids, 'columns': columns}, f)
+
+
+class DetStore(object):
+    """Read-only view of a detection store written by save_dets.
+
+    Behaves like a dict of img_id -> (N, C) float32 array. The table is
+    memory-mapped by default, so opening a store does not read detections.
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.img_ids = meta['img_ids']
+        self.columns = meta['columns']
+        self.index = {img_id: i for i, img_id in enumerate(self.img_ids)}
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.table = np.load(os.path.join(path, 'dets.npy'),
+                             mmap_mode='r' if mmap else None)
+
+    @property
+    def has_wh(self):
+        return WH_COLUMNS[0] in self.columns
+
+    @property
+    def has_tvec(self):
+        return TVEC_COLUMNS[0] in self.columns
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __contains__(self, img_id):
+        return img_id in self.index
+
+    def __iter__(self):
+        return iter(self.img_ids)
+
+    def __getitem__(self, img_id):
+        i = self.index[img_id]
+        return self.table[self.offsets[i]:self.offsets[i + 1]]
+
+    def keys(self):
+        return list(self.img_ids)
+
+    def items(self):
+        for img_id in self.img_ids:
+            yield img_id, self[img_id]
+
+
+def load_dets(path, mmap=True):
+    """Opens a detection store, falling back to the legacy <path>.json dump."""
+    if os.path.isdir(path):
+        return DetStore(path, mmap=mmap)
+    json_path = path if path.endswith('.json') else path + '.json'
+    with open(json_path, 'r') as f:
+        dets = json.load(f)
+    return {img_id: np.array(det, dtype=np.float32) for img_id, det in dets.items()}
+
+
+def json_to_det_store(json_path, path, columns=None):
+    with open(json_path, 'r') as f:
+        dets = json.load(f)
+    save_dets(path, dets, columns=columns)
+
+
+def det_store_to_json(path, json_path):
+    store = DetStore(path, mmap=True)
+    with open(json_path, 'w') as f:
+        json.dump({img_id: det.tolist() for img_id, det in store.items()}, f)
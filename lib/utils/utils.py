@@ -1,9 +1,12 @@
 import random
 import math
+import resource
+from collections import OrderedDict
 from PIL import Image
 import numpy as np
 
 import torch
+import torch.distributed as dist
 
 
 def str2bool(v):
@@ -37,6 +40,68 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class MetricMeter(object):
+    """Running averages of several scalar losses, summed on their device.
+
+    update() never synchronizes with the device; the sums are copied to the
+    host only when avg() is called. device is where the sums live, which
+    synchronize() needs on a process that never called update() (NCCL
+    only reduces CUDA tensors).
+    """
+    def __init__(self, names, device='cpu'):
+        self.names = list(names)
+        self.device = torch.device(device)
+        self.reset()
+
+    def reset(self):
+        self.sum = None
+        self.count = 0
+
+    def update(self, vals, n=1):
+        val = torch.stack([torch.as_tensor(vals[name]).detach().float().reshape(()) for name in self.names])
+        if self.sum is None:
+            self.sum = val * n
+        else:
+            self.sum += val * n
+        self.count += n
+
+    def synchronize(self):
+        """Sums the running totals over all distributed processes; every
+        process has to call it."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        if self.sum is None:
+            self.sum = torch.zeros(len(self.names), device=self.device)
+        total = torch.cat([self.sum, self.sum.new_tensor([self.count])])
+        dist.all_reduce(total)
+        self.sum = total[:-1]
+        self.count = int(total[-1].item())
+
+    def state_dict(self):
+        return {'sum': None if self.sum is None else self.sum.cpu(), 'count': self.count}
+
+    def load_state_dict(self, state, device='cpu'):
+        self.sum = None if state['sum'] is None else state['sum'].to(device)
+        self.count = state['count']
+
+    def avg(self):
+        if self.sum is None:
+            return OrderedDict((name, 0.) for name in self.names)
+        return OrderedDict(zip(self.names, (self.sum / self.count).tolist()))
+
+
+def reset_peak_memory(device='cuda'):
+    if torch.device(device).type == 'cuda' and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device='cuda'):
+    """Peak allocated CUDA memory, or the process max RSS on CPU."""
+    if torch.device(device).type == 'cuda' and torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
 def convert_str_to_labels(s, names=['model_type', 'pitch', 'yaw', 'roll', 'x', 'y', 'z']):
     labels = []
     for l in np.array(s.split()).reshape([-1, 7]):
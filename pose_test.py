@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -44,6 +43,7 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.utils.det_store import load_dets
 
 
 def parse_args():
@@ -81,8 +81,7 @@ def main():
     mask_paths = np.array('inputs/test_masks/' + df['ImageId'].values + '.jpg')
     labels = np.array([convert_str_to_labels(s, names=['yaw', 'pitch', 'roll',
                        'x', 'y', 'z', 'score']) for s in df['PredictionString']])
-    with open('outputs/decoded/test/%s.json' %args.det_name, 'r') as f:
-        dets = json.load(f)
+    dets = load_dets('outputs/decoded/test/%s' %args.det_name)
 
     if config['rot'] == 'eular':
         num_outputs = 3
@@ -28,6 +28,7 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import WeightedRandomSampler
+from torch.nn.parallel import DistributedDataParallel
 import torch.backends.cudnn as cudnn
 import torchvision
 
@@ -41,6 +42,13 @@ from lib.utils.utils import *
 from lib.models.model_factory import get_pose_model
 from lib.optimizers import RAdam
 from lib.decodes import decode
+from lib.precision import PrecisionPolicy
+from lib.checkpoint_manager import CheckpointManager, get_rng_state, set_rng_state
+from lib.data_pipeline import build_loader, DevicePrefetcher, ResumableSampler, SeededDataset
+from lib.distributed import init_distributed, setup_print, get_device, is_main_process, cleanup
+from lib.distributed import all_gather_objects, shard_dataset
+from lib.accumulation import micro_batches, no_sync, estimate_micro_batch_size
+from lib.fold_scheduler import run_folds
 
 
 def parse_args():
@@ -52,6 +60,10 @@ def parse_args():
                         help='number of total epochs to run')
     parser.add_argument('-b', '--batch_size', default=32, type=int,
                         metavar='N', help='mini-batch size (default: 32)')
+    parser.add_argument('--micro_batch_size', default=0, type=int,
+                        help='accumulate gradients over micro-batches of this size (0: whole batch)')
+    parser.add_argument('--memory_budget', default=0, type=float,
+                        help='set micro_batch_size from a memory budget in MB (0: disabled)')
 
     # model
     parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
@@ -60,6 +72,7 @@ def parse_args():
     parser.add_argument('--input_h', default=224, type=int)
     parser.add_argument('--freeze_bn', default=False, type=str2bool)
     parser.add_argument('--rot', default='trig', choices=['eular', 'trig', 'quat'])
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'])
 
     # loss
     parser.add_argument('--loss', default='L1Loss')
@@ -88,6 +101,14 @@ def parse_args():
     # dataset
     parser.add_argument('--cv', default=False, type=str2bool)
     parser.add_argument('--n_splits', default=5, type=int)
+    parser.add_argument('--fold_workers', default=0, type=int,
+                        help='train folds in N parallel worker processes (0: one after another)')
+    parser.add_argument('--fold_devices', default=None,
+                        help='comma separated CUDA devices given to the fold workers in turn')
+    parser.add_argument('--fold_threads', default=0, type=int,
+                        help='CPU threads per fold worker (0: no limit)')
+    parser.add_argument('--fold', default=None, type=int,
+                        help='train only this fold, set by the fold scheduler')
 
     # augmentation
     parser.add_argument('--hflip', default=False, type=str2bool)
@@ -114,87 +135,195 @@ def parse_args():
     parser.add_argument('--clahe', default=False, type=str2bool)
     parser.add_argument('--clahe_p', default=0.5, type=float)
 
+    parser.add_argument('--log_interval', default=20, type=int,
+                        help='read losses back from the device every N steps')
     parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--pin_memory', default=True, type=str2bool)
+    parser.add_argument('--persistent_workers', default=True, type=str2bool)
+    parser.add_argument('--prefetch_factor', default=2, type=int,
+                        help='batches loaded ahead by each worker')
+    parser.add_argument('--prefetch_depth', default=2, type=int,
+                        help='batches copied to the device ahead of the loop (0: disabled)')
+
+    # distributed (start with torchrun, batch_size is per process)
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
+    parser.add_argument('--dist_backend', default=None,
+                        help='torch.distributed backend (default: nccl on cuda, gloo on cpu)')
     parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--save_interval', default=1, type=int,
+                        help='save the checkpoint every N epochs (and after the last one)')
+    parser.add_argument('--keep_checkpoints', default=1, type=int,
+                        help='number of epoch checkpoints kept')
+    parser.add_argument('--async_checkpoint', default=True, type=str2bool,
+                        help='write checkpoints in a background thread')
+    parser.add_argument('--checkpoint_steps', default=0, type=int,
+                        help='also save the checkpoint every N steps within an epoch (0: disabled)')
+    parser.add_argument('--seed', default=41, type=int,
+                        help='seed of the training sample order and augmentation')
 
     args = parser.parse_args()
 
     return args
 
 
-def train(config, train_loader, model, criterion, optimizer, epoch):
-    avg_meter = AverageMeter()
+def get_checkpoint_path(config):
+    if config['fold'] is None:
+        return 'models/pose/%s/checkpoint.pth.tar' % config['name']
+    return 'models/pose/%s/checkpoint_%d.pth.tar' % (config['name'], config['fold'])
 
-    model.train()
 
-    pbar = tqdm(total=len(train_loader))
-    for i, (input, target) in enumerate(train_loader):
-        input = input.cuda()
-        target = target.cuda()
+def fold_done(config, fold):
+    path = 'models/pose/%s/log_%d.csv' % (config['name'], fold)
+    return os.path.exists(path) and len(pd.read_csv(path)) >= config['epochs']
+
 
-        output = model(input)
+def write_results(config, n_folds):
+    """Collects results.csv from the log_%d.csv of every trained fold."""
+    folds = []
+    best_losses = []
+    for fold in range(1, n_folds + 1):
+        path = 'models/pose/%s/log_%d.csv' % (config['name'], fold)
+        if not os.path.exists(path):
+            continue
+        log = pd.read_csv(path)
+        folds.append(str(fold))
+        best_losses.append(log['val_loss'].min())
 
-        loss = criterion(output, target.float())
+    results = pd.DataFrame({
+        'fold': folds + ['mean'],
+        'best_loss': best_losses + [np.mean(best_losses)],
+    })
 
-        # compute gradient and do optimizing step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+    print(results)
+    results.to_csv('models/pose/%s/results.csv' % config['name'], index=False)
+
+
+def train(config, train_loader, model, criterion, optimizer, epoch, precision=None, device='cuda',
+          start_step=0, meter_state=None, step_callback=None):
+    meter = MetricMeter(['loss'], device)
+    if meter_state is not None:
+        meter.load_state_dict(meter_state, device)
+
+    if precision is None:
+        precision = PrecisionPolicy('fp32')
+    scaler = precision.scaler
+
+    model.train()
 
-        avg_meter.update(loss.item(), input.size(0))
-        postfix = OrderedDict([('loss', avg_meter.avg)])
-        pbar.set_postfix(postfix)
+    reset_peak_memory(device)
+    start_time = time.time()
+    pbar = tqdm(total=len(train_loader), initial=start_step, disable=not is_main_process())
+    for i, (input, target) in enumerate(train_loader, start_step):
+        # i batches of the epoch are done
+        if step_callback is not None and i > start_step:
+            step_callback(i, meter)
+
+        input = input.to(device)
+        target = target.to(device)
+
+        # the criterion averages over its micro-batch, weighting by the micro-batch
+        # share makes the micro-batch losses add up to the batch loss
+        optimizer.zero_grad()
+        chunks = micro_batches(input.size(0), config['micro_batch_size'])
+        loss = 0
+        for j, chunk in enumerate(chunks):
+            with no_sync(model, j < len(chunks) - 1):
+                with precision.autocast():
+                    output = model(input[chunk])
+
+                micro_loss = criterion(output.float(), target[chunk].float()) * (output.size(0) / input.size(0))
+                # compute gradient
+                scaler.scale(micro_loss).backward()
+            loss += micro_loss.detach()
+
+        # optimizing step
+        scaler.step(optimizer)
+        scaler.update()
+
+        meter.update({'loss': loss}, input.size(0))
+        if (i + 1) % config['log_interval'] == 0:
+            pbar.set_postfix(meter.avg())
         pbar.update(1)
+    meter.synchronize()
+    avg = meter.avg()
+    pbar.set_postfix(avg)
     pbar.close()
 
-    return avg_meter.avg
+    step_time = (time.time() - start_time) / max(len(train_loader) - start_step, 1)
+    print('%s - step_time %.3fs - peak_mem %.0fMB' % (precision.precision, step_time, peak_memory_mb(device)))
+    if isinstance(train_loader, DevicePrefetcher):
+        print('input - queue_depth %.1f - stall %.1fs - worker_wait %.1fs - copy %.1fs'
+              % tuple(train_loader.stats().values()))
 
+    return avg['loss']
 
-def validate(config, val_loader, model, criterion):
-    avg_meters = {'loss': AverageMeter()}
+
+def validate(config, val_loader, model, criterion, precision=None, device='cuda'):
+    meter = MetricMeter(['loss'], device)
+
+    if precision is None:
+        precision = PrecisionPolicy('fp32')
 
     # switch to evaluate mode
     model.eval()
 
     with torch.no_grad():
-        pbar = tqdm(total=len(val_loader))
+        pbar = tqdm(total=len(val_loader), disable=not is_main_process())
         for i, (input, target) in enumerate(val_loader):
-            input = input.cuda()
-            target = target.cuda()
+            input = input.to(device)
+            target = target.to(device)
 
-            output = model(input)
+            with precision.autocast():
+                output = model(input)
 
             loss = 0
             losses = {}
-            loss = criterion(output, target.float())
+            loss = criterion(output.float(), target.float())
             losses['loss'] = loss
 
-            avg_meters['loss'].update(losses['loss'].item(), input.size(0))
-            postfix = OrderedDict([('loss', avg_meters['loss'].avg)])
-            pbar.set_postfix(postfix)
+            meter.update(losses, input.size(0))
+            if (i + 1) % config['log_interval'] == 0:
+                pbar.set_postfix(meter.avg())
             pbar.update(1)
 
+        meter.synchronize()
+        avg = meter.avg()
+        pbar.set_postfix(avg)
         pbar.close()
 
-    return avg_meters['loss'].avg
+    return avg['loss']
 
 
 def main():
     config = vars(parse_args())
 
-    if config['name'] is None:
-        config['name'] = '%s_%s' % (config['arch'], datetime.now().strftime('%m%d%H'))
-
-    if not os.path.exists('models/pose/%s' % config['name']):
-        os.makedirs('models/pose/%s' % config['name'])
+    rank, world_size, local_rank = init_distributed(config['dist_backend'])
+    setup_print(is_main_process())
 
-    if config['resume']:
+    if config['fold'] is not None:
+        # fold worker started by the scheduler, the settings come from config.yml
+        fold = config['fold']
         with open('models/pose/%s/config.yml' % config['name'], 'r') as f:
             config = yaml.load(f, Loader=yaml.FullLoader)
-        config['resume'] = True
+        config['fold'] = fold
+        config['resume'] = os.path.exists(get_checkpoint_path(config))
+        if config['fold_threads'] > 0:
+            torch.set_num_threads(config['fold_threads'])
+    else:
+        if config['name'] is None:
+            config['name'] = '%s_%s' % (config['arch'], datetime.now().strftime('%m%d%H'))
+
+        if not os.path.exists('models/pose/%s' % config['name']):
+            os.makedirs('models/pose/%s' % config['name'])
 
-    with open('models/pose/%s/config.yml' % config['name'], 'w') as f:
-        yaml.dump(config, f)
+        if config['resume']:
+            with open('models/pose/%s/config.yml' % config['name'], 'r') as f:
+                config = yaml.load(f, Loader=yaml.FullLoader)
+            config['resume'] = True
+
+        if is_main_process():
+            with open('models/pose/%s/config.yml' % config['name'], 'w') as f:
+                yaml.dump(config, f)
 
     print('-'*20)
     for key in config.keys():
@@ -203,13 +332,30 @@ def main():
 
     cudnn.benchmark = True
 
+    device = get_device(config['device'], local_rank)
+
+    if config['fold_workers'] > 0 and config['fold'] is None:
+        n_folds = config['n_splits'] if config['cv'] else 1
+        folds = [fold for fold in range(1, n_folds + 1) if not fold_done(config, fold)]
+        returncodes = run_folds(os.path.abspath(__file__), config['name'], folds,
+                                config['fold_workers'],
+                                devices=config['fold_devices'].split(',') if config['fold_devices'] else None,
+                                num_threads=config['fold_threads'],
+                                out_dir='models/pose/%s' % config['name'])
+        write_results(config, n_folds)
+
+        failed = [str(fold) for fold, code in returncodes.items() if code != 0]
+        if failed:
+            print('=> failed folds: %s, run again with --resume to continue them' % ', '.join(failed))
+        return
+
     df = pd.read_csv('inputs/train.csv')
     img_ids = df['ImageId'].values
     pose_df = pd.read_csv('processed/pose_train.csv')
     pose_df['img_path'] = 'processed/pose_images/train/' + pose_df['img_path']
 
     if config['resume']:
-        checkpoint = torch.load('models/pose/%s/checkpoint.pth.tar' % config['name'])
+        checkpoint = torch.load(get_checkpoint_path(config), weights_only=False)
 
     if config['rot'] == 'eular':
         num_outputs = 3
@@ -221,9 +367,9 @@ def main():
         raise NotImplementedError
 
     if config['loss'] == 'L1Loss':
-        criterion = nn.L1Loss().cuda()
+        criterion = nn.L1Loss().to(device)
     elif config['loss'] == 'MSELoss':
-        criterion = nn.MSELoss().cuda()
+        criterion = nn.MSELoss().to(device)
     else:
         raise NotImplementedError
 
@@ -274,6 +420,9 @@ def main():
 
     kf = KFold(n_splits=config['n_splits'], shuffle=True, random_state=41)
     for fold, (train_idx, val_idx) in enumerate(kf.split(img_ids)):
+        if config['fold'] is not None and fold + 1 != config['fold']:
+            continue
+
         print('Fold [%d/%d]' %(fold + 1, config['n_splits']))
 
         if (config['resume'] and fold < checkpoint['fold'] - 1) or (not config['resume'] and os.path.exists('pose_models/%s/model_%d.pth' % (config['name'], fold+1))):
@@ -367,32 +516,59 @@ def main():
             train_labels,
             transform=train_transform,
         )
-        train_loader = torch.utils.data.DataLoader(
-            train_set,
+        train_sampler = ResumableSampler(train_set, num_replicas=world_size, rank=rank, seed=config['seed'])
+        train_loader = build_loader(
+            SeededDataset(train_set),
             batch_size=config['batch_size'],
-            shuffle=True,
+            sampler=train_sampler,
             num_workers=config['num_workers'],
-            # pin_memory=True,
+            pin_memory=config['pin_memory'],
+            persistent_workers=config['persistent_workers'],
+            prefetch_factor=config['prefetch_factor'],
         )
+        if config['prefetch_depth'] > 0:
+            train_loader = DevicePrefetcher(train_loader, device, config['prefetch_depth'])
 
         val_set = PoseDataset(
             val_img_paths,
             val_labels,
             transform=val_transform,
         )
-        val_loader = torch.utils.data.DataLoader(
-            val_set,
+        val_loader = build_loader(
+            shard_dataset(val_set, rank, world_size),
             batch_size=config['batch_size'],
             shuffle=False,
             num_workers=config['num_workers'],
-            # pin_memory=True,
+            pin_memory=config['pin_memory'],
+            persistent_workers=config['persistent_workers'],
+            prefetch_factor=config['prefetch_factor'],
         )
+        if config['prefetch_depth'] > 0:
+            val_loader = DevicePrefetcher(val_loader, device, config['prefetch_depth'])
 
         # create model
         model = get_pose_model(config['arch'],
                           num_outputs=num_outputs,
                           freeze_bn=config['freeze_bn'])
-        model = model.cuda()
+        model = model.to(device)
+
+        if config['memory_budget'] > 0:
+            def probe(model, n):
+                input = torch.stack([train_set[k % len(train_set)][0] for k in range(n)]).to(device)
+                with PrecisionPolicy(config['precision'], device.type).autocast():
+                    output = model(input)
+                output.float().mean().backward()
+
+            micro_batch_size = estimate_micro_batch_size(model, probe, config['batch_size'],
+                                                         config['memory_budget'], device)
+            # the same number of micro-batches on every process
+            config['micro_batch_size'] = min(all_gather_objects(micro_batch_size))
+            print('=> micro_batch_size %d for a %.0fMB budget' % (config['micro_batch_size'], config['memory_budget']))
+
+        # model stays unwrapped for state_dicts, net runs the forward passes
+        net = model
+        if world_size > 1:
+            net = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
 
         params = filter(lambda p: p.requires_grad, model.parameters())
         if config['optimizer'] == 'Adam':
@@ -428,23 +604,77 @@ def main():
         best_loss = float('inf')
         # best_score = float('inf')
 
+        precision = PrecisionPolicy(config['precision'], device.type)
+
         start_epoch = 0
+        start_step = 0
+        meter_state = None
+
+        checkpoints = None
+        if is_main_process():
+            checkpoints = CheckpointManager(
+                get_checkpoint_path(config),
+                keep_last=config['keep_checkpoints'],
+                history_fmt='models/pose/%s/checkpoint_%d.epoch%%d.pth.tar' % (config['name'], fold+1),
+                async_save=config['async_checkpoint'])
 
         if config['resume'] and fold == checkpoint['fold'] - 1:
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
             start_epoch = checkpoint['epoch']
-            log = pd.read_csv('models/pose/%s/log_%d.csv' % (config['name'], fold+1)).to_dict(orient='list')
+            # no log yet when interrupted during the first epoch
+            if os.path.exists('models/pose/%s/log_%d.csv' % (config['name'], fold+1)):
+                log = pd.read_csv('models/pose/%s/log_%d.csv' % (config['name'], fold+1)).to_dict(orient='list')
+                # epochs logged after the last saved checkpoint are trained again
+                log = {k: v[:start_epoch] for k, v in log.items()}
             best_loss = checkpoint['best_loss']
+            if 'scaler' in checkpoint:
+                precision.load_state_dict(checkpoint['scaler'])
+            if checkpoint.get('step', 0) > 0:
+                # continue the interrupted epoch after its last saved step
+                start_step = checkpoint['step']
+                train_sampler.load_state_dict(checkpoint['sampler'])
+                meter_state = checkpoint['meter'][rank % len(checkpoint['meter'])]
+                set_rng_state(checkpoint['rng'][rank % len(checkpoint['rng'])])
+                print('=> resuming epoch %d at step %d' % (start_epoch + 1, start_step))
+
+        def save_step(step, meter):
+            if config['checkpoint_steps'] <= 0 or step % config['checkpoint_steps'] != 0:
+                return
+            # every process contributes its own meter and RNG states
+            meter_states = all_gather_objects(meter.state_dict())
+            rng_states = all_gather_objects(get_rng_state())
+            if not is_main_process():
+                return
+            state = {
+                'fold': fold + 1,
+                'epoch': train_sampler.epoch,
+                'step': step,
+                'state_dict': model.state_dict(),
+                'best_loss': best_loss,
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'scaler': precision.state_dict(),
+                'sampler': train_sampler.state_dict(step * config['batch_size']),
+                'meter': meter_states,
+                'rng': rng_states,
+            }
+            checkpoints.save(state)
 
         for epoch in range(start_epoch, config['epochs']):
             print('Epoch [%d/%d]' % (epoch + 1, config['epochs']))
 
+            train_sampler.set_epoch(epoch)
+
             # train for one epoch
-            train_loss = train(config, train_loader, model, criterion, optimizer, epoch)
+            train_loss = train(config, train_loader, net, criterion, optimizer, epoch, precision=precision,
+                               device=device, start_step=start_step, meter_state=meter_state,
+                               step_callback=save_step)
+            start_step = 0
+            meter_state = None
             # evaluate on validation set
-            val_loss = validate(config, val_loader, model, criterion)
+            val_loss = validate(config, val_loader, net, criterion, precision=precision, device=device)
 
             if config['scheduler'] == 'CosineAnnealingLR':
                 scheduler.step()
@@ -461,23 +691,33 @@ def main():
             log['val_loss'].append(val_loss)
             # log['val_score'].append(val_score)
 
-            pd.DataFrame(log).to_csv('models/pose/%s/log_%d.csv' % (config['name'], fold+1), index=False)
+            stall = 0
+            if is_main_process():
+                stall += checkpoints.save_log(pd.DataFrame(log), 'models/pose/%s/log_%d.csv' % (config['name'], fold+1))
 
             if val_loss < best_loss:
-                torch.save(model.state_dict(), 'models/pose/%s/model_%d.pth' % (config['name'], fold+1))
+                if is_main_process():
+                    stall += checkpoints.save_best(model.state_dict(), 'models/pose/%s/model_%d.pth' % (config['name'], fold+1))
                 best_loss = val_loss
                 # best_score = val_score
                 print("=> saved best model")
 
-            state = {
-                'fold': fold + 1,
-                'epoch': epoch + 1,
-                'state_dict': model.state_dict(),
-                'best_loss': best_loss,
-                'optimizer': optimizer.state_dict(),
-                'scheduler': scheduler.state_dict(),
-            }
-            torch.save(state, 'models/pose/%s/checkpoint.pth.tar' % config['name'])
+            if (epoch + 1) % config['save_interval'] == 0 or epoch + 1 == config['epochs']:
+                state = {
+                    'fold': fold + 1,
+                    'epoch': epoch + 1,
+                    'state_dict': model.state_dict(),
+                    'best_loss': best_loss,
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'scaler': precision.state_dict(),
+                }
+                if is_main_process():
+                    stall += checkpoints.save(state, epoch + 1)
+            print('checkpoint stall %.3fs' % stall)
+
+        if checkpoints is not None:
+            checkpoints.close()
 
         print('val_loss:  %f' % best_loss)
         # print('val_score: %f' % best_score)
@@ -493,7 +733,9 @@ def main():
         })
 
         print(results)
-        results.to_csv('models/pose/%s/results.csv' % config['name'], index=False)
+        # fold workers leave results.csv to the scheduler
+        if config['fold'] is None and is_main_process():
+            results.to_csv('models/pose/%s/results.csv' % config['name'], index=False)
 
         del model
         torch.cuda.empty_cache()
@@ -505,6 +747,8 @@ def main():
         if not config['cv']:
             break
 
+    cleanup()
+
 
 if __name__ == '__main__':
     main()
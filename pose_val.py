@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -44,6 +43,7 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.utils.det_store import load_dets
 
 
 def parse_args():
@@ -79,8 +79,7 @@ def main():
     img_paths = np.array('inputs/train_images/' + df['ImageId'].values + '.jpg')
     mask_paths = np.array('inputs/train_masks/' + df['ImageId'].values + '.jpg')
     labels = np.array([convert_str_to_labels(s) for s in df['PredictionString']])
-    with open('outputs/decoded/val/%s.json' %args.det_name, 'r') as f:
-        dets = json.load(f)
+    dets = load_dets('outputs/decoded/val/%s' %args.det_name)
 
     if config['rot'] == 'eular':
         num_outputs = 3
@@ -0,0 +1,89 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from lib.utils.utils import *
+from lib.utils.nms import nms
+from lib.utils.det_store import load_dets
+from lib.evaluation import pair_distances, greedy_match, compute_map
+from lib.evaluation import THRES_RO_LIST, THRES_TR_LIST
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--name', default=None)
+    parser.add_argument('--score_ths', default='0.05,0.1,0.15,0.2,0.25,0.3')
+    parser.add_argument('--nms_ths', default='none,0.05,0.1,0.2,0.5,1.0',
+                        help='comma separated NMS distance thresholds (none: no NMS)')
+    parser.add_argument('--n_jobs', default=-1, type=int)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def sweep_nms_th(dets, gts, nms_th, score_ths):
+    """Evaluates every score threshold for one NMS threshold.
+
+    Detections of each image are sorted by score once, so thresholding keeps
+    a prefix of the rows and the distance matrices are computed only once.
+    """
+    matches = []
+    for img_id, det in dets.items():
+        if nms_th is not None:
+            det = nms(det, dist_th=nms_th)
+        det, tr_dists, ro_dists = pair_distances(det[:, :7], gts[img_id])
+        matches.append((det[:, 6], tr_dists, ro_dists, len(gts[img_id])))
+
+    results = []
+    for score_th in score_ths:
+        result_flgs = [[] for _ in THRES_RO_LIST]
+        scores = [[] for _ in THRES_RO_LIST]
+        n_gt = 0
+        for score, tr_dists, ro_dists, n in matches:
+            k = int(np.sum(score > score_th))
+            # eval.py drops images without predictions, GT included
+            if k == 0:
+                continue
+            n_gt += n
+            for i, (thre_ro_dist, thre_tr_dist) in enumerate(zip(THRES_RO_LIST, THRES_TR_LIST)):
+                result_flgs[i].extend(greedy_match(tr_dists[:k], ro_dists[:k], thre_tr_dist, thre_ro_dist))
+                scores[i].extend(score[:k].tolist())
+        results.append({
+            'score_th': score_th,
+            'nms_th': nms_th,
+            'map': compute_map(result_flgs, scores, n_gt),
+        })
+
+    return results
+
+
+def main():
+    args = parse_args()
+
+    score_ths = [float(s) for s in args.score_ths.split(',')]
+    nms_ths = [None if s == 'none' else float(s) for s in args.nms_ths.split(',')]
+
+    dets = load_dets('outputs/decoded/val/%s' %args.name)
+    dets = {img_id: np.array(det, dtype=np.float64) for img_id, det in dets.items()}
+
+    df = pd.read_csv('inputs/train.csv')
+    df = df[df.ImageId.isin(dets.keys())]
+    gts = {img_id: np.array(s.split(), dtype=np.float64).reshape([-1, 7])
+           for img_id, s in zip(df['ImageId'], df['PredictionString'])}
+
+    results = Parallel(n_jobs=args.n_jobs)(
+        delayed(sweep_nms_th)(dets, gts, nms_th, score_ths) for nms_th in nms_ths)
+    results = pd.DataFrame([r for rs in results for r in rs])
+    print(results.sort_values('map', ascending=False).to_string(index=False))
+
+    os.makedirs('outputs/sweeps/val', exist_ok=True)
+    results.to_csv('outputs/sweeps/val/%s.csv' %args.name, index=False)
+
+
+if __name__ == '__main__':
+    main()
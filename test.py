@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -39,6 +38,8 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.precision import PrecisionPolicy
+from lib.utils.det_store import save_dets, get_columns
 
 
 def parse_args():
@@ -50,6 +51,8 @@ def parse_args():
     parser.add_argument('--nms_th', default=0.1, type=float)
     parser.add_argument('--min_samples', default=1, type=int)
     parser.add_argument('--hflip', default=False, type=str2bool)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--channels_last', default=False, type=str2bool)
     parser.add_argument('--uncropped', action='store_true')
     parser.add_argument('--show', action='store_true')
 
@@ -73,6 +76,8 @@ def main():
 
     cudnn.benchmark = False
 
+    precision = PrecisionPolicy(args.precision)
+
     df = pd.read_csv('inputs/sample_submission.csv')
     img_ids = df['ImageId'].values
     img_paths = np.array('inputs/test_images/' + df['ImageId'].values + '.jpg')
@@ -164,6 +169,8 @@ def main():
                               gn=config['gn'], ws=config['ws'],
                               freeze_bn=config['freeze_bn'])
             model = model.cuda()
+            if args.channels_last:
+                model = model.to(memory_format=torch.channels_last)
 
             model_path = 'models/detection/%s/model_%d.pth' % (config['name'], fold+1)
             if not os.path.exists(model_path):
@@ -179,13 +186,19 @@ def main():
                 pbar = tqdm(total=len(test_loader))
                 for i, batch in enumerate(test_loader):
                     input = batch['input'].cuda()
+                    if args.channels_last:
+                        input = input.contiguous(memory_format=torch.channels_last)
                     mask = batch['mask'].cuda()
 
-                    output = model(input)
+                    with precision.autocast():
+                        output = model(input)
+                    output = {head: output[head].float() for head in output}
                     # print(output)
 
                     if args.hflip:
-                        output_hf = model(torch.flip(input, (-1,)))
+                        with precision.autocast():
+                            output_hf = model(torch.flip(input, (-1,)))
+                        output_hf = {head: output_hf[head].float() for head in output_hf}
                         output_hf['hm'] = torch.flip(output_hf['hm'], (-1,))
                         output_hf['reg'] = torch.flip(output_hf['reg'], (-1,))
                         output_hf['reg'][:, 0] = 1 - output_hf['reg'][:, 0]
@@ -352,7 +365,7 @@ def main():
         )
         det = det.numpy()[0]
 
-        dets[img_id] = det.tolist()
+        dets[img_id] = det
 
         if args.nms:
             det = nms(det, dist_th=args.nms_th)
@@ -370,8 +383,8 @@ def main():
 
         df.loc[i, 'PredictionString'] = convert_labels_to_str(det[:, :7])
 
-    with open('outputs/decoded/test/%s.json' %name, 'w') as f:
-        json.dump(dets, f)
+    save_dets('outputs/decoded/test/%s' %name, dets,
+              columns=get_columns(wh=config['wh'], tvec=config['tvec']))
 
     name = '%s_%.2f' %(args.name, args.score_th)
     if args.uncropped:
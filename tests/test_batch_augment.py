@@ -0,0 +1,112 @@
+import os
+import sys
+from unittest import mock
+
+import numpy as np
+import cv2
+import pytest
+
+import torch
+
+from albumentations.augmentations import transforms
+from albumentations.core.composition import Compose, KeypointParams
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.datasets import Dataset
+from lib.batch_augment import BatchAugment
+
+
+NUM_IMAGES = 6
+TARGETS = ['hm', 'reg_mask', 'reg', 'wh', 'depth', 'tvec', 'eular', 'trig', 'quat', 'gt', 'ind', 'ind_mask']
+
+
+@pytest.fixture(scope='module')
+def train_data(tmp_path_factory):
+    """Random images of the competition size with random cars in view."""
+    tmp_dir = tmp_path_factory.mktemp('images')
+    rng = np.random.RandomState(41)
+    img_paths, mask_paths, labels = [], [], []
+    for i in range(NUM_IMAGES):
+        img = cv2.resize(rng.randint(0, 256, (68, 85, 3)).astype('uint8'), (3384, 2710))
+        img_paths.append(str(tmp_dir / ('%d.jpg' % i)))
+        cv2.imwrite(img_paths[-1], img)
+        mask_paths.append(str(tmp_dir / ('mask_%d.jpg' % i)))
+        labels.append([{
+            'model_type': 0,
+            'pitch': rng.uniform(-np.pi, np.pi),
+            'yaw': rng.uniform(-0.2, 0.2),
+            'roll': np.pi + rng.uniform(-0.1, 0.1),
+            'x': rng.uniform(-15, 15),
+            'y': rng.uniform(4, 10),
+            'z': rng.uniform(8, 60),
+        } for _ in range(10)])
+    return img_paths, mask_paths, labels
+
+
+def get_params():
+    rng = np.random.RandomState(0)
+    n = NUM_IMAGES
+    return {
+        'flip': np.arange(n) % 2 == 1,
+        'scale': np.where(np.arange(n) % 3 > 0, rng.uniform(0.9, 1.1, n), 1.0),
+        # ShiftScaleRotate draws dx and dy from the same fixed range here
+        'shift': np.repeat(np.where(np.arange(n) < 2, 0, rng.uniform(-0.1, 0.1, n))[:, None], 2, 1),
+        'color': np.full(n, -1),
+        'color_args': np.zeros((n, 3)),
+    }
+
+
+def per_sample(train_data, params, i, **kwargs):
+    """Dataset[i] with the flip, scale and shift of params forced through
+    its random draws."""
+    img_paths, mask_paths, labels = train_data
+    shift = params['shift'][i, 0]
+    transform = Compose([
+        transforms.ShiftScaleRotate(shift_limit=(shift, shift), scale_limit=0, rotate_limit=0,
+                                    border_mode=cv2.BORDER_CONSTANT, value=0, p=float(shift != 0)),
+    ], keypoint_params=KeypointParams(format='xy', remove_invisible=False))
+    dataset = Dataset(img_paths, mask_paths, labels, transform=transform,
+                      hflip=float(params['flip'][i]), scale=float(params['scale'][i] != 1),
+                      scale_limit=0.1, **kwargs)
+    with mock.patch.object(np.random, 'uniform', return_value=params['scale'][i] - 1):
+        return dataset[i]
+
+
+@pytest.mark.parametrize('lhalf', [False, True])
+def test_labels_match_per_sample(train_data, lhalf):
+    img_paths, mask_paths, labels = train_data
+    kwargs = dict(input_w=640, input_h=512, lhalf=lhalf)
+    params = get_params()
+
+    expected = torch.utils.data.default_collate([per_sample(train_data, params, i, **kwargs)
+                                                 for i in range(NUM_IMAGES)])
+
+    dataset = Dataset(img_paths, mask_paths, labels, batch_aug=True, **kwargs)
+    batch = torch.utils.data.default_collate([dataset[i] for i in range(NUM_IMAGES)])
+    batch = BatchAugment(dataset)(batch, params)
+
+    # some cars must be visible for the check to mean anything
+    assert expected['ind_mask'].sum() > 0
+    for key in TARGETS:
+        assert batch[key].shape == expected[key].shape, key
+    assert torch.equal(batch['ind'], expected['ind'])
+    assert torch.equal(batch['ind_mask'], expected['ind_mask'])
+    assert torch.equal(batch['reg_mask'], expected['reg_mask'])
+    for key in ['hm', 'reg', 'wh', 'depth', 'tvec', 'eular', 'trig', 'quat', 'gt']:
+        np.testing.assert_allclose(batch[key].numpy(), expected[key].numpy(), rtol=1e-4, atol=1e-4,
+                                   err_msg=key)
+
+    assert batch['input'].shape == expected['input'].shape
+    assert batch['mask'].shape == expected['mask'].shape
+
+
+def test_params_depend_only_on_seed(train_data):
+    img_paths, mask_paths, labels = train_data
+    dataset = Dataset(img_paths, mask_paths, labels, batch_aug=True)
+    augment = BatchAugment(dataset, hflip=0.5, scale=0.5, scale_limit=0.1, shift=0.5, shift_limit=0.1,
+                           color=[('hsv', 0.5, (20, 0, 0)), ('brightness', 0.5, 0.2), (None, 0.5, None)])
+    a = augment.sample_params([3, 5, 7])
+    b = augment.sample_params([7, 3])
+    for key in a:
+        np.testing.assert_array_equal(a[key][[2, 0]], b[key])
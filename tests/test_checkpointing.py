@@ -0,0 +1,44 @@
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.models.model_factory import get_model
+
+
+HEADS = OrderedDict([('hm', 1), ('reg', 2), ('depth', 1)])
+
+
+def train_step(arch, checkpointing, state_dict=None):
+    model = get_model(arch, heads=HEADS, head_conv=16, pretrained=False, checkpointing=checkpointing)
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    model.train()
+    torch.manual_seed(0)
+    input = torch.randn(2, 3, 128, 128)
+    output = model(input)
+    sum(o.mean() for o in output.values()).backward()
+    return model
+
+
+@pytest.mark.parametrize('arch', ['resnet18_fpn', 'dla34'])
+@pytest.mark.parametrize('checkpointing', ['backbone', 'all'])
+def test_bn_buffers_match_without_checkpointing(arch, checkpointing):
+    torch.manual_seed(41)
+    state_dict = get_model(arch, heads=HEADS, head_conv=16, pretrained=False).state_dict()
+
+    expected = train_step(arch, None, state_dict).state_dict()
+    actual = train_step(arch, checkpointing, state_dict).state_dict()
+
+    bn_buffers = [key for key in expected
+                  if key.endswith(('running_mean', 'running_var', 'num_batches_tracked'))]
+    assert bn_buffers
+    for key in bn_buffers:
+        if key.endswith('num_batches_tracked'):
+            assert actual[key].item() == 1, key
+        torch.testing.assert_close(actual[key], expected[key], msg=key)
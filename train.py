@@ -9,6 +9,8 @@ import warnings
 from datetime import datetime
 import yaml
 import gc
+import json
+import hashlib
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -28,6 +30,7 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import WeightedRandomSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 import torch.backends.cudnn as cudnn
 import torchvision
@@ -43,6 +46,18 @@ from lib.models.model_factory import get_model
 from lib.optimizers import RAdam
 from lib import losses
 from lib.decodes import decode
+from lib.evaluation import MAPMeter
+from lib.health import HealthMonitor
+from lib.precision import PrecisionPolicy
+from lib.accumulation import micro_batches, no_sync, estimate_micro_batch_size
+from lib.checkpoint_manager import CheckpointManager, get_rng_state, set_rng_state
+from lib.data_pipeline import build_loader, DevicePrefetcher, ResumableSampler, SeededDataset
+from lib.feature_cache import FeatureCache
+from lib.batch_augment import BatchAugment, BatchAugmentLoader
+from lib.image_cache import ImageCache
+from lib.fold_scheduler import run_folds
+from lib.distributed import init_distributed, setup_print, get_device, is_main_process
+from lib.distributed import convert_sync_bn, all_gather_objects, cleanup, shard_dataset
 
 
 def parse_args():
@@ -54,6 +69,10 @@ def parse_args():
                         help='number of total epochs to run')
     parser.add_argument('-b', '--batch_size', default=4, type=int,
                         metavar='N', help='mini-batch size (default: 4)')
+    parser.add_argument('--micro_batch_size', default=0, type=int,
+                        help='accumulate gradients over micro-batches of this size (0: whole batch)')
+    parser.add_argument('--memory_budget', default=0, type=float,
+                        help='set micro_batch_size from a memory budget in MB (0: disabled)')
 
     # model
     parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18_fpn',
@@ -64,19 +83,35 @@ def parse_args():
     parser.add_argument('--input_w', default=2560, type=int)
     parser.add_argument('--input_h', default=2048, type=int)
     parser.add_argument('--freeze_bn', default=False, type=str2bool)
+    parser.add_argument('--freeze_backbone', default=False, type=str2bool,
+                        help='train only the laterals, decoders and heads')
+    parser.add_argument('--feature_cache', default=False, type=str2bool,
+                        help='cache the features of the frozen backbone (implies --freeze_backbone)')
+    parser.add_argument('--feature_cache_dir', default='feature_cache')
+    parser.add_argument('--feature_cache_variants', default=4, type=int,
+                        help='augmentations kept per training image with --feature_cache, '
+                             'every epoch uses one of them')
     parser.add_argument('--rot', default='trig', choices=['eular', 'trig', 'quat'])
     parser.add_argument('--wh', default=True, type=str2bool)
     parser.add_argument('--tvec', default=True, type=str2bool)
     parser.add_argument('--gn', default=False, type=str2bool)
     parser.add_argument('--ws', default=False, type=str2bool)
     parser.add_argument('--lhalf', default=True, type=str2bool)
+    parser.add_argument('--resize_schedule', default='',
+                        help='train at reduced input sizes first, e.g. "0.5:4,0.75:4" trains 4 epochs at '
+                             'half size and 4 at 3/4 size before the full input_w x input_h')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--channels_last', default=False, type=str2bool)
+    parser.add_argument('--checkpointing', default='none',
+                        help='activation checkpointing: none, all or comma separated backbone,decoder,heads')
 
     # pseudo labeling
     parser.add_argument('--load_model', default=None)
     parser.add_argument('--pseudo_label', default=None)
 
     # loss
-    parser.add_argument('--hm_loss', default='FocalLoss')
+    parser.add_argument('--hm_loss', default='FocalLoss',
+                        help='FocalLoss, LogitFocalLoss or FusedFocalLoss (recomputes in backward)')
     parser.add_argument('--reg_loss', default='L1Loss')
     parser.add_argument('--wh_loss', default='L1Loss')
     parser.add_argument('--wh_weight', default=0.05, type=float)
@@ -111,6 +146,31 @@ def parse_args():
     # dataset
     parser.add_argument('--cv', default=True, type=str2bool)
     parser.add_argument('--n_splits', default=5, type=int)
+    parser.add_argument('--fold_workers', default=0, type=int,
+                        help='train folds in N parallel worker processes (0: one after another)')
+    parser.add_argument('--fold_devices', default=None,
+                        help='comma separated CUDA devices given to the fold workers in turn')
+    parser.add_argument('--fold_threads', default=0, type=int,
+                        help='CPU threads per fold worker (0: no limit)')
+    parser.add_argument('--fold', default=None, type=int,
+                        help='train only this fold, set by the fold scheduler')
+    parser.add_argument('--data_cache', default=None,
+                        help='pickle of the parsed train.csv shared between runs (written if missing)')
+    parser.add_argument('--image_cache', default=None,
+                        help='decoded images shared between runs, built by tune.py (lib/image_cache.py)')
+
+    # validation
+    parser.add_argument('--val_interval', default='1',
+                        help='validate every N epochs, or "N1:E1,N2": every N1 epochs for E1 epochs, '
+                             'then every N2 (the last epoch is always validated)')
+    parser.add_argument('--val_subset', default=1.0, type=float,
+                        help='fraction of the val fold (a fixed random subset) used by intermediate validations')
+    parser.add_argument('--val_full_epochs', default=0, type=int,
+                        help='validate on the full val fold in each of the last N epochs')
+    parser.add_argument('--map_interval', default=0, type=int,
+                        help='compute val mAP every N epochs (0: disabled)')
+    parser.add_argument('--map_score_th', default=0.1, type=float)
+    parser.add_argument('--best_metric', default='val_loss', choices=['val_loss', 'val_map'])
 
     # augmentation
     parser.add_argument('--hflip', default=True, type=str2bool)
@@ -136,100 +196,359 @@ def parse_args():
     parser.add_argument('--iso_noise_p', default=0.5, type=float)
     parser.add_argument('--clahe', default=False, type=str2bool)
     parser.add_argument('--clahe_p', default=0.5, type=float)
-
+    parser.add_argument('--batch_aug', default=False, type=str2bool,
+                        help='flip, scale, shift and color jitter on whole batches after collation '
+                             '(lib/batch_augment.py), the loader workers only decode')
+
+    # numerical health
+    parser.add_argument('--health', default=False, type=str2bool,
+                        help='check losses and head outputs for NaN/Inf every step')
+    parser.add_argument('--health_heads', default='hm,depth')
+    parser.add_argument('--grad_norm_interval', default=0, type=int,
+                        help='check the gradient norm every N steps (0: disabled)')
+    parser.add_argument('--anomaly_window', default=10, type=int,
+                        help='steps to run with anomaly detection after a problem')
+
+    parser.add_argument('--log_interval', default=20, type=int,
+                        help='read losses back from the device every N steps')
     parser.add_argument('--num_workers', default=4, type=int)
+    parser.add_argument('--pin_memory', default=True, type=str2bool)
+    parser.add_argument('--persistent_workers', default=True, type=str2bool)
+    parser.add_argument('--prefetch_factor', default=2, type=int,
+                        help='batches loaded ahead by each worker')
+    parser.add_argument('--prefetch_depth', default=2, type=int,
+                        help='batches copied to the device ahead of the loop (0: disabled)')
+
+    # distributed (start with torchrun, batch_size is per process)
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
+    parser.add_argument('--dist_backend', default=None,
+                        help='torch.distributed backend (default: nccl on cuda, gloo on cpu)')
+    parser.add_argument('--sync_bn', default=False, type=str2bool,
+                        help='SyncBatchNorm in the FPN laterals and decoders (cuda only)')
     parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--stop_epoch', default=0, type=int,
+                        help='stop after this epoch keeping the schedule of --epochs, continue with '
+                             '--resume and a later --stop_epoch (0: train all epochs)')
+    parser.add_argument('--save_interval', default=1, type=int,
+                        help='save the checkpoint every N epochs (and after the last one)')
+    parser.add_argument('--keep_checkpoints', default=1, type=int,
+                        help='number of epoch checkpoints kept')
+    parser.add_argument('--async_checkpoint', default=True, type=str2bool,
+                        help='write checkpoints in a background thread')
+    parser.add_argument('--checkpoint_steps', default=0, type=int,
+                        help='also save the checkpoint every N steps within an epoch (0: disabled)')
+    parser.add_argument('--seed', default=41, type=int,
+                        help='seed of the training sample order and augmentation')
 
     parser.add_argument('--log_dir', default="./logs/", type=str)
 
     args = parser.parse_args()
 
+    if args.best_metric == 'val_map' and args.map_interval <= 0:
+        parser.error('--best_metric val_map needs --map_interval > 0')
+
     return args
 
 
-def train(config, heads, train_loader, model, criterion, optimizer, epoch, writer=None):
-    avg_meters = {'loss': AverageMeter()}
-    for head in heads.keys():
-        avg_meters[head] = AverageMeter()
+def get_best(log, best_metric):
+    # subset validations only count when there was no full one
+    if 'val_mode' in log and (log['val_mode'] == 'full').any():
+        log = log[log['val_mode'] == 'full'].reset_index(drop=True)
+    if best_metric == 'val_map':
+        best_loss, best_map = log.loc[log['val_map'].fillna(-1).values.argmax(), ['val_loss', 'val_map']].values
+    else:
+        best_idx = log['val_loss'].fillna(np.inf).values.argmin()
+        best_loss = log.loc[best_idx, 'val_loss']
+        best_map = log.loc[best_idx, 'val_map'] if 'val_map' in log else np.nan
+    return best_loss, best_map
+
+
+def get_val_mode(config, epoch):
+    """'full', 'subset' or 'skip' for the validation after the epoch."""
+    if epoch + 1 == config['epochs'] or epoch >= config['epochs'] - config['val_full_epochs']:
+        return 'full'
+    stage_start = 0
+    for stage in config['val_interval'].split(','):
+        interval, _, stage_epochs = stage.partition(':')
+        if not stage_epochs or epoch < stage_start + int(stage_epochs):
+            break
+        stage_start += int(stage_epochs)
+    if (epoch + 1 - stage_start) % int(interval) != 0:
+        return 'skip'
+    return 'subset' if config['val_subset'] < 1 else 'full'
+
+
+def get_input_size(config, epoch):
+    """Training input size of the epoch under --resize_schedule."""
+    scale = 1.0
+    end = 0
+    for stage in config['resize_schedule'].split(','):
+        if not stage:
+            continue
+        stage_scale, stage_epochs = stage.split(':')
+        end += int(stage_epochs)
+        if epoch < end:
+            scale = float(stage_scale)
+            break
+    if scale == 1.0:
+        return config['input_w'], config['input_h']
+    # multiples of 64 keep the FPN levels (and the lhalf crop) aligned
+    input_w = max(int(round(config['input_w'] * scale / 64)) * 64, 64)
+    input_h = max(int(round(config['input_h'] * scale / 64)) * 64, 64)
+    return input_w, input_h
+
+
+def get_checkpoint_path(config):
+    if config['fold'] is None:
+        return 'models/detection/%s/checkpoint.pth.tar' % config['name']
+    return 'models/detection/%s/checkpoint_%d.pth.tar' % (config['name'], config['fold'])
+
+
+def get_feature_cache_path(config, fold, rank=0, world_size=1):
+    """Directory of the backbone feature cache. The settings the features
+    depend on are hashed into it, so runs differing only in the laterals,
+    decoders or heads share a cache. Every fold has its own cache: the
+    sample seeds depend on the index in the fold's train set, and the
+    capacity is sized for one fold."""
+    keys = ['arch', 'load_model', 'lhalf', 'precision', 'seed', 'feature_cache_variants',
+            'hflip', 'hflip_p', 'shift', 'shift_p', 'shift_limit', 'scale', 'scale_p', 'scale_limit',
+            'hsv', 'hsv_p', 'hue_limit', 'sat_limit', 'val_limit', 'brightness', 'brightness_p',
+            'brightness_limit', 'contrast', 'contrast_p', 'contrast_limit', 'iso_noise', 'iso_noise_p',
+            'clahe', 'clahe_p', 'batch_aug']
+    settings = {key: config[key] for key in keys}
+    digest = hashlib.md5(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+    path = os.path.join(config['feature_cache_dir'], '%s_%s' % (config['arch'], digest), 'fold%d' % (fold + 1))
+    if world_size > 1:
+        path = os.path.join(path, 'rank%d' % rank)
+    return path
+
+
+def fold_done(config, fold):
+    path = 'models/detection/%s/log_%d.csv' % (config['name'], fold)
+    return os.path.exists(path) and len(pd.read_csv(path)) >= config['epochs']
+
+
+def write_results(config, n_folds):
+    """Collects results.csv from the log_%d.csv of every trained fold."""
+    folds = []
+    best_losses = []
+    best_maps = []
+    for fold in range(1, n_folds + 1):
+        path = 'models/detection/%s/log_%d.csv' % (config['name'], fold)
+        if not os.path.exists(path):
+            continue
+        best_loss, best_map = get_best(pd.read_csv(path), config['best_metric'])
+        folds.append(str(fold))
+        best_losses.append(best_loss)
+        best_maps.append(best_map)
 
-    model.train()
+    results = pd.DataFrame({
+        'fold': folds + ['mean'],
+        'best_loss': best_losses + [np.mean(best_losses)],
+        'best_map': best_maps + [np.mean(best_maps)],
+    })
 
-    pbar = tqdm(total=len(train_loader))
-    for i, batch in enumerate(train_loader):
-        input = batch['input'].cuda()
-        mask = batch['mask'].cuda()
-        reg_mask = batch['reg_mask'].cuda()
+    print(results)
+    results.to_csv('models/detection/%s/results.csv' % config['name'], index=False)
 
-        output = model(input)
 
-        loss = 0
-        losses = {}
-        for head in heads.keys():
-            losses[head] = criterion[head](output[head], batch[head].cuda(), mask if head == 'hm' else reg_mask)
-            if head == 'wh':
-                loss += config['wh_weight'] * losses[head]
-            elif head == 'tvec':
-                loss += config['tvec_weight'] * losses[head]
-            else:
-                loss += losses[head]
-        losses['loss'] = loss
+def get_postfix(avg):
+    postfix = OrderedDict([('loss', avg['loss'])])
+    for name, val in avg.items():
+        if name != 'loss':
+            postfix[name + '_loss'] = val
+    return postfix
+
+
+def get_features(feature_cache, model, input, img_paths, seeds, precision):
+    """Backbone features of input from the cache, running the frozen
+    backbone on the samples that are not cached yet."""
+    model = getattr(model, 'module', model)
+
+    def forward_backbone(x):
+        with precision.autocast():
+            return model.forward_backbone(x)
+
+    return feature_cache.features(forward_backbone, input, img_paths, seeds)
+
+
+def train(config, heads, train_loader, model, criterion, optimizer, epoch, writer=None, health=None,
+          precision=None, device='cuda', start_step=0, meter_state=None, step_callback=None,
+          feature_cache=None):
+    meter = MetricMeter(['loss'] + list(heads.keys()), device)
+    if meter_state is not None:
+        meter.load_state_dict(meter_state, device)
+
+    if precision is None:
+        precision = PrecisionPolicy('fp32')
+    scaler = precision.scaler
+
+    model.train()
+
+    reset_peak_memory(device)
+    start_time = time.time()
+    pbar = tqdm(total=len(train_loader), initial=start_step, disable=not is_main_process())
+    for i, batch in enumerate(train_loader, start_step):
+        # i batches of the epoch are done
+        if step_callback is not None and i > start_step:
+            step_callback(i, meter)
+
+        input = batch['input'].to(device)
+        if config['channels_last']:
+            input = input.contiguous(memory_format=torch.channels_last)
+        mask = batch['mask'].to(device)
+        reg_mask = batch['reg_mask'].to(device)
+        ind = batch['ind'].to(device)
+        ind_mask = batch['ind_mask'].to(device)
+        targets = {head: batch[head].to(device) for head in heads.keys()}
+
+        # the model runs on the images or on their cached backbone features
+        x = input
+        if feature_cache is not None:
+            x = get_features(feature_cache, model, input, batch['img_path'], batch['seed'].tolist(), precision)
+
+        if health is not None:
+            health.start_step()
+
+        # with several micro-batches every loss is divided by the normalizer
+        # of the whole batch, so the micro-batch losses add up to the batch loss
+        chunks = micro_batches(input.size(0), config['micro_batch_size'])
+        normalizers = {}
+        if len(chunks) > 1:
+            for head in heads.keys():
+                normalizers[head] = criterion[head].normalizer(
+                    targets[head], mask if head == 'hm' else reg_mask, ind_mask)
 
-        # compute gradient and do optimizing step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        losses = OrderedDict()
+        finite = True
+        for j, chunk in enumerate(chunks):
+            with no_sync(model, j < len(chunks) - 1):
+                with precision.autocast():
+                    output = model(x[chunk] if torch.is_tensor(x) else [f[chunk] for f in x])
+
+                    loss = 0
+                    micro_losses = {}
+                    for head in heads.keys():
+                        kwargs = {'normalizer': normalizers[head]} if head in normalizers else {}
+                        if head == 'hm':
+                            micro_losses[head] = criterion[head](output[head], targets[head][chunk], mask[chunk],
+                                                                 **kwargs)
+                        else:
+                            micro_losses[head] = criterion[head](output[head], targets[head][chunk], reg_mask[chunk],
+                                                                 ind=ind[chunk], ind_mask=ind_mask[chunk], **kwargs)
+                        if head == 'wh':
+                            loss += config['wh_weight'] * micro_losses[head]
+                        elif head == 'tvec':
+                            loss += config['tvec_weight'] * micro_losses[head]
+                        else:
+                            loss += micro_losses[head]
+                    micro_losses['loss'] = loss
+
+                # skip the step when the losses or checked outputs are not finite
+                if health is not None and not health.check_forward(micro_losses, output):
+                    finite = False
+                    break
+
+                # compute gradient
+                scaler.scale(loss).backward()
+
+            for name, val in micro_losses.items():
+                losses[name] = losses.get(name, 0) + val.detach()
+
+        if not finite:
+            optimizer.zero_grad()
+            pbar.update(1)
+            continue
 
-        avg_meters['loss'].update(losses['loss'].item(), input.size(0))
-        postfix = OrderedDict([('loss', avg_meters['loss'].avg)])
-        for head in heads.keys():
-            avg_meters[head].update(losses[head].item(), input.size(0))
-            postfix[head + '_loss'] = avg_meters[head].avg
-        pbar.set_postfix(postfix)
+        # optimizing step
+        if health is not None:
+            scaler.unscale_(optimizer)
+        if health is None or health.check_grads(model, scaler):
+            scaler.step(optimizer)
+        scaler.update()
+
+        meter.update(losses, input.size(0))
+        if (i + 1) % config['log_interval'] == 0:
+            pbar.set_postfix(get_postfix(meter.avg()))
         pbar.update(1)
+    meter.synchronize()
+    avg = meter.avg()
+    postfix = get_postfix(avg)
+    pbar.set_postfix(postfix)
     pbar.close()
 
+    step_time = (time.time() - start_time) / max(len(train_loader) - start_step, 1)
+    peak_mem = peak_memory_mb(device)
+    print('%s - step_time %.3fs - peak_mem %.0fMB' % (precision.precision, step_time, peak_mem))
+    if isinstance(train_loader, DevicePrefetcher):
+        print('input - queue_depth %.1f - stall %.1fs - worker_wait %.1fs - copy %.1fs'
+              % tuple(train_loader.stats().values()))
+
     # log to tensorboard
     if writer is not None:
 
         ## all head Loss in one window
         writer.add_scalars("Losses/train", postfix, epoch)
 
+        writer.add_scalar("Perf/step_time", step_time, epoch)
+        writer.add_scalar("Perf/peak_mem_mb", peak_mem, epoch)
+        if isinstance(train_loader, DevicePrefetcher):
+            for name, val in train_loader.stats().items():
+                writer.add_scalar("Perf/input_%s" % name, val, epoch)
+
         ## set loss in each windows
         if config["tvec"]:
-            writer.add_scalar("Loss_train/total_tvec", avg_meters['loss'].avg, epoch)
-            writer.add_scalar("Loss_train/total", avg_meters['loss'].avg - avg_meters["tvec"].avg * config["tvec_weight"], epoch)
+            writer.add_scalar("Loss_train/total_tvec", avg['loss'], epoch)
+            writer.add_scalar("Loss_train/total", avg['loss'] - avg["tvec"] * config["tvec_weight"], epoch)
         
         else:
-            writer.add_scalar("Loss_train/total", avg_meters['loss'].avg, epoch)
+            writer.add_scalar("Loss_train/total", avg['loss'], epoch)
 
         for head in heads.keys():
-            writer.add_scalar("Loss_train/{}".format(head), avg_meters[head].avg, epoch)
+            writer.add_scalar("Loss_train/{}".format(head), avg[head], epoch)
 
-    return avg_meters['loss'].avg
+    return avg['loss']
 
 
-def validate(config, heads, val_loader, model, criterion, epoch, writer=None):
-    avg_meters = {'loss': AverageMeter()}
-    for head in heads.keys():
-        avg_meters[head] = AverageMeter()
+def validate(config, heads, val_loader, model, criterion, epoch, writer=None, map_meter=None,
+             precision=None, device='cuda', feature_cache=None):
+    meter = MetricMeter(['loss'] + list(heads.keys()), device)
+
+    if precision is None:
+        precision = PrecisionPolicy('fp32')
 
     # switch to evaluate mode
     model.eval()
 
     with torch.no_grad():
-        pbar = tqdm(total=len(val_loader))
+        pbar = tqdm(total=len(val_loader), disable=not is_main_process())
         for i, batch in enumerate(val_loader):
-            input = batch['input'].cuda()
-            mask = batch['mask'].cuda()
-            reg_mask = batch['reg_mask'].cuda()
-
-            output = model(input)
+            input = batch['input'].to(device)
+            if config['channels_last']:
+                input = input.contiguous(memory_format=torch.channels_last)
+            mask = batch['mask'].to(device)
+            reg_mask = batch['reg_mask'].to(device)
+            ind = batch['ind'].to(device)
+            ind_mask = batch['ind_mask'].to(device)
+
+            x = input
+            if feature_cache is not None:
+                # val images are not augmented
+                x = get_features(feature_cache, model, input, batch['img_path'], [-1] * input.size(0), precision)
+
+            with precision.autocast():
+                output = model(x)
+            output = {head: output[head].float() for head in output}
 
             loss = 0
             losses = {}
             for head in heads.keys():
-                losses[head] = criterion[head](output[head], batch[head].cuda(),
-                                               mask if head == 'hm' else reg_mask)
+                if head == 'hm':
+                    losses[head] = criterion[head](output[head], batch[head].to(device), mask)
+                else:
+                    losses[head] = criterion[head](output[head], batch[head].to(device), reg_mask,
+                                                   ind=ind, ind_mask=ind_mask)
                 if head == 'wh':
                     loss += config['wh_weight'] * losses[head]
                 elif head == 'tvec':
@@ -238,16 +557,35 @@ def validate(config, heads, val_loader, model, criterion, epoch, writer=None):
                     loss += losses[head]
             losses['loss'] = loss
 
-            avg_meters['loss'].update(losses['loss'].item(), input.size(0))
-            postfix = OrderedDict([('loss', avg_meters['loss'].avg)])
-            for head in heads.keys():
-                avg_meters[head].update(losses[head].item(), input.size(0))
-                postfix[head + '_loss'] = avg_meters[head].avg
-            pbar.set_postfix(postfix)
+            if map_meter is not None:
+                batch_det = decode(
+                    config,
+                    output['hm'],
+                    output['reg'],
+                    output['depth'],
+                    eular=output['eular'] if config['rot'] == 'eular' else None,
+                    trig=output['trig'] if config['rot'] == 'trig' else None,
+                    quat=output['quat'] if config['rot'] == 'quat' else None,
+                    mask=mask,
+                )
+                map_meter.update(batch_det.cpu().numpy(), batch['gt'].numpy())
+
+            meter.update(losses, input.size(0))
+            if (i + 1) % config['log_interval'] == 0:
+                pbar.set_postfix(get_postfix(meter.avg()))
             pbar.update(1)
 
+        meter.synchronize()
+        avg = meter.avg()
+        postfix = get_postfix(avg)
+        pbar.set_postfix(postfix)
         pbar.close()
 
+    val_map = None
+    if map_meter is not None:
+        map_meter.synchronize()
+        val_map = map_meter.compute()
+
     # log to tensorboard
     if writer is not None:
 
@@ -256,36 +594,59 @@ def validate(config, heads, val_loader, model, criterion, epoch, writer=None):
     
         ## set loss in each windows
         if config["tvec"]:
-            writer.add_scalar("Loss_valid/total_tvec", avg_meters['loss'].avg, epoch)
-            writer.add_scalar("Loss_valid/total", avg_meters['loss'].avg - avg_meters["tvec"].avg * config["tvec_weight"], epoch)
+            writer.add_scalar("Loss_valid/total_tvec", avg['loss'], epoch)
+            writer.add_scalar("Loss_valid/total", avg['loss'] - avg["tvec"] * config["tvec_weight"], epoch)
         
         else:
-            writer.add_scalar("Loss_valid/total", avg_meters['loss'].avg, epoch)
+            writer.add_scalar("Loss_valid/total", avg['loss'], epoch)
 
         for head in heads.keys():
-            writer.add_scalar("Loss_valid/{}".format(head), avg_meters[head].avg, epoch)
+            writer.add_scalar("Loss_valid/{}".format(head), avg[head], epoch)
 
-    return avg_meters['loss'].avg
+        if val_map is not None:
+            writer.add_scalar("mAP_valid", val_map, epoch)
+
+    return avg['loss'], val_map
 
 
 def main():
     config = vars(parse_args())
 
-    if config['name'] is None:
-        config['name'] = '%s_%s' % (config['arch'], datetime.now().strftime('%m%d%H'))
-
-    config['num_filters'] = [int(n) for n in config['num_filters'].split(',')]
+    rank, world_size, local_rank = init_distributed(config['dist_backend'])
+    setup_print(is_main_process())
 
-    if not os.path.exists('models/detection/%s' % config['name']):
-        os.makedirs('models/detection/%s' % config['name'])
-
-    if config['resume']:
+    if config['fold'] is not None:
+        # fold worker started by the scheduler, the settings come from config.yml
+        fold = config['fold']
         with open('models/detection/%s/config.yml' % config['name'], 'r') as f:
             config = yaml.load(f, Loader=yaml.FullLoader)
-        config['resume'] = True
+        config['fold'] = fold
+        config['resume'] = os.path.exists(get_checkpoint_path(config))
+        if config['fold_threads'] > 0:
+            torch.set_num_threads(config['fold_threads'])
+    else:
+        if config['name'] is None:
+            config['name'] = '%s_%s' % (config['arch'], datetime.now().strftime('%m%d%H'))
+
+        config['num_filters'] = [int(n) for n in config['num_filters'].split(',')]
+
+        if config['feature_cache'] and not config['freeze_backbone']:
+            print('=> feature_cache caches a frozen backbone, setting freeze_backbone')
+            config['freeze_backbone'] = True
+
+        if not os.path.exists('models/detection/%s' % config['name']):
+            os.makedirs('models/detection/%s' % config['name'])
 
-    with open('models/detection/%s/config.yml' % config['name'], 'w') as f:
-        yaml.dump(config, f)
+        if config['resume']:
+            stop_epoch = config['stop_epoch']
+            with open('models/detection/%s/config.yml' % config['name'], 'r') as f:
+                config = yaml.load(f, Loader=yaml.FullLoader)
+            config['resume'] = True
+            config['stop_epoch'] = stop_epoch
+
+        if is_main_process():
+            with open('models/detection/%s/config.yml' % config['name'], 'w') as f:
+                yaml.dump(config, f)
 
     print('-'*20)
     for key in config.keys():
@@ -294,10 +655,38 @@ def main():
 
     cudnn.benchmark = False
 
-    df = pd.read_csv('inputs/train.csv')
-    img_paths = np.array('inputs/train_images/' + df['ImageId'].values + '.jpg')
-    mask_paths = np.array('inputs/train_masks/' + df['ImageId'].values + '.jpg')
-    labels = np.array([convert_str_to_labels(s) for s in df['PredictionString']])
+    device = get_device(config['device'], local_rank)
+
+    # parsed once by the scheduler (or a sweep) and shared with the fold workers (or trials)
+    data_cache = config['data_cache'] or 'models/detection/%s/data.pkl' % config['name']
+    if (config['fold'] is not None or config['data_cache']) and os.path.exists(data_cache):
+        img_paths, mask_paths, labels = joblib.load(data_cache)
+    else:
+        df = pd.read_csv('inputs/train.csv')
+        img_paths = np.array('inputs/train_images/' + df['ImageId'].values + '.jpg')
+        mask_paths = np.array('inputs/train_masks/' + df['ImageId'].values + '.jpg')
+        labels = np.array([convert_str_to_labels(s) for s in df['PredictionString']])
+        if config['data_cache'] and is_main_process():
+            joblib.dump((img_paths, mask_paths, labels), data_cache)
+
+    image_cache = ImageCache(config['image_cache']) if config['image_cache'] else None
+
+    if config['fold_workers'] > 0 and config['fold'] is None:
+        joblib.dump((img_paths, mask_paths, labels), data_cache)
+
+        n_folds = config['n_splits'] if config['cv'] else 1
+        folds = [fold for fold in range(1, n_folds + 1) if not fold_done(config, fold)]
+        returncodes = run_folds(os.path.abspath(__file__), config['name'], folds,
+                                config['fold_workers'],
+                                devices=config['fold_devices'].split(',') if config['fold_devices'] else None,
+                                num_threads=config['fold_threads'],
+                                out_dir='models/detection/%s' % config['name'])
+        write_results(config, n_folds)
+
+        failed = [str(fold) for fold, code in returncodes.items() if code != 0]
+        if failed:
+            print('=> failed folds: %s, run again with --resume to continue them' % ', '.join(failed))
+        return
 
     test_img_paths = None
     test_mask_paths = None
@@ -322,7 +711,7 @@ def main():
             raise NotImplementedError
 
     if config['resume']:
-        checkpoint = torch.load('models/detection/%s/checkpoint.pth.tar' % config['name'])
+        checkpoint = torch.load(get_checkpoint_path(config), weights_only=False)
 
     heads = OrderedDict([
         ('hm', 1),
@@ -347,7 +736,7 @@ def main():
 
     criterion = OrderedDict()
     for head in heads.keys():
-        criterion[head] = losses.__dict__[config[head + '_loss']]().cuda()
+        criterion[head] = losses.__dict__[config[head + '_loss']]().to(device)
 
     train_transform = Compose([
         transforms.ShiftScaleRotate(
@@ -382,23 +771,51 @@ def main():
         ) if config['clahe'] else NoOp(),
     ], keypoint_params=KeypointParams(format='xy', remove_invisible=False))
 
+    train_augment = None
+    if config['batch_aug']:
+        # ISONoise and CLAHE have no batched version and stay in the workers
+        train_transform = Compose([
+            transforms.ISONoise(
+                p=config['iso_noise_p'],
+            ) if config['iso_noise'] else NoOp(),
+            transforms.CLAHE(
+                p=config['clahe_p'],
+            ) if config['clahe'] else NoOp(),
+        ])
+        # NoOp entries keep the OneOf probabilities of train_transform
+        color = [
+            ('hsv', config['hsv_p'], (config['hue_limit'], config['sat_limit'], config['val_limit']))
+            if config['hsv'] else (None, 0.5, None),
+            ('brightness', config['brightness_p'], config['brightness_limit'])
+            if config['brightness'] else (None, 0.5, None),
+            ('contrast', config['contrast_p'], config['contrast_limit'])
+            if config['contrast'] else (None, 0.5, None),
+        ]
+
     val_transform = None
 
     folds = []
     best_losses = []
+    best_maps = []
     # best_scores = []
 
     kf = KFold(n_splits=config['n_splits'], shuffle=True, random_state=41)
     for fold, (train_idx, val_idx) in enumerate(kf.split(img_paths)):
+        if config['fold'] is not None and fold + 1 != config['fold']:
+            continue
+
         print('Fold [%d/%d]' %(fold + 1, config['n_splits']))
-        writer = SummaryWriter(log_dir=config["log_dir"]+config["name"]+"/fold{:02d}".format(fold+1))
+        writer = None
+        if is_main_process():
+            writer = SummaryWriter(log_dir=config["log_dir"]+config["name"]+"/fold{:02d}".format(fold+1))
 
         if (config['resume'] and fold < checkpoint['fold'] - 1) or (not config['resume'] and os.path.exists('models/%s/model_%d.pth' % (config['name'], fold+1))):
             log = pd.read_csv('models/detection/%s/log_%d.csv' %(config['name'], fold+1))
-            best_loss = log.loc[log['val_loss'].values.argmin(), 'val_loss']
+            best_loss, best_map = get_best(log, config['best_metric'])
             # best_loss, best_score = log.loc[log['val_loss'].values.argmin(), ['val_loss', 'val_score']].values
             folds.append(str(fold + 1))
             best_losses.append(best_loss)
+            best_maps.append(best_map)
             # best_scores.append(best_score)
             continue
 
@@ -420,20 +837,39 @@ def main():
             input_h=config['input_h'],
             transform=train_transform,
             lhalf=config['lhalf'],
-            hflip=config['hflip_p'] if config['hflip'] else 0,
-            scale=config['scale_p'] if config['scale'] else 0,
+            hflip=0 if config['batch_aug'] or not config['hflip'] else config['hflip_p'],
+            scale=0 if config['batch_aug'] or not config['scale'] else config['scale_p'],
             scale_limit=config['scale_limit'],
+            image_cache=image_cache,
+            batch_aug=config['batch_aug'],
             # test_img_paths=test_img_paths,
             # test_mask_paths=test_mask_paths,
             # test_outputs=test_outputs,
         )
-        train_loader = torch.utils.data.DataLoader(
-            train_set,
+        train_sampler = ResumableSampler(train_set, num_replicas=world_size, rank=rank, seed=config['seed'],
+                                         num_variants=config['feature_cache_variants'] if config['feature_cache'] else 0)
+        train_loader = build_loader(
+            SeededDataset(train_set, return_seed=config['feature_cache'] or config['batch_aug']),
             batch_size=config['batch_size'],
-            shuffle=True,
+            sampler=train_sampler,
             num_workers=config['num_workers'],
-            # pin_memory=True,
+            pin_memory=config['pin_memory'],
+            persistent_workers=config['persistent_workers'],
+            prefetch_factor=config['prefetch_factor'],
         )
+        if config['batch_aug']:
+            train_augment = BatchAugment(
+                train_set,
+                hflip=config['hflip_p'] if config['hflip'] else 0,
+                scale=config['scale_p'] if config['scale'] else 0,
+                scale_limit=config['scale_limit'],
+                shift=config['shift_p'] if config['shift'] else 0,
+                shift_limit=config['shift_limit'],
+                color=color)
+            train_loader = BatchAugmentLoader(train_loader, train_augment,
+                                              pin_memory=config['pin_memory'] and device.type == 'cuda')
+        if config['prefetch_depth'] > 0:
+            train_loader = DevicePrefetcher(train_loader, device, config['prefetch_depth'])
 
         val_set = Dataset(
             val_img_paths,
@@ -442,14 +878,29 @@ def main():
             input_w=config['input_w'],
             input_h=config['input_h'],
             transform=val_transform,
-            lhalf=config['lhalf'])
-        val_loader = torch.utils.data.DataLoader(
-            val_set,
-            batch_size=config['batch_size'],
-            shuffle=False,
-            num_workers=config['num_workers'],
-            # pin_memory=True,
-        )
+            lhalf=config['lhalf'],
+            image_cache=image_cache)
+
+        def get_val_loader(dataset):
+            loader = build_loader(
+                shard_dataset(dataset, rank, world_size),
+                batch_size=config['batch_size'],
+                shuffle=False,
+                num_workers=config['num_workers'],
+                pin_memory=config['pin_memory'],
+                persistent_workers=config['persistent_workers'],
+                prefetch_factor=config['prefetch_factor'],
+            )
+            if config['prefetch_depth'] > 0:
+                loader = DevicePrefetcher(loader, device, config['prefetch_depth'])
+            return loader
+
+        val_loader = get_val_loader(val_set)
+        val_subset_loader = None
+        if config['val_subset'] < 1:
+            subset_size = max(int(round(len(val_set) * config['val_subset'])), 1)
+            subset_idx = np.sort(np.random.RandomState(config['seed']).choice(len(val_set), subset_size, replace=False))
+            val_subset_loader = get_val_loader(torch.utils.data.Subset(val_set, subset_idx))
 
         # create model
         model = get_model(config['arch'], heads=heads,
@@ -457,12 +908,56 @@ def main():
                           num_filters=config['num_filters'],
                           dcn=config['dcn'],
                           gn=config['gn'], ws=config['ws'],
-                          freeze_bn=config['freeze_bn'])
-        model = model.cuda()
+                          freeze_bn=config['freeze_bn'],
+                          freeze_backbone=config['freeze_backbone'],
+                          checkpointing=config['checkpointing'])
+        if config['sync_bn'] and world_size > 1:
+            if device.type == 'cuda':
+                convert_sync_bn(model, ['lateral4', 'lateral3', 'lateral2', 'lateral1',
+                                        'decode3', 'decode2', 'decode1'])
+            else:
+                print('=> SyncBatchNorm needs cuda, keeping per-process BatchNorm')
+        model = model.to(device)
+        if config['channels_last']:
+            model = model.to(memory_format=torch.channels_last)
 
         if config['load_model'] is not None:
             model.load_state_dict(torch.load('models/detection/%s/model_%d.pth' %(config['load_model'], fold+1)))
 
+        feature_cache = None
+        if config['feature_cache']:
+            feature_cache = FeatureCache(get_feature_cache_path(config, fold, rank, world_size),
+                                         len(train_set) * config['feature_cache_variants'] + len(val_set))
+            print('=> feature cache %s' % feature_cache.path)
+
+        if config['memory_budget'] > 0:
+            def probe(model, n):
+                batch = torch.utils.data.default_collate([train_set[k % len(train_set)] for k in range(n)])
+                if train_augment is not None:
+                    batch = train_augment(batch)
+                input = batch['input']
+                input = input.to(device)
+                if config['channels_last']:
+                    input = input.contiguous(memory_format=torch.channels_last)
+                with PrecisionPolicy(config['precision'], device.type).autocast():
+                    output = model(input)
+                sum(o.float().mean() for o in output.values()).backward()
+
+            micro_batch_size = estimate_micro_batch_size(model, probe, config['batch_size'],
+                                                         config['memory_budget'], device)
+            # the same number of micro-batches on every process
+            config['micro_batch_size'] = min(all_gather_objects(micro_batch_size))
+            print('=> micro_batch_size %d for a %.0fMB budget' % (config['micro_batch_size'], config['memory_budget']))
+
+        # model stays unwrapped for state_dicts, net runs the forward passes
+        net = model
+        if world_size > 1:
+            # the backbone's classifier never gets gradients: static_graph, or
+            # find_unused_parameters with micro-batches as static_graph breaks no_sync
+            accumulate = len(micro_batches(config['batch_size'], config['micro_batch_size'])) > 1
+            net = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None,
+                                          static_graph=not accumulate, find_unused_parameters=accumulate)
+
         params = filter(lambda p: p.requires_grad, model.parameters())
         if config['optimizer'] == 'Adam':
             optimizer = optim.Adam(params, lr=config['lr'], weight_decay=config['weight_decay'])
@@ -491,36 +986,139 @@ def main():
             'loss': [],
             # 'score': [],
             'val_loss': [],
+            'val_map': [],
             # 'val_score': [],
+            'input_w': [],
+            'input_h': [],
+            'time': [],
+            'val_mode': [],
         }
 
         best_loss = float('inf')
+        best_map = -float('inf')
+        best_mode = None
+
+        precision = PrecisionPolicy(config['precision'], device.type)
+
+        health = None
+        if config['health']:
+            health = HealthMonitor(heads=[h for h in config['health_heads'].split(',') if h in heads],
+                                   grad_norm_interval=config['grad_norm_interval'],
+                                   anomaly_window=config['anomaly_window'])
         # best_score = float('inf')
 
         start_epoch = 0
+        start_step = 0
+        meter_state = None
+
+        checkpoints = None
+        if is_main_process():
+            checkpoints = CheckpointManager(
+                get_checkpoint_path(config),
+                keep_last=config['keep_checkpoints'],
+                history_fmt='models/detection/%s/checkpoint_%d.epoch%%d.pth.tar' % (config['name'], fold+1),
+                async_save=config['async_checkpoint'])
 
         if config['resume'] and fold == checkpoint['fold'] - 1:
             model.load_state_dict(checkpoint['state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
             start_epoch = checkpoint['epoch']
-            log = pd.read_csv('models/detection/%s/log_%d.csv' % (config['name'], fold+1)).to_dict(orient='list')
+            # no log yet when interrupted during the first epoch
+            if os.path.exists('models/detection/%s/log_%d.csv' % (config['name'], fold+1)):
+                log = pd.read_csv('models/detection/%s/log_%d.csv' % (config['name'], fold+1)).to_dict(orient='list')
+                # epochs logged after the last saved checkpoint are trained again
+                log = {k: v[:start_epoch] for k, v in log.items()}
+                for key in ['input_w', 'input_h', 'time']:
+                    log.setdefault(key, [np.nan] * len(log['epoch']))
+                log.setdefault('val_mode', ['full'] * len(log['epoch']))
             best_loss = checkpoint['best_loss']
+            best_map = checkpoint.get('best_map', -float('inf'))
+            best_mode = checkpoint.get('best_mode', 'full')
+            if 'scaler' in checkpoint:
+                precision.load_state_dict(checkpoint['scaler'])
+            if checkpoint.get('step', 0) > 0:
+                # continue the interrupted epoch after its last saved step
+                start_step = checkpoint['step']
+                train_sampler.load_state_dict(checkpoint['sampler'])
+                meter_state = checkpoint['meter'][rank % len(checkpoint['meter'])]
+                set_rng_state(checkpoint['rng'][rank % len(checkpoint['rng'])])
+                print('=> resuming epoch %d at step %d' % (start_epoch + 1, start_step))
+
+        def save_step(step, meter):
+            if config['checkpoint_steps'] <= 0 or step % config['checkpoint_steps'] != 0:
+                return
+            # every process contributes its own meter and RNG states
+            meter_states = all_gather_objects(meter.state_dict())
+            rng_states = all_gather_objects(get_rng_state())
+            if not is_main_process():
+                return
+            state = {
+                'fold': fold + 1,
+                'epoch': train_sampler.epoch,
+                'step': step,
+                'state_dict': model.state_dict(),
+                'best_loss': best_loss,
+                'best_map': best_map,
+                'best_mode': best_mode,
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'scaler': precision.state_dict(),
+                'sampler': train_sampler.state_dict(step * config['batch_size']),
+                'meter': meter_states,
+                'rng': rng_states,
+            }
+            checkpoints.save(state)
+
+        end_epoch = config['epochs']
+        if config['stop_epoch'] > 0:
+            end_epoch = min(config['stop_epoch'], end_epoch)
 
-        for epoch in range(start_epoch, config['epochs']):
+        for epoch in range(start_epoch, end_epoch):
             print('Epoch [%d/%d]' % (epoch + 1, config['epochs']))
 
+            train_sampler.set_epoch(epoch)
+            input_w, input_h = get_input_size(config, epoch)
+            if config['resize_schedule']:
+                train_sampler.set_input_size((input_w, input_h))
+                print('input size %dx%d' % (input_w, input_h))
+            epoch_start = time.time()
+
             # train for one epoch
-            train_loss = train(config, heads, train_loader, model, criterion, optimizer, epoch, writer=writer)
+            train_loss = train(config, heads, train_loader, net, criterion, optimizer, epoch, writer=writer,
+                               health=health, precision=precision, device=device, start_step=start_step,
+                               meter_state=meter_state, step_callback=save_step, feature_cache=feature_cache)
+            start_step = 0
+            meter_state = None
             # evaluate on validation set
-            val_loss = validate(config, heads, val_loader, model, criterion, epoch, writer=writer)
+            val_mode = get_val_mode(config, epoch)
+            val_loss, val_map = np.nan, None
+            if val_mode != 'skip':
+                map_meter = None
+                if config['map_interval'] > 0 and ((epoch + 1) % config['map_interval'] == 0 or epoch + 1 == config['epochs']):
+                    map_meter = MAPMeter(score_th=config['map_score_th'])
+                val_loss, val_map = validate(config, heads, val_subset_loader if val_mode == 'subset' else val_loader,
+                                             net, criterion, epoch, writer=writer, map_meter=map_meter,
+                                             precision=precision, device=device, feature_cache=feature_cache)
 
             if config['scheduler'] == 'CosineAnnealingLR':
                 scheduler.step()
-            elif config['scheduler'] == 'ReduceLROnPlateau':
+            elif config['scheduler'] == 'ReduceLROnPlateau' and val_mode != 'skip':
                 scheduler.step(val_loss)
 
-            print('loss %.4f - val_loss %.4f' % (train_loss, val_loss))
+            if feature_cache is not None:
+                feature_cache.flush()
+                hit_rate = feature_cache.stats()
+                print('feature cache - hit_rate %.3f' % hit_rate)
+                if writer is not None:
+                    writer.add_scalar("Perf/feature_cache_hit_rate", hit_rate, epoch)
+
+            if val_mode == 'skip':
+                print('loss %.4f - no validation' % train_loss)
+            elif val_map is None:
+                print('loss %.4f - val_loss %.4f (%s)' % (train_loss, val_loss, val_mode))
+            else:
+                print('loss %.4f - val_loss %.4f - val_map %.4f (%s)' % (train_loss, val_loss, val_map, val_mode))
             # print('loss %.4f - score %.4f - val_loss %.4f - val_score %.4f'
             #       % (train_loss, train_score, val_loss, val_score))
 
@@ -528,52 +1126,103 @@ def main():
             log['loss'].append(train_loss)
             # log['score'].append(train_score)
             log['val_loss'].append(val_loss)
+            log['val_map'].append(val_map if val_map is not None else np.nan)
             # log['val_score'].append(val_score)
+            log['input_w'].append(input_w)
+            log['input_h'].append(input_h)
+            # cumulative train and validation time of the fold
+            log['time'].append(np.nansum(log['time'][-1:]) + time.time() - epoch_start)
+            log['val_mode'].append(val_mode)
+
+            stall = 0
+            if is_main_process():
+                stall += checkpoints.save_log(pd.DataFrame(log), 'models/detection/%s/log_%d.csv' % (config['name'], fold+1))
+
+            if val_mode == 'skip' or (val_mode == 'subset' and best_mode == 'full'):
+                is_best = False
+            elif val_mode == 'full' and best_mode == 'subset':
+                # full validations replace the subset ones
+                is_best = True
+            elif config['best_metric'] == 'val_map' and val_map is not None:
+                # best_map is nan when the best model so far was chosen by val_loss
+                is_best = not val_map <= best_map
+            elif config['best_metric'] == 'val_map':
+                # val_loss until the first mAP, so a best model exists
+                is_best = not best_map > -float('inf') and val_loss < best_loss
+            else:
+                is_best = val_loss < best_loss
 
-            pd.DataFrame(log).to_csv('models/detection/%s/log_%d.csv' % (config['name'], fold+1), index=False)
-
-            if val_loss < best_loss:
-                torch.save(model.state_dict(), 'models/detection/%s/model_%d.pth' % (config['name'], fold+1))
+            if is_best:
+                if is_main_process():
+                    stall += checkpoints.save_best(model.state_dict(), 'models/detection/%s/model_%d.pth' % (config['name'], fold+1))
                 best_loss = val_loss
+                best_map = val_map if val_map is not None else np.nan
+                best_mode = val_mode
                 # best_score = val_score
                 print("=> saved best model")
 
-            state = {
-                'fold': fold + 1,
-                'epoch': epoch + 1,
-                'state_dict': model.state_dict(),
-                'best_loss': best_loss,
-                'optimizer': optimizer.state_dict(),
-                'scheduler': scheduler.state_dict(),
-            }
-            torch.save(state, 'models/detection/%s/checkpoint.pth.tar' % config['name'])
+            if (epoch + 1) % config['save_interval'] == 0 or epoch + 1 == end_epoch:
+                state = {
+                    'fold': fold + 1,
+                    'epoch': epoch + 1,
+                    'state_dict': model.state_dict(),
+                    'best_loss': best_loss,
+                    'best_map': best_map,
+                    'best_mode': best_mode,
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'scaler': precision.state_dict(),
+                }
+                if is_main_process():
+                    stall += checkpoints.save(state, epoch + 1)
+            print('checkpoint stall %.3fs' % stall)
+            if writer is not None:
+                writer.add_scalar("Perf/checkpoint_stall", stall, epoch)
+
+        if checkpoints is not None:
+            checkpoints.close()
+
+        if feature_cache is not None:
+            feature_cache.close()
+
+        if health is not None:
+            health.close()
+            print('numerical health events: %d' % health.num_events)
 
         print('val_loss:  %f' % best_loss)
+        if config['map_interval'] > 0:
+            print('val_map:   %f' % best_map)
         # print('val_score: %f' % best_score)
 
         folds.append(str(fold + 1))
         best_losses.append(best_loss)
+        best_maps.append(best_map)
         # best_scores.append(best_score)
 
-        results = pd.DataFrame({
-            'fold': folds + ['mean'],
-            'best_loss': best_losses + [np.mean(best_losses)],
-            # 'best_score': best_scores + [np.mean(best_scores)],
-        })
+        # fold workers leave results.csv to the scheduler
+        if config['fold'] is None and is_main_process():
+            results = pd.DataFrame({
+                'fold': folds + ['mean'],
+                'best_loss': best_losses + [np.mean(best_losses)],
+                'best_map': best_maps + [np.mean(best_maps)],
+                # 'best_score': best_scores + [np.mean(best_scores)],
+            })
 
-        print(results)
-        results.to_csv('models/detection/%s/results.csv' % config['name'], index=False)
+            print(results)
+            results.to_csv('models/detection/%s/results.csv' % config['name'], index=False)
 
         del model
         torch.cuda.empty_cache()
 
         del train_set, train_loader
-        del val_set, val_loader
+        del val_set, val_loader, val_subset_loader
         gc.collect()
 
         if not config['cv']:
             break
 
+    cleanup()
+
 
 if __name__ == '__main__':
     main()
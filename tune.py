@@ -0,0 +1,194 @@
+import os
+import sys
+import math
+import shlex
+import itertools
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import joblib
+
+from lib.utils.utils import *
+from lib.fold_scheduler import run_jobs
+from lib.image_cache import build_image_cache
+from train import get_best
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--name', default=None)
+    parser.add_argument('--params', required=True,
+                        help='train.py arguments to sweep, e.g. "wh_weight=0.05,0.1;tvec_weight=0.5,1.0"')
+    parser.add_argument('--num_trials', default=0, type=int,
+                        help='random trials drawn from the grid (0: the whole grid)')
+    parser.add_argument('--train_args', default='',
+                        help='arguments passed to every trial, e.g. "--arch resnet18_fpn --batch_size 4"')
+    parser.add_argument('--epochs', default=30, type=int)
+    parser.add_argument('--input_w', default=2560, type=int)
+    parser.add_argument('--input_h', default=2048, type=int)
+    parser.add_argument('--seed', default=41, type=int)
+
+    # successive halving
+    parser.add_argument('--rungs', default='',
+                        help='comma separated epochs after which only the best 1/eta trials go on '
+                             '(empty: train every trial for all epochs)')
+    parser.add_argument('--eta', default=2, type=int)
+
+    # budget
+    parser.add_argument('--workers', default=1, type=int,
+                        help='trials trained in parallel')
+    parser.add_argument('--devices', default=None,
+                        help='comma separated CUDA devices given to the workers in turn')
+    parser.add_argument('--threads', default=0, type=int,
+                        help='CPU threads per worker (0: no limit)')
+
+    # shared data
+    parser.add_argument('--cache_images', default=True, type=str2bool,
+                        help='decode the images once for all trials')
+    parser.add_argument('--image_cache_dir', default=None,
+                        help='default: processed/images_<input_w>x<input_h>')
+    parser.add_argument('--n_jobs', default=-1, type=int)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def parse_params(params):
+    """'a=1,2;b=x' -> OrderedDict([('a', ['1', '2']), ('b', ['x'])])"""
+    space = OrderedDict()
+    for param in params.split(';'):
+        if not param.strip():
+            continue
+        name, values = param.split('=')
+        space[name.strip()] = [v.strip() for v in values.split(',')]
+    return space
+
+
+def get_trials(config):
+    space = parse_params(config['params'])
+    grid = list(itertools.product(*space.values()))
+    if 0 < config['num_trials'] < len(grid):
+        idx = np.sort(np.random.RandomState(config['seed']).choice(len(grid), config['num_trials'], replace=False))
+        grid = [grid[i] for i in idx]
+    trials = pd.DataFrame(grid, columns=list(space.keys()))
+    trials.insert(0, 'trial', ['%s_%03d' % (config['name'], i) for i in range(len(trials))])
+    return trials
+
+
+def get_rungs(config):
+    rungs = sorted(set(int(r) for r in config['rungs'].split(',') if r))
+    return [r for r in rungs if r < config['epochs']] + [config['epochs']]
+
+
+def trial_status(trial):
+    """(epochs trained, best val_loss, its val_map) from the fold 1 log."""
+    path = 'models/detection/%s/log_1.csv' % trial
+    if not os.path.exists(path):
+        return 0, np.nan, np.nan
+    log = pd.read_csv(path)
+    if not log['val_loss'].notnull().any():
+        return len(log), np.nan, np.nan
+    best_loss, best_map = get_best(log, 'val_loss')
+    return len(log), best_loss, best_map
+
+
+def main():
+    config = vars(parse_args())
+
+    if config['name'] is None:
+        config['name'] = 'sweep_%s' % datetime.now().strftime('%m%d%H')
+    sweep_dir = 'models/sweeps/%s' % config['name']
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # the same trials when a sweep is started again
+    trials_path = os.path.join(sweep_dir, 'trials.csv')
+    if os.path.exists(trials_path):
+        trials = pd.read_csv(trials_path, dtype=str)
+    else:
+        trials = get_trials(config)
+        trials.to_csv(trials_path, index=False)
+    params = [c for c in trials.columns if c != 'trial']
+    print(trials.to_string(index=False))
+
+    # parsed and decoded once, shared by all trials
+    data_cache = os.path.join(sweep_dir, 'data.pkl')
+    if not os.path.exists(data_cache):
+        df = pd.read_csv('inputs/train.csv')
+        img_paths = np.array('inputs/train_images/' + df['ImageId'].values + '.jpg')
+        mask_paths = np.array('inputs/train_masks/' + df['ImageId'].values + '.jpg')
+        labels = np.array([convert_str_to_labels(s) for s in df['PredictionString']])
+        joblib.dump((img_paths, mask_paths, labels), data_cache)
+    shared_args = ['--data_cache', data_cache]
+    if config['cache_images']:
+        image_cache_dir = config['image_cache_dir'] or 'processed/images_%dx%d' % (config['input_w'], config['input_h'])
+        img_paths, mask_paths, _ = joblib.load(data_cache)
+        build_image_cache(image_cache_dir, img_paths, mask_paths, config['input_w'], config['input_h'],
+                          n_jobs=config['n_jobs'])
+        shared_args += ['--image_cache', image_cache_dir]
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+    train_args = shlex.split(config['train_args'])
+    devices = config['devices'].split(',') if config['devices'] else None
+
+    results = trials.copy()
+    results['epochs'] = 0
+    results['val_loss'] = np.nan
+    results['val_map'] = np.nan
+    results['status'] = 'pending'
+
+    rungs = get_rungs(config)
+    alive = list(results.index)
+    for r, stop_epoch in enumerate(rungs):
+        print('Rung [%d/%d]: %d trials to epoch %d' % (r + 1, len(rungs), len(alive), stop_epoch))
+        jobs = []
+        for t in alive:
+            trial = results.loc[t, 'trial']
+            if trial_status(trial)[0] >= stop_epoch:
+                continue
+            command = [sys.executable, script] + train_args + [
+                '--name', trial,
+                '--epochs', str(config['epochs']),
+                '--input_w', str(config['input_w']),
+                '--input_h', str(config['input_h']),
+                '--cv', 'False',
+                '--stop_epoch', str(stop_epoch),
+            ] + shared_args
+            for param in params:
+                command += ['--' + param, str(results.loc[t, param])]
+            # stopped at the previous rung (or interrupted)
+            if os.path.exists('models/detection/%s/checkpoint.pth.tar' % trial):
+                command.append('--resume')
+            jobs.append((trial, command, os.path.join(sweep_dir, '%s.txt' % trial)))
+        returncodes = run_jobs(jobs, config['workers'], devices=devices, num_threads=config['threads'])
+
+        for t in list(alive):
+            trial = results.loc[t, 'trial']
+            results.loc[t, ['epochs', 'val_loss', 'val_map']] = trial_status(trial)
+            if returncodes.get(trial, 0) != 0:
+                results.loc[t, 'status'] = 'failed'
+                alive.remove(t)
+            else:
+                results.loc[t, 'status'] = 'done' if stop_epoch == config['epochs'] else 'running'
+
+        if r < len(rungs) - 1:
+            # successive halving on the best val_loss so far
+            alive = sorted(alive, key=lambda t: np.nan_to_num(results.loc[t, 'val_loss'], nan=np.inf))
+            n_keep = max(int(math.ceil(len(alive) / config['eta'])), 1)
+            for t in alive[n_keep:]:
+                results.loc[t, 'status'] = 'stopped'
+            alive = alive[:n_keep]
+
+        results.to_csv(os.path.join(sweep_dir, 'results.csv'), index=False)
+
+    results = results.sort_values('val_loss')
+    results.to_csv(os.path.join(sweep_dir, 'results.csv'), index=False)
+    print(results.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ from collections import OrderedDict
 import random
 import warnings
 from datetime import datetime
-import json
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -39,6 +38,9 @@ from lib import losses
 from lib.decodes import decode
 from lib.utils.vis import visualize
 from lib.utils.nms import nms
+from lib.precision import PrecisionPolicy
+from lib.data_pipeline import build_loader
+from lib.utils.det_store import save_dets, get_columns
 
 
 def parse_args():
@@ -49,6 +51,8 @@ def parse_args():
     parser.add_argument('--nms', default=False, type=str2bool)
     parser.add_argument('--nms_th', default=0.1, type=float)
     parser.add_argument('--hflip', default=False, type=str2bool)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--channels_last', default=False, type=str2bool)
     parser.add_argument('--show', action='store_true')
 
     args = parser.parse_args()
@@ -69,6 +73,8 @@ def main():
 
     cudnn.benchmark = True
 
+    precision = PrecisionPolicy(args.precision)
+
     df = pd.read_csv('inputs/train.csv')
     img_paths = np.array('inputs/train_images/' + df['ImageId'].values + '.jpg')
     mask_paths = np.array('inputs/train_masks/' + df['ImageId'].values + '.jpg')
@@ -112,12 +118,12 @@ def main():
             input_h=config['input_h'],
             transform=None,
             lhalf=config['lhalf'])
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = build_loader(
             val_set,
             batch_size=config['batch_size'],
             shuffle=False,
             num_workers=config['num_workers'],
-            # pin_memory=True,
+            persistent_workers=False,
         )
 
         model = get_model(config['arch'], heads=heads,
@@ -127,6 +133,8 @@ def main():
                           gn=config['gn'], ws=config['ws'],
                           freeze_bn=config['freeze_bn'])
         model = model.cuda()
+        if args.channels_last:
+            model = model.to(memory_format=torch.channels_last)
 
         model_path = 'models/detection/%s/model_%d.pth' % (config['name'], fold+1)
         if not os.path.exists(model_path):
@@ -142,14 +150,20 @@ def main():
             pbar = tqdm(total=len(val_loader))
             for i, batch in enumerate(val_loader):
                 input = batch['input'].cuda()
+                if args.channels_last:
+                    input = input.contiguous(memory_format=torch.channels_last)
                 mask = batch['mask'].cuda()
                 hm = batch['hm'].cuda()
                 reg_mask = batch['reg_mask'].cuda()
 
-                output = model(input)
+                with precision.autocast():
+                    output = model(input)
+                output = {head: output[head].float() for head in output}
 
                 if args.hflip:
-                    output_hf = model(torch.flip(input, (-1,)))
+                    with precision.autocast():
+                        output_hf = model(torch.flip(input, (-1,)))
+                    output_hf = {head: output_hf[head].float() for head in output_hf}
                     output_hf['hm'] = torch.flip(output_hf['hm'], (-1,))
                     output_hf['reg'] = torch.flip(output_hf['reg'], (-1,))
                     output_hf['reg'][:, 0] = 1 - output_hf['reg'][:, 0]
@@ -205,7 +219,7 @@ def main():
                         'mask': mask[k:k+1].cpu(),
                     }
 
-                    dets[img_id] = det.tolist()
+                    dets[img_id] = det
                     if args.nms:
                         det = nms(det, dist_th=args.nms_th)
                     pred_df.loc[pred_df.ImageId == img_id, 'PredictionString'] = convert_labels_to_str(det[det[:, 6] > args.score_th, :7])
@@ -233,8 +247,8 @@ def main():
         if not config['cv']:
             break
 
-    with open('outputs/decoded/val/%s.json' %args.name, 'w') as f:
-        json.dump(dets, f)
+    save_dets('outputs/decoded/val/%s' %args.name, dets,
+              columns=get_columns(wh=config['wh']))
 
     name = '%s_%.2f' %(args.name, args.score_th)
     if args.nms: